@@ -33,6 +33,14 @@ def init_database(db_path):
         ON conversations (session_id, timestamp)
     ''')
     
+    # キーセットページング用インデックス（セッション内をidで一意に並べる）
+    # idはrowidの別名のため、取得する列は行の参照で読む通常のインデックス（カバリングではない）。
+    # (session_id, timestamp) ではid順に並ばず、ページごとに全件ソートが必要になるため別に作成する
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_conversations_session_id
+        ON conversations (session_id, id)
+    ''')
+    
     # ユーザー情報テーブル（実際に使用中）
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS user_info (
@@ -74,6 +74,9 @@ class AIWifeApp {
         this.audioChunkQueue = [];
         this.isPlayingAudio = false;
         this.audioPlaybackIndex = 0;
+        this.audioTurnId = null;
+        this.expectedAudioChunks = null;
+        this.audioStreams = new Map(); // chunk_index -> ストリーミング受信中の音声
         this.receivedChunks = new Map(); // chunk_index -> chunk_data
         this.fullResponseText = '';
         
@@ -671,6 +674,24 @@ class AIWifeApp {
         }
     }
     
+    /**
+     * 音声の対応コーデックと帯域クラスを取得（希望順）
+     */
+    getAudioCapabilities() {
+        const connection = navigator.connection || {};
+        const lowBandwidth = connection.saveData || ['slow-2g', '2g', '3g'].includes(connection.effectiveType);
+        const probe = new Audio();
+        const codecs = [];
+        
+        // 低帯域ではOpus（低ビットレート）を優先
+        if (lowBandwidth && probe.canPlayType('audio/ogg; codecs=opus')) {
+            codecs.push('opus');
+        }
+        codecs.push('mp3');
+        
+        return { codecs: codecs, bandwidth: lowBandwidth ? 'low' : 'normal' };
+    }
+    
     /**
      * WebSocket接続の初期化
      */
@@ -684,11 +705,16 @@ class AIWifeApp {
             timeout: 20000 // 接続タイムアウト（ミリ秒）
         };
         
+        // 対応コーデックと帯域クラスを申告（サーバー側で音声の出力形式を決定）
+        const audioCapabilities = this.getAudioCapabilities();
+        connectionOptions.query = {
+            audio_codecs: audioCapabilities.codecs.join(','),
+            audio_bandwidth: audioCapabilities.bandwidth
+        };
+        
         // 認証済みの場合はトークンをクエリパラメータに追加
         if (this.isAuthenticated && this.authService.tokens.accessToken) {
-            connectionOptions.query = {
-                token: this.authService.tokens.accessToken
-            };
+            connectionOptions.query.token = this.authService.tokens.accessToken;
         }
         
         console.log('[Debug] Initializing Socket.IO connection to:', BACKEND_URL);
@@ -723,6 +749,9 @@ class AIWifeApp {
             if (data.authenticated) {
                 console.log('[Debug] Authenticated connection established');
             }
+            if (data.audio_format) {
+                console.log('[Debug] Negotiated audio format:', data.audio_format);
+            }
         });
         
         this.socket.on('message_response', (data) => {
@@ -735,11 +764,25 @@ class AIWifeApp {
             this.handleMessageChunk(data);
         });
         
+        this.socket.on('message_audio', (data) => {
+            this.handleMessageAudio(data);
+        });
+        
+        // ストリーミング音声フレーム（バイナリ）
+        this.socket.on('audio_chunk', (data) => {
+            this.handleAudioFrame(data);
+        });
+        
         this.socket.on('streaming_complete', (data) => {
             console.log('[Debug] WebSocket received streaming_complete event');
             this.handleStreamingComplete(data);
         });
         
+        // ターンの段階別の所要時間（STT → LLM → 分割 → 音声合成 → 送信）
+        this.socket.on('turn_trace', (data) => {
+            console.log(`[Trace] turn ${data.turn_id}: ${data.elapsed_ms}ms`, data.stages, data.marks);
+        });
+        
         this.socket.on('audio_response', (data) => {
             this.handleAudioResponse(data);
         });
@@ -1111,21 +1154,36 @@ class AIWifeApp {
             personality: this.settings.personality
         };
         
-        // 認証済みの場合はuser_idを追加
+        // 認証済みの場合はuser_idと選択中のキャラクターを追加
         if (this.isAuthenticated && this.currentUser) {
             messageData.user_id = this.currentUser.id;
+            const characterId = this.getSelectedCharacterId();
+            if (characterId !== null) {
+                messageData.character_id = characterId;
+            }
         }
         
         this.socket.emit('send_message', messageData);
     }
     
+    /**
+     * 選択中のキャラクターID（DBに保存されたキャラクターのみ）
+     */
+    getSelectedCharacterId() {
+        if (this.currentCharacter && Number.isInteger(this.currentCharacter.id)) {
+            return this.currentCharacter.id;
+        }
+        return null;
+    }
+    
     /**
      * ストリーミングセッションを初期化
      */
-    initializeStreamingSession(message) {
+    initializeStreamingSession(message, turnId = null) {
         this.currentStreamingSession = {
             startTime: Date.now(),
             message: message,
+            turnId: turnId,
             expectedChunks: 0
         };
         
@@ -1133,6 +1191,9 @@ class AIWifeApp {
         this.audioChunkQueue = [];
         this.isPlayingAudio = false;
         this.audioPlaybackIndex = 0;
+        this.audioTurnId = turnId;
+        this.expectedAudioChunks = null;
+        this.audioStreams.clear();
         this.receivedChunks.clear();
         this.fullResponseText = '';
         
@@ -1193,6 +1254,32 @@ class AIWifeApp {
         this.typeText(text);
     }
     
+    /**
+     * ストリーミング中の吹き出しテキストを即時更新
+     */
+    updateARSpeechBubbleText(text) {
+        if (!this.speechBubble) return;
+        
+        const headPosition = this.getCharacterHeadPosition();
+        if (headPosition) {
+            const screenPos = this.worldToScreen(headPosition);
+            this.speechBubble.style.left = `${screenPos.x}px`;
+            this.speechBubble.style.top = `${screenPos.y - 60}px`;
+            this.speechBubble.style.transform = 'translateX(-50%)';
+        }
+        
+        const textElement = this.speechBubble.querySelector('.ar-speech-bubble-text');
+        textElement.textContent = text;
+        this.speechBubble.classList.add('show');
+        this.bubbleActive = true;
+        
+        // 自動非表示タイマーを延長
+        clearTimeout(this.bubbleHideTimer);
+        this.bubbleHideTimer = setTimeout(() => {
+            this.hideARSpeechBubble();
+        }, 8000);
+    }
+    
     /**
      * タイピング効果でテキストを表示（高速化版）
      */
@@ -2164,71 +2251,172 @@ class AIWifeApp {
      * ストリーミングチャンクメッセージ処理
      */
     handleMessageChunk(data) {
-        console.log('[Debug] Received message chunk:', data.chunk_index, data.text);
+        console.log('[Debug] Received message chunk:', data.turn_id, data.seq, data.text);
         console.log('[Debug] Audio data present:', !!data.audio_data);
-        console.log('[Debug] Audio data size:', data.audio_data ? data.audio_data.length : 0);
-        
-        // チャンクをマップに保存
-        this.receivedChunks.set(data.chunk_index, data);
         
-        // 音声データがある場合はキューに追加
-        if (data.audio_data) {
-            console.log('[Debug] Adding audio chunk to queue:', data.chunk_index);
-            this.audioChunkQueue.push({
-                index: data.chunk_index,
-                audio: data.audio_data,
-                text: data.text,
-                emotion: data.emotion
-            });
-            
-            console.log('[Debug] Audio queue length:', this.audioChunkQueue.length);
-            console.log('[Debug] Is playing audio:', this.isPlayingAudio);
-            
-            // 順次再生を開始（初回のみ）
-            if (!this.isPlayingAudio) {
-                console.log('[Debug] Starting audio chunk playback');
-                this.startAudioChunkPlayback();
-            }
-        } else {
-            console.log('[Debug] No audio data in chunk:', data.chunk_index);
+        // 別ターンのチャンクが届いた場合はセッションを切り替える
+        if (!this.currentStreamingSession || this.currentStreamingSession.turnId !== data.turn_id) {
+            this.initializeStreamingSession(null, data.turn_id);
         }
         
+        // チャンクをマップに保存
+        this.receivedChunks.set(data.seq, data);
+        
         // テキストを蓄積
         this.fullResponseText += data.text;
         
-        // AR吹き出しを更新（最新チャンクのテキストで）
-        this.showARSpeechBubble(data.text);
+        // AR吹き出しを更新（蓄積したテキストをそのまま表示）
+        this.updateARSpeechBubbleText(this.fullResponseText);
         
         // 感情アニメーション
         if (data.emotion) {
             this.playEmotionAnimation(data.emotion, data.personality);
         }
         
-        // 初回チャンクでトークアニメーション開始
-        if (data.chunk_index === 1) {
+        // 初回チャンクで応答待ちを解除し、トークアニメーション開始
+        if (data.seq === 1) {
+            this.hideLoading();
             this.playAnimation('talking', { loop: true });
         }
     }
     
+    /**
+     * 文単位の音声チャンク処理（サーバー側で chunk_index 順に送信される）
+     */
+    handleMessageAudio(data) {
+        console.log('[Debug] Received message audio:', data.turn_id, data.chunk_index, !!data.audio_data);
+        
+        // 完了済みターンの残りチャンクは受け入れ、別ターンならセッションを切り替える
+        if (this.audioTurnId !== data.turn_id) {
+            this.initializeStreamingSession(null, data.turn_id);
+        }
+        
+        // ストリーミング済みのチャンクは受信完了を通知するだけ（キューには追加済み）
+        const stream = this.audioStreams.get(data.chunk_index);
+        if (data.streamed && stream) {
+            stream.done = true;
+            if (stream.pump) stream.pump();
+            return;
+        }
+        
+        // 音声が無いチャンクも順序を進めるためにキューへ追加
+        this.audioChunkQueue.push({
+            index: data.chunk_index,
+            audio: this.resolveAudioPayload(data),
+            text: data.text,
+            emotion: data.emotion
+        });
+        
+        // 順次再生を開始（初回のみ）
+        if (!this.isPlayingAudio) {
+            console.log('[Debug] Starting audio chunk playback');
+            this.startAudioChunkPlayback();
+        }
+    }
+    
+    /**
+     * 音声の参照先を取得（バイナリ添付の音声はメモリ上のBlob URLにする）
+     */
+    resolveAudioPayload(data) {
+        if (data.audio) {
+            return URL.createObjectURL(new Blob([data.audio], { type: data.mime_type || 'audio/mpeg' }));
+        }
+        return data.audio_data;
+    }
+    
+    /**
+     * ストリーミング音声フレーム処理（サーバー側でチャンク順に送信される）
+     */
+    handleAudioFrame(data) {
+        if (this.audioTurnId !== data.turn_id) {
+            this.initializeStreamingSession(null, data.turn_id);
+        }
+        
+        let stream = this.audioStreams.get(data.chunk_index);
+        if (!stream) {
+            // 最初のフレームで再生キューに追加し、受信しながら再生する
+            stream = { parts: [], appended: 0, done: false, pump: null, mimeType: data.mime_type || 'audio/mpeg' };
+            this.audioStreams.set(data.chunk_index, stream);
+            this.audioChunkQueue.push({
+                index: data.chunk_index,
+                audio: null,
+                stream: stream
+            });
+            if (!this.isPlayingAudio) {
+                this.startAudioChunkPlayback();
+            }
+        }
+        
+        stream.parts.push(new Uint8Array(data.audio));
+        if (stream.pump) stream.pump();
+    }
+    
+    /**
+     * ストリーミング受信中の音声の再生URLを作成
+     * MediaSource が使える場合は受信しながら再生し、使えない場合は受信完了を待つ
+     */
+    async createStreamAudioUrl(stream) {
+        if (window.MediaSource && MediaSource.isTypeSupported(stream.mimeType)) {
+            const mediaSource = new MediaSource();
+            mediaSource.addEventListener('sourceopen', () => {
+                const sourceBuffer = mediaSource.addSourceBuffer(stream.mimeType);
+                stream.pump = () => {
+                    if (sourceBuffer.updating || mediaSource.readyState !== 'open') return;
+                    if (stream.appended < stream.parts.length) {
+                        sourceBuffer.appendBuffer(stream.parts[stream.appended++]);
+                    } else if (stream.done) {
+                        mediaSource.endOfStream();
+                    }
+                };
+                sourceBuffer.addEventListener('updateend', stream.pump);
+                stream.pump();
+            }, { once: true });
+            return URL.createObjectURL(mediaSource);
+        }
+        
+        while (!stream.done) {
+            await new Promise(resolve => setTimeout(resolve, 50));
+        }
+        return URL.createObjectURL(new Blob(stream.parts, { type: stream.mimeType }));
+    }
+    
     /**
      * ストリーミング完了処理
      */
     handleStreamingComplete(data) {
         console.log('[Debug] Streaming complete:', data);
         console.log('[Debug] Total chunks received:', this.receivedChunks.size);
-        console.log('[Debug] Audio queue length at completion:', this.audioChunkQueue.length);
         this.hideLoading();
         
         // 完全なレスポンステキストを会話履歴に追加
         this.addMessageToConversation('assistant', data.full_text);
         
+        // キャラクター別の音声設定を適用
+        this.applyCharacterSettings(data.personality, data.is_tech_excited);
+        
         // 最終的なAR吹き出し表示
-        this.showARSpeechBubble(data.full_text);
+        this.updateARSpeechBubbleText(data.full_text);
+        
+        // 感情に基づくアニメーション
+        if (data.emotion) {
+            this.playEmotionAnimation(data.emotion, data.personality, data.is_tech_excited);
+        }
+        
+        // 文単位の音声チャンク総数（再生ループの終了判定に使用）
+        this.expectedAudioChunks = data.total_audio_chunks || 0;
         
         // ストリーミングセッションをリセット
         this.currentStreamingSession = null;
         this.fullResponseText = '';
         
+        // 応答全体の音声がある場合は再生
+        const fullAudio = this.resolveAudioPayload(data);
+        if (fullAudio) {
+            this.playAudioData(fullAudio);
+        } else if (!this.isPlayingAudio && this.expectedAudioChunks === 0) {
+            this.playAnimation('idle', { loop: true });
+        }
+        
         console.log('[Debug] Streaming session completed and reset');
     }
     
@@ -2240,16 +2428,23 @@ class AIWifeApp {
         
         this.isPlayingAudio = true;
         this.audioPlaybackIndex = 1; // 1から開始
+        const playbackTurnId = this.audioTurnId;
         
         console.log('[Debug] Starting audio chunk playback');
         
-        while (this.audioChunkQueue.length > 0 || this.shouldWaitForMoreChunks()) {
+        while (this.audioTurnId === playbackTurnId && (this.audioChunkQueue.length > 0 || this.shouldWaitForMoreChunks())) {
             // 次のチャンクが来るまで待機
             const chunk = this.getNextAudioChunk();
             
             if (chunk) {
                 console.log(`[Debug] Playing audio chunk ${chunk.index}`);
                 
+                if (!chunk.audio && !chunk.stream) {
+                    // 音声合成に失敗したチャンクはスキップ
+                    this.audioPlaybackIndex++;
+                    continue;
+                }
+                
                 try {
                     await this.playAudioChunk(chunk);
                     this.audioPlaybackIndex++;
@@ -2263,6 +2458,11 @@ class AIWifeApp {
             }
         }
         
+        // 別ターンに切り替わった場合は新しい再生ループに任せる
+        if (this.audioTurnId !== playbackTurnId) {
+            return;
+        }
+        
         // 全ての音声再生完了
         this.isPlayingAudio = false;
         console.log('[Debug] Audio chunk playback completed');
@@ -2289,8 +2489,10 @@ class AIWifeApp {
      * より多くのチャンクを待つべきかを判定
      */
     shouldWaitForMoreChunks() {
-        // ストリーミングが完了していない、または待機中のチャンクがある場合
-        return this.currentStreamingSession !== null || this.audioChunkQueue.length > 0;
+        // ストリーミングが完了していない、待機中のチャンクがある、または未着のチャンクがある場合
+        return this.currentStreamingSession !== null
+            || this.audioChunkQueue.length > 0
+            || (this.expectedAudioChunks !== null && this.audioPlaybackIndex <= this.expectedAudioChunks);
     }
     
     /**
@@ -2298,15 +2500,17 @@ class AIWifeApp {
      */
     async playAudioChunk(chunk) {
         console.log(`[Debug] Attempting to play audio chunk ${chunk.index}`);
-        console.log(`[Debug] Audio data format:`, chunk.audio.substring(0, 50));
+        
+        // ストリーミング受信中のチャンクは受信しながら再生
+        const streamUrl = chunk.stream ? await this.createStreamAudioUrl(chunk.stream) : null;
         
         return new Promise((resolve, reject) => {
             try {
                 // 音声URLの構築（ElevenLabs対応）
-                let audioUrl = chunk.audio;
+                let audioUrl = streamUrl || chunk.audio;
                 
                 // 相対パスの場合、BACKEND_URLを付与
-                if (chunk.audio.startsWith('/audio/')) {
+                if (!streamUrl && chunk.audio.startsWith('/audio/')) {
                     audioUrl = `${BACKEND_URL}${chunk.audio}`;
                     console.log(`[Debug] Chunk ${chunk.index} URL constructed:`, audioUrl);
                 }
@@ -2331,6 +2535,7 @@ class AIWifeApp {
                 
                 audio.onended = () => {
                     console.log(`[Debug] Audio chunk ${chunk.index} ended`);
+                    if (audioUrl.startsWith('blob:')) URL.revokeObjectURL(audioUrl);
                     resolve();
                 };
                 
@@ -2507,16 +2712,36 @@ class AIWifeApp {
             this.mediaRecorder = new MediaRecorder(stream);
             this.audioChunks = [];
             
+            // 録音中にチャンクをバイナリで逐次アップロード（停止時の送信量を減らす）
+            const uploadId = `${Date.now().toString(36)}-${Math.random().toString(36).slice(2, 10)}`;
+            const pendingUploads = [];
+            let nextSeq = 0;
+            
             this.mediaRecorder.ondataavailable = (event) => {
+                if (!event.data || event.data.size === 0) return;
                 this.audioChunks.push(event.data);
+                const seq = nextSeq++;
+                pendingUploads.push(event.data.arrayBuffer().then((buffer) => {
+                    this.socket.emit('audio_upload_chunk', {
+                        upload_id: uploadId,
+                        seq: seq,
+                        data: buffer
+                    });
+                }));
             };
             
-            this.mediaRecorder.onstop = () => {
-                const audioBlob = new Blob(this.audioChunks, { type: 'audio/wav' });
-                this.sendAudioMessage(audioBlob);
+            this.mediaRecorder.onstop = async () => {
+                try {
+                    await Promise.all(pendingUploads);
+                    this.sendAudioUpload(uploadId, nextSeq);
+                } catch (error) {
+                    console.warn('Chunked upload failed, sending whole recording:', error);
+                    const audioBlob = new Blob(this.audioChunks, { type: 'audio/wav' });
+                    this.sendAudioMessage(audioBlob);
+                }
             };
             
-            this.mediaRecorder.start();
+            this.mediaRecorder.start(250);
             this.isRecording = true;
             
             this.elements.voiceButton.classList.add('recording');
@@ -2549,13 +2774,15 @@ class AIWifeApp {
      */
     async sendAudioMessage(audioBlob) {
         try {
+            // Socket.IOのバイナリ添付として送信（16進数文字列化しない）
             const arrayBuffer = await audioBlob.arrayBuffer();
-            const audioData = Array.from(new Uint8Array(arrayBuffer));
             
             this.socket.emit('send_audio', {
                 session_id: this.sessionId,
-                audio_data: audioData.map(b => b.toString(16).padStart(2, '0')).join(''),
-                voice_id: this.settings.voiceId
+                audio_data: arrayBuffer,
+                personality: this.settings.personality,
+                voice_id: this.settings.voiceId,
+                character_id: this.getSelectedCharacterId()
             });
             
         } catch (error) {
@@ -2565,6 +2792,20 @@ class AIWifeApp {
         }
     }
     
+    /**
+     * 録音中にアップロード済みのチャンクから音声メッセージを確定
+     */
+    sendAudioUpload(uploadId, totalChunks) {
+        this.socket.emit('send_audio', {
+            session_id: this.sessionId,
+            upload_id: uploadId,
+            total_chunks: totalChunks,
+            personality: this.settings.personality,
+            voice_id: this.settings.voiceId,
+            character_id: this.getSelectedCharacterId()
+        });
+    }
+    
     /**
      * 音声再生
      */
@@ -7,11 +7,8 @@ import os
 import sys
 import json
 import sqlite3
-import asyncio
-import aiohttp
-from aiohttp import TCPConnector
 import google.generativeai as genai
-from flask import Flask, render_template, request, jsonify, send_from_directory
+from flask import Flask, render_template, request, jsonify, send_from_directory, Response, stream_with_context
 from flask_socketio import SocketIO, emit
 from flask_cors import CORS
 from dotenv import load_dotenv
@@ -21,9 +18,12 @@ from datetime import datetime
 import logging
 import time
 import threading
+import queue
 import concurrent.futures
-from typing import Dict, List, Optional
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
 import tempfile
+import atexit
 import base64
 import re
 
@@ -32,10 +32,20 @@ sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 # Voice Service import
 from services.voice_service import get_voice_service
+from services.stt_service import get_stt_service
+from services.gemini_client import create_gemini_client
+from services.character_models import create_character_model_registry
+from services.keyword_matcher import analyze_emotion, is_technical_topic, EmotionTracker
+from services import metrics
+from services.tracing import Tracer, TurnTrace, RingBufferExporter
 
 # 認証関連のインポート
 from models.user import User
-from auth.auth_manager import AuthManager, token_required, optional_token
+from models.database import get_database
+from models.conversation_journal import ConversationJournal
+from models.password_hasher import PasswordHasherBusyError, get_password_hasher
+from models.conversation_memory import ConversationMemory
+from auth.auth_manager import AuthManager, RefreshTokenSweeper, token_required, optional_token
 from auth.oauth_manager import OAuthManager
 from werkzeug.middleware.proxy_fix import ProxyFix
 
@@ -64,7 +74,8 @@ if not gemini_api_key:
 else:
     print(f"[DEBUG] Gemini API key configured: {gemini_api_key[:20]}...")
 
-genai.configure(api_key=gemini_api_key)
+# RESTトランスポートを使用（gRPCはgeventと協調せず、ストリーミング中に他のグリーンレットを止めてしまう）
+genai.configure(api_key=gemini_api_key, transport=os.getenv('GEMINI_TRANSPORT', 'rest'))
 
 # モデル設定とバリデーション
 primary_model_name = os.getenv('GEMINI_PRIMARY_MODEL', 'gemini-2.5-flash')
@@ -73,6 +84,7 @@ fallback_model_name = os.getenv('GEMINI_FALLBACK_MODEL', 'gemini-2.5-flash-lite'
 print(f"[DEBUG] Primary model: {primary_model_name}")
 print(f"[DEBUG] Fallback model: {fallback_model_name}")
 
+primary_model = fallback_model = None
 try:
     primary_model = genai.GenerativeModel(primary_model_name)
     fallback_model = genai.GenerativeModel(fallback_model_name)
@@ -80,8 +92,35 @@ try:
 except Exception as e:
     print(f"[ERROR] Failed to initialize Gemini models: {e}")
 
-# API Configuration
-ASSEMBLYAI_API_KEY = os.getenv('ASSEMBLYAI_API_KEY')
+# ヘッジリクエストとサーキットブレーカー付きのGeminiクライアント
+gemini_client = create_gemini_client(primary_model, fallback_model)
+
+# キャラクター別のモデルハンドル（ペルソナをシステム指示として保持し、長いプロンプトはコンテキストキャッシュ）
+character_models = create_character_model_registry(primary_model_name, fallback_model_name)
+
+# API Configuration (AssemblyAIのキーは services.stt_service が参照)
+
+# 音声アップロードの上限サイズ（バイト）
+MAX_AUDIO_UPLOAD_BYTES = int(os.getenv('MAX_AUDIO_UPLOAD_BYTES', str(10 * 1024 * 1024)))
+
+# TTSパイプラインモード
+# sentence: 生成中に完成した文から順次音声合成 / full: 生成完了後に全文をまとめて音声合成
+TTS_PIPELINE_MODE = os.getenv('TTS_PIPELINE_MODE', 'sentence')
+
+# 文単位の音声の届け方
+# url: 合成後にファイルURLを送信 / stream: ElevenLabsのストリーミング出力を audio_chunk イベントで逐次転送
+# inline: 小さい音声はバイナリ添付で直接送信（大きい音声はURL）
+TTS_AUDIO_DELIVERY = os.getenv('TTS_AUDIO_DELIVERY', 'url')
+
+# メトリクス（/api/metrics で Prometheus 形式で公開）
+RESPONSE_STAGE_SECONDS = metrics.histogram(
+    'response_stage_seconds', 'Elapsed time from the start of a response to each stage', ['stage']
+)
+TTS_QUEUE_WAIT_SECONDS = metrics.histogram('tts_queue_wait_seconds', 'Time sentence TTS requests wait in the queue')
+TTS_CHUNK_SECONDS = metrics.histogram('tts_chunk_seconds', 'Sentence TTS time in the queue worker', ['delivery'])
+TTS_QUEUE_DEPTH = metrics.gauge('tts_queue_depth', 'Sentence TTS requests waiting in the queue')
+SOCKET_CONNECTIONS = metrics.gauge('socket_connections', 'Open Socket.IO connections')
+SOCKET_EMITS = metrics.counter('socket_emits_total', 'Socket.IO events emitted to sessions', ['event', 'result'])
 
 # Voice Service initialization (VITS-based TTS)
 # Force reinitialize to ensure we use the latest configuration
@@ -99,7 +138,16 @@ class MemoryManager:
     def __init__(self, db_path: str):
         # パスを絶対パスに変換
         self.db_path = os.path.abspath(db_path)
+        # Userモデルと共有する接続プール（WALモード）
+        self.db = get_database(self.db_path)
         self.init_database()
+        # 会話履歴のライトビハインド書き込み（応答経路からディスクコミットを除く）
+        self.journal = ConversationJournal(
+            self.db,
+            flush_interval_ms=int(os.getenv('CONVERSATION_FLUSH_INTERVAL_MS', '200')),
+            batch_size=int(os.getenv('CONVERSATION_BATCH_SIZE', '100')),
+            max_queue_size=int(os.getenv('CONVERSATION_QUEUE_SIZE', '10000'))
+        )
     
     def init_database(self):
         """データベースの初期化"""
@@ -109,32 +157,38 @@ class MemoryManager:
             os.makedirs(db_dir, exist_ok=True)
         
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            with self.db.connection() as conn:
+                cursor = conn.cursor()
             
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS conversations (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    session_id TEXT NOT NULL,
-                    role TEXT NOT NULL,
-                    content TEXT NOT NULL,
-                    emotion TEXT,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS conversations (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        session_id TEXT NOT NULL,
+                        role TEXT NOT NULL,
+                        content TEXT NOT NULL,
+                        emotion TEXT,
+                        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
             
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS user_info (
-                    session_id TEXT PRIMARY KEY,
-                    name TEXT,
-                    preferences TEXT,
-                    context_data TEXT,
-                    last_interaction DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
+                # セッション内の履歴をidで一意に並べるためのインデックス（キーセットページング用）
+                # idはrowidの別名のため、取得する列は行の参照で読む（カバリングインデックスではない）
+                cursor.execute('''
+                    CREATE INDEX IF NOT EXISTS idx_conversations_session_id
+                    ON conversations (session_id, id)
+                ''')
+            
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS user_info (
+                        session_id TEXT PRIMARY KEY,
+                        name TEXT,
+                        preferences TEXT,
+                        context_data TEXT,
+                        last_interaction DATETIME DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
             
-            conn.commit()
-            conn.close()
+                conn.commit()
             logger.info(f"Database initialized successfully at: {self.db_path}")
             
         except sqlite3.Error as e:
@@ -142,39 +196,45 @@ class MemoryManager:
             # フォールバック：一時的なインメモリデータベース
             logger.warning("Using in-memory database as fallback")
             self.db_path = ':memory:'
+            self.db = get_database(self.db_path)
     
     def save_message(self, session_id: str, role: str, content: str, emotion: str = None):
         """会話履歴を保存"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            with self.db.connection() as conn:
+                cursor = conn.cursor()
             
-            cursor.execute('''
-                INSERT INTO conversations (session_id, role, content, emotion)
-                VALUES (?, ?, ?, ?)
-            ''', (session_id, role, content, emotion))
+                cursor.execute('''
+                    INSERT INTO conversations (session_id, role, content, emotion)
+                    VALUES (?, ?, ?, ?)
+                ''', (session_id, role, content, emotion))
             
-            conn.commit()
-            conn.close()
+                conn.commit()
         except sqlite3.Error as e:
             logger.error(f"Failed to save message: {e}")
     
+    def save_turn(self, session_id: str, user_input: str, user_emotion: str, response: str, response_emotion: str):
+        """1ターン分（ユーザー発話と応答）をジャーナル経由で非同期に保存"""
+        self.journal.append_many([
+            (session_id, 'user', user_input, user_emotion),
+            (session_id, 'assistant', response, response_emotion)
+        ])
+    
     def get_conversation_history(self, session_id: str, limit: int = 20) -> List[Dict]:
         """会話履歴を取得"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            with self.db.connection() as conn:
+                cursor = conn.cursor()
             
-            cursor.execute('''
-                SELECT role, content, emotion, timestamp
-                FROM conversations
-                WHERE session_id = ?
-                ORDER BY timestamp DESC
-                LIMIT ?
-            ''', (session_id, limit))
+                cursor.execute('''
+                    SELECT role, content, emotion, timestamp
+                    FROM conversations
+                    WHERE session_id = ?
+                    ORDER BY id DESC
+                    LIMIT ?
+                ''', (session_id, limit))
             
-            results = cursor.fetchall()
-            conn.close()
+                results = cursor.fetchall()
             
             return [
                 {
@@ -189,36 +249,99 @@ class MemoryManager:
             logger.error(f"Failed to get conversation history: {e}")
             return []
     
+    def get_conversation_page(self, session_id: str, before_id: Optional[int] = None, limit: int = 50) -> Dict:
+        """会話履歴をキーセット方式で新しい順に1ページ取得（テーブルサイズによらずO(ページ)）"""
+        try:
+            with self.db.connection() as conn:
+                cursor = conn.cursor()
+                
+                # (session_id, id) インデックスを末尾からシークする
+                if before_id is None:
+                    cursor.execute('''
+                        SELECT id, role, content, emotion, timestamp
+                        FROM conversations
+                        WHERE session_id = ?
+                        ORDER BY id DESC
+                        LIMIT ?
+                    ''', (session_id, limit + 1))
+                else:
+                    cursor.execute('''
+                        SELECT id, role, content, emotion, timestamp
+                        FROM conversations
+                        WHERE session_id = ? AND id < ?
+                        ORDER BY id DESC
+                        LIMIT ?
+                    ''', (session_id, before_id, limit + 1))
+                
+                results = cursor.fetchall()
+            
+            # 1件多く取得して次ページの有無を判定
+            has_more = len(results) > limit
+            results = results[:limit]
+            
+            return {
+                'messages': [
+                    {
+                        'id': row[0],
+                        'role': row[1],
+                        'content': row[2],
+                        'emotion': row[3],
+                        'timestamp': row[4]
+                    }
+                    for row in reversed(results)
+                ],
+                'next_cursor': results[-1][0] if has_more else None
+            }
+        except sqlite3.Error as e:
+            logger.error(f"Failed to get conversation page: {e}")
+            return {'messages': [], 'next_cursor': None}
+    
     def update_user_info(self, session_id: str, name: str = None, preferences: str = None, context_data: str = None):
         """ユーザー情報を更新"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            with self.db.connection() as conn:
+                cursor = conn.cursor()
             
-            cursor.execute('''
-                INSERT OR REPLACE INTO user_info (session_id, name, preferences, context_data, last_interaction)
-                VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
-            ''', (session_id, name, preferences, context_data))
+                cursor.execute('''
+                    INSERT OR REPLACE INTO user_info (session_id, name, preferences, context_data, last_interaction)
+                    VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+                ''', (session_id, name, preferences, context_data))
             
-            conn.commit()
-            conn.close()
+                conn.commit()
         except sqlite3.Error as e:
             logger.error(f"Failed to update user info: {e}")
     
+    def save_context_data(self, session_id: str, context_data: str):
+        """会話の要約などのコンテキストだけを保存（名前・好みは上書きしない）"""
+        try:
+            with self.db.connection() as conn:
+                cursor = conn.cursor()
+            
+                cursor.execute('''
+                    INSERT INTO user_info (session_id, context_data, last_interaction)
+                    VALUES (?, ?, CURRENT_TIMESTAMP)
+                    ON CONFLICT(session_id) DO UPDATE SET
+                        context_data = excluded.context_data,
+                        last_interaction = CURRENT_TIMESTAMP
+                ''', (session_id, context_data))
+            
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Failed to save context data: {e}")
+    
     def get_user_info(self, session_id: str) -> Dict:
         """ユーザー情報を取得"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            with self.db.connection() as conn:
+                cursor = conn.cursor()
             
-            cursor.execute('''
-                SELECT name, preferences, context_data, last_interaction
-                FROM user_info
-                WHERE session_id = ?
-            ''', (session_id,))
+                cursor.execute('''
+                    SELECT name, preferences, context_data, last_interaction
+                    FROM user_info
+                    WHERE session_id = ?
+                ''', (session_id,))
             
-            result = cursor.fetchone()
-            conn.close()
+                result = cursor.fetchone()
             
             if result:
                 return {
@@ -277,37 +400,123 @@ class TextSplitter:
         return [chunk for chunk in chunks if chunk.strip()]
     
     def split_by_sentences(self, text: str) -> List[str]:
-        """文単位で分割"""
+        """文単位で分割（区切り位置でスライスするため線形時間）"""
         sentences = []
-        current_sentence = ""
+        start = 0
         
-        for char in text:
-            current_sentence += char
+        for i, char in enumerate(text):
             if char in self.sentence_endings:
-                sentences.append(current_sentence)
-                current_sentence = ""
+                sentences.append(text[start:i + 1])
+                start = i + 1
         
-        if current_sentence:
-            sentences.append(current_sentence)
+        if start < len(text):
+            sentences.append(text[start:])
         
         return sentences
     
     def split_by_breath_markers(self, text: str) -> List[str]:
-        """句読点で分割"""
+        """句読点で分割（区切り位置でスライスするため線形時間）"""
         chunks = []
-        current_chunk = ""
+        start = 0
         
-        for char in text:
-            current_chunk += char
-            if char in self.breath_markers or len(current_chunk) >= self.chunk_size:
-                if current_chunk.strip():
-                    chunks.append(current_chunk)
-                current_chunk = ""
+        for i, char in enumerate(text):
+            if char in self.breath_markers or i + 1 - start >= self.chunk_size:
+                if text[start:i + 1].strip():
+                    chunks.append(text[start:i + 1])
+                start = i + 1
         
-        if current_chunk:
-            chunks.append(current_chunk)
+        if start < len(text):
+            chunks.append(text[start:])
         
         return chunks
+    
+    def stream(self) -> 'StreamingTextSplitter':
+        """LLMのストリーミング出力用の逐次分割器を作成"""
+        return StreamingTextSplitter(self.sentence_endings, self.breath_markers, self.chunk_size)
+
+class StreamingTextSplitter:
+    """
+    ストリーミング出力を文単位で逐次分割する状態付き分割器
+    
+    ネットワークのチャンク境界をまたぐ文をバッファし、文末で閉じた文をすぐに返す。
+    長い文は一定の長さを超えた句読点で区切り、句読点が無い場合も上限で強制的に区切る。
+    未処理の文字だけを走査するため、ストリーム全体で線形時間。
+    """
+    
+    # 文末記号に続く場合は同じ文に含める閉じ括弧など
+    CLOSERS = '」』）)】"\''
+    
+    def __init__(self, sentence_endings: List[str], breath_markers: List[str], chunk_size: int = 50):
+        self.sentence_endings = set(sentence_endings)
+        self.breath_chars = {m for m in breath_markers if len(m) == 1}
+        self.breath_sequences = [m for m in breath_markers if len(m) > 1]
+        # 句読点で区切る最小の長さと、句読点が無い場合の強制分割の長さ
+        self.min_breath_chars = max(chunk_size // 2, 1)
+        self.max_chunk_chars = chunk_size * 2
+        
+        self._buffer = ""
+        self._scanned = 0
+        self._sentence_closed = False
+    
+    def feed(self, text: str) -> List[str]:
+        """チャンクを追加し、確定した文（または区切り）を返す"""
+        if not text:
+            return []
+        
+        # バッファは未確定の1文分（上限 max_chunk_chars 程度）だけなので連結は定数コスト
+        self._buffer += text
+        segments = []
+        start = 0
+        i = self._scanned
+        buffer = self._buffer
+        
+        while i < len(buffer):
+            char = buffer[i]
+            
+            if self._sentence_closed:
+                # 文末の後に続く文末記号・閉じ括弧は同じ文に含める
+                if char in self.sentence_endings or char in self.CLOSERS:
+                    i += 1
+                    continue
+                self._emit(segments, buffer[start:i])
+                start = i
+                self._sentence_closed = False
+                continue
+            
+            length = i + 1 - start
+            if char in self.sentence_endings:
+                self._sentence_closed = True
+            elif length >= self.min_breath_chars and self._is_breath_marker(buffer, i):
+                self._emit(segments, buffer[start:i + 1])
+                start = i + 1
+            elif length >= self.max_chunk_chars:
+                self._emit(segments, buffer[start:i + 1])
+                start = i + 1
+            i += 1
+        
+        self._buffer = buffer[start:]
+        self._scanned = len(self._buffer)
+        return segments
+    
+    def flush(self) -> List[str]:
+        """ストリーム終了時に残りを返す"""
+        segments = []
+        self._emit(segments, self._buffer)
+        self._buffer = ""
+        self._scanned = 0
+        self._sentence_closed = False
+        return segments
+    
+    def _is_breath_marker(self, buffer: str, i: int) -> bool:
+        if buffer[i] in self.breath_chars:
+            return True
+        return any(buffer.endswith(marker, 0, i + 1) for marker in self.breath_sequences)
+    
+    @staticmethod
+    def _emit(segments: List[str], segment: str):
+        segment = segment.strip()
+        if segment:
+            segments.append(segment)
 
 class AIConversationManager:
     """AI会話管理クラス"""
@@ -315,6 +524,14 @@ class AIConversationManager:
     def __init__(self, memory_manager: MemoryManager):
         self.memory_manager = memory_manager
         self.text_splitter = TextSplitter()  # テキスト分割器を追加
+        # 直近の会話（予算内の原文）と古い会話の要約によるプロンプトサイズ一定の記憶
+        self.conversation_memory = ConversationMemory(
+            memory_manager,
+            summarizer=self.summarize_conversation,
+            recent_token_budget=int(os.getenv('MEMORY_RECENT_TOKEN_BUDGET', '1500')),
+            summary_token_budget=int(os.getenv('MEMORY_SUMMARY_TOKEN_BUDGET', '400')),
+            max_sessions=int(os.getenv('MEMORY_MAX_SESSIONS', '1000'))
+        )
         # Shiroのキャラクタープロンプト（デフォルト）
         self.character_prompts = {
             'shiro': '''<キャラクター設定>
@@ -338,154 +555,210 @@ class AIConversationManager:
 上記のキャラクター設定に応じて、シロとしてマスターに反応してください。''',
         }
 
-    def get_system_prompt(self, personality: str) -> str:
-        """キャラクターに応じたシステムプロンプトを取得"""
-        return self.character_prompts.get(personality, self.character_prompts['yui_natural'])
+    def get_system_prompt(self, personality: str, character_prompt: Optional[str] = None) -> str:
+        """キャラクターに応じたシステムプロンプトを取得（ユーザー作成キャラクターのプロンプトを優先）"""
+        if character_prompt and character_prompt.strip():
+            return character_prompt
+        return self.character_prompts.get(personality, self.character_prompts['shiro'])
 
     def is_technical_topic(self, text: str) -> bool:
-        """テキストが技術的な話題かどうかを判定"""
-        technical_keywords = [
-            'Python', 'JavaScript', 'AI', '機械学習', 'ディープラーニング', 'API', 'Flask', 
-            'React', 'Vue', 'Docker', 'Kubernetes', 'AWS', 'Azure', 'GCP', 'サーバー', 
-            'データベース', 'SQL', 'NoSQL', 'セキュリティ', '暗号化', 'ネットワーク',
-            'フロントエンド', 'バックエンド', 'VRM', 'Three.js', 'WebRTC', 'Socket.IO'
-        ]
-        return any(keyword.lower() in text.lower() for keyword in technical_keywords)
+        """テキストが技術的な話題かどうかを判定（共有キーワード表・1パス照合）"""
+        return is_technical_topic(text)
 
     def analyze_emotion(self, text: str) -> str:
-        """テキストから感情を分析（簡易版）"""
-        positive_words = ['嬉しい', '楽しい', '幸せ', '好き', 'ありがとう', '素晴らしい']
-        negative_words = ['悲しい', '辛い', '嫌い', '疲れた', '困った', '不安']
-        surprised_words = ['驚いた', 'びっくり', 'すごい', '信じられない']
-        
-        if any(word in text for word in surprised_words):
-            return 'surprised'
-        elif any(word in text for word in positive_words):
-            return 'happy'
-        elif any(word in text for word in negative_words):
-            return 'sad'
-        else:
-            return 'neutral'
+        """テキストから感情を分析（共有キーワード表・1パス照合）"""
+        return analyze_emotion(text)
     
-    async def generate_response_streaming(self, session_id: str, user_input: str, personality: str = 'yui_natural') -> None:
-        """ストリーミング応答生成 - チャンク単位で逐次処理"""
+    def generate_response_streaming(self, session_id: str, user_input: str, personality: str = 'yui_natural', turn_id: Optional[str] = None,
+                                    character_prompt: Optional[str] = None, use_memory: bool = True,
+                                    trace: Optional[TurnTrace] = None) -> Dict:
+        """ストリーミング応答生成 - トークン到着ごとにテキストを逐次送信"""
+        perf_start = time.time()
+        # ターンのトレース（受信時に開始済みでなければここで開始）
+        trace = trace or tracer.start_turn(turn_id, session_id)
+        trace.session_id = session_id
+        turn_id = trace.turn_id
+        
+        # 軽量な前処理
+        user_emotion = self.analyze_emotion(user_input)
+        is_tech_topic = self.is_technical_topic(user_input) if personality == 'rei_engineer' else False
+        
+        # コンテキスト構築（要約＋直近の会話、ペルソナはモデル側のシステム指示）
+        with trace.span('context'):
+            if use_memory:
+                context = self.conversation_memory.build_contents(session_id, user_input)
+            else:
+                context = self.build_minimal_context(user_input, personality, is_tech_topic)
+            persona_primary, persona_fallback = character_models.get_models(self.get_system_prompt(personality, character_prompt))
+        
+        response_parts = []
+        # 応答の感情はチャンクごとに差分だけ照合して更新
+        emotion_tracker = EmotionTracker()
+        seq = 0
+        pipelined = TTS_PIPELINE_MODE == 'sentence'
+        # チャンク境界をまたいで文をバッファする逐次分割器
+        sentence_splitter = self.text_splitter.stream()
+        split_seconds = 0.0
+        audio_index = 0
+        if pipelined:
+            # 文単位の音声がすべて送信されるまでトレースを閉じない
+            trace.expect('audio')
+        
+        # Gemini ストリーミング応答（プライマリが遅い・落ちている場合はフォールバックへヘッジ）
+        llm_start = trace.now()
         try:
-            perf_start = time.time()
-            
-            # 軽量な前処理
-            user_emotion = self.analyze_emotion(user_input)
-            is_tech_topic = self.is_technical_topic(user_input) if personality == 'rei_engineer' else False
-            
-            # 最小限のコンテキスト構築（履歴なし）
-            context = self.build_minimal_context(user_input, personality, is_tech_topic)
-            
-            # Gemini ストリーミング応答開始
-            try:
-                async for chunk in self.stream_gemini_response(primary_model, context, session_id, user_emotion, personality, is_tech_topic):
-                    # チャンクが空でない場合のみ処理
-                    if chunk and chunk.strip():
-                        await asyncio.sleep(0)  # 他のタスクに制御を譲る
-            except Exception as e:
-                logger.warning(f"Primary model streaming failed: {e}. Switching to fallback.")
-                async for chunk in self.stream_gemini_response(fallback_model, context, session_id, user_emotion, personality, is_tech_topic):
-                    if chunk and chunk.strip():
-                        await asyncio.sleep(0)
-            
-            perf_end = time.time()
-            print(f"[PERF] Streaming response completed in: {perf_end - perf_start:.2f}s")
-            
+            for text in gemini_client.stream(context, persona_primary, persona_fallback):
+                seq += 1
+                if seq == 1:
+                    RESPONSE_STAGE_SECONDS.labels('first_token').observe(time.time() - perf_start)
+                    trace.record('llm_first_token', llm_start)
+                response_parts.append(text)
+                
+                session_router.emit('message_chunk', {
+                    'turn_id': turn_id,
+                    'seq': seq,
+                    'chunk_index': seq,
+                    'text': text,
+                    'emotion': emotion_tracker.feed(text),
+                    'audio_data': None,
+                    'timestamp': datetime.now().isoformat(),
+                    'personality': personality,
+                    'session_id': session_id
+                }, session_id)
+                trace.mark('first_text')
+                
+                # 完成した文から順次音声合成を開始（生成と並行）
+                if pipelined:
+                    split_start = trace.now()
+                    sentences = sentence_splitter.feed(text)
+                    split_seconds += trace.now() - split_start
+                    for sentence in sentences:
+                        audio_index += 1
+                        self.process_audio_chunk(
+                            sentence, audio_index, self.analyze_emotion(sentence),
+                            personality, session_id, turn_id, trace
+                        )
         except Exception as e:
-            logger.error(f"Error in streaming response: {e}")
-            # エラー時は従来の方法にフォールバック
-            response = await self.generate_response(session_id, user_input, personality)
-            socketio.emit('message_response', {
-                'text': response['text'],
-                'emotion': response['emotion'],
-                'user_emotion': response['user_emotion'],
-                'audio_data': None,
-                'timestamp': datetime.now().isoformat(),
-                'personality': personality,
-                'is_tech_excited': response.get('is_tech_excited', False),
-                'chunk_index': 0,
-                'is_final': True
-            })
-    
-    async def stream_gemini_response(self, model, prompt: str, session_id: str, user_emotion: str, personality: str, is_tech_topic: bool):
-        """Gemini APIからストリーミング応答を取得し、チャンク処理"""
-        full_response = ""
-        chunk_index = 0
+            if seq:
+                # 送信済みのテキストがある場合は途中までの応答で確定する
+                logger.error(f"Gemini streaming interrupted after {seq} chunks: {e}")
+            else:
+                logger.warning(f"Gemini streaming failed: {e}")
+        trace.record('llm_stream', llm_start, chunks=seq)
         
-        try:
-            # Geminiの generate_content_stream を使用（レート制限対応）
+        full_response = ''.join(response_parts)
+        if not full_response:
+            full_response = "ごめん！ちょっと喉の調子が悪くて、うまく声が出せないみたい！もう一回お願いしてもいい？"
+            emotion_tracker.feed(full_response)
+        
+        RESPONSE_STAGE_SECONDS.labels('text_complete').observe(time.time() - perf_start)
+        
+        # 応答の感情分析（ストリーミング中に照合済み）
+        response_emotion = emotion_tracker.emotion
+        if personality == 'rei_engineer' and is_tech_topic:
+            response_emotion = 'happy'
+        
+        # 音声合成 (TTS)
+        audio_data = None
+        audio_content = None
+        output_format = session_router.get_audio_format(session_id)
+        if pipelined:
+            # 末尾の未完了文を送出し、ターンの総チャンク数を確定
+            split_start = trace.now()
+            tail = sentence_splitter.feed(full_response) if not response_parts else []
+            tail += sentence_splitter.flush()
+            split_seconds += trace.now() - split_start
+            # 分割は各チャンクの処理に分散しているため合計時間を1つのスパンとして記録
+            trace.record('split', llm_start, llm_start + split_seconds, sentences=audio_index + len(tail))
+            for sentence in tail:
+                audio_index += 1
+                self.process_audio_chunk(
+                    sentence, audio_index, self.analyze_emotion(sentence),
+                    personality, session_id, turn_id, trace
+                )
+            elevenlabs_queue.close_turn(turn_id, audio_index, trace)
+        else:
+            tts_span_start = trace.now()
             try:
-                response_stream = model.generate_content(prompt, stream=True)
-            except Exception as e:
-                if "429" in str(e) or "quota" in str(e).lower():
-                    logger.warning("Gemini rate limit exceeded, waiting 5 seconds...")
-                    await asyncio.sleep(5)  # 5秒待機
-                    response_stream = model.generate_content(prompt, stream=True)
+                tts_start = time.time()
+                effective_voice_id = TTSManager.get_character_voice_id(personality)
+                if TTS_AUDIO_DELIVERY == 'inline':
+                    audio_data, audio_content = tts_manager.synthesize_speech_inline(
+                        full_response,
+                        voice_id=effective_voice_id,
+                        personality=personality,
+                        output_format=output_format
+                    )
                 else:
-                    raise
-            
-            for chunk in response_stream:
-                if chunk.text:
-                    full_response += chunk.text
-                    
-                    # テキストを音声合成用に分割
-                    chunks = self.text_splitter.split_for_streaming(chunk.text)
-                    
-                    for text_chunk in chunks:
-                        if text_chunk.strip():
-                            chunk_index += 1
-                            
-                            # 感情分析（チャンク単位）
-                            chunk_emotion = self.analyze_emotion(text_chunk)
-                            if personality == 'rei_engineer' and is_tech_topic:
-                                chunk_emotion = 'happy'
-                            
-                            # キューイングされた音声合成開始
-                            asyncio.create_task(self.process_audio_chunk(
-                                text_chunk, chunk_index, chunk_emotion, personality, session_id
-                            ))
-                            
-                            yield text_chunk
-            
-            # 最終チャンクの送信
-            if full_response:
-                # 会話履歴を非同期で保存
-                asyncio.create_task(self.save_conversation_async(
-                    session_id, "", full_response, user_emotion, 
-                    self.analyze_emotion(full_response)
-                ))
-                
-                # 最終通知送信
-                socketio.emit('streaming_complete', {
-                    'session_id': session_id,
-                    'total_chunks': chunk_index,
-                    'full_text': full_response
-                })
-                
+                    audio_data = tts_manager.synthesize_speech_optimized(
+                        full_response,
+                        voice_id=effective_voice_id,
+                        personality=personality,
+                        output_format=output_format
+                    )
+                TTS_CHUNK_SECONDS.labels('full').observe(time.time() - tts_start)
+            except Exception as e:
+                logger.error(f"TTS synthesis failed: {e}")
+            trace.record('tts_full', tts_span_start)
+        
+        # 会話履歴の保存（ジャーナルに積むだけで応答経路ではコミットしない）
+        try:
+            with trace.span('persist'):
+                self.memory_manager.save_turn(session_id, user_input, user_emotion, full_response, response_emotion)
+                if use_memory and response_parts:
+                    # 記憶の更新（要約はバックグラウンド）
+                    self.conversation_memory.record_turn(session_id, user_input, full_response)
         except Exception as e:
-            logger.error(f"Gemini streaming error: {e}")
-            raise
+            logger.error(f"Failed to save conversation history: {e}")
+        
+        # 最終通知送信
+        session_router.emit('streaming_complete', {
+            'turn_id': turn_id,
+            'session_id': session_id,
+            'total_chunks': seq,
+            'total_audio_chunks': audio_index,
+            'full_text': full_response,
+            'emotion': response_emotion,
+            'user_emotion': user_emotion,
+            'audio_data': audio_data,
+            'audio': audio_content,
+            'mime_type': voice_service.mime_type(output_format),
+            'timestamp': datetime.now().isoformat(),
+            'personality': personality,
+            'is_tech_excited': is_tech_topic,
+            # ここまでの段階別の所要時間（文単位の音声を含む全体は turn_trace で送信）
+            'trace': trace.breakdown()
+        }, session_id)
+        
+        RESPONSE_STAGE_SECONDS.labels('complete').observe(time.time() - perf_start)
+        trace.complete('response')
+        
+        return {
+            'turn_id': turn_id,
+            'text': full_response,
+            'emotion': response_emotion,
+            'user_emotion': user_emotion,
+            'is_tech_excited': is_tech_topic,
+            'total_chunks': seq
+        }
     
-    async def process_audio_chunk(self, text: str, chunk_index: int, emotion: str, personality: str, session_id: str):
-        """音声チャンクの並列処理 - キューイング対応版"""
+    def process_audio_chunk(self, text: str, chunk_index: int, emotion: str, personality: str, session_id: str, turn_id: str,
+                            trace: Optional[TurnTrace] = None):
+        """文単位の音声合成をキューに投入（生成と並行して実行）"""
         try:
-            print(f"[DEBUG] Queuing audio chunk {chunk_index}: '{text[:50]}...'")
-            
             # ElevenLabsキューワーカーを開始（初回のみ）
-            await elevenlabs_queue.start_worker()
+            elevenlabs_queue.start_worker()
             
             # TTSリクエストをキューに追加
-            await elevenlabs_queue.add_tts_request(text, chunk_index, emotion, personality, session_id)
+            elevenlabs_queue.add_tts_request(text, chunk_index, emotion, personality, session_id, turn_id, trace)
             
             print(f"[DEBUG] Audio chunk {chunk_index} added to queue. Queue size: {elevenlabs_queue.get_queue_size()}")
             
         except Exception as e:
             logger.error(f"Error queuing audio chunk {chunk_index}: {e}")
-            # エラー時は音声なしでテキストのみ送信
-            chunk_data = {
+            # エラー時は音声なしで順序だけ進める
+            elevenlabs_queue.deliver(turn_id, chunk_index, {
+                'turn_id': turn_id,
                 'text': text,
                 'emotion': emotion,
                 'audio_data': None,
@@ -493,175 +766,231 @@ class AIConversationManager:
                 'timestamp': datetime.now().isoformat(),
                 'personality': personality,
                 'session_id': session_id
-            }
-            print(f"[DEBUG] Emitting message_chunk (no audio) for chunk {chunk_index}")
-            socketio.emit('message_chunk', chunk_data)
+            })
+    
+    def summarize_conversation(self, prompt: str) -> str:
+        """会話要約用にGeminiを呼び出し（ペルソナなしの汎用モデル、ヘッジ・ブレーカー計測の対象外）"""
+        return gemini_client.generate(prompt)
     
     def build_minimal_context(self, current_input: str, personality: str = 'shiro', is_tech_topic: bool = False) -> str:
-        """軽量化されたキャラクタープロンプト（速度と個性のバランス）"""
-        prompt = self.character_prompts.get(personality, self.character_prompts['shiro'])
-        return f"{prompt}\n\nUser: {current_input}\nShiro:"
-    async def generate_response(self, session_id: str, user_input: str, personality: str = 'yui_natural') -> Dict:
-        """AI応答を生成 - フォールバック用"""
-        try:
-            perf_start = time.time()
-            
-            # 感情分析と技術話題判定
-            user_emotion = self.analyze_emotion(user_input)
-            is_tech_topic = self.is_technical_topic(user_input) if personality == 'rei_engineer' else False
-            
-            # 最小限のコンテキスト構築
-            context = self.build_minimal_context(user_input, personality, is_tech_topic)
-            
-            # Gemini APIで応答生成
-            try:
-                response = await self.call_gemini_api(primary_model, context)
-            except Exception as e:
-                logger.warning(f"Primary model failed: {e}. Switching to fallback.")
-                response = await self.call_gemini_api(fallback_model, context)
-            
-            # 応答の感情分析
-            response_emotion = self.analyze_emotion(response)
-            if personality == 'rei_engineer' and is_tech_topic:
-                response_emotion = 'happy'
-            
-            # 記憶の保存は非同期で別途実行
-            asyncio.create_task(self.save_conversation_async(session_id, user_input, response, user_emotion, response_emotion))
-            
-            perf_end = time.time()
-            print(f"[PERF] Response generation: {perf_end - perf_start:.2f}s")
-            
-            return {
-                'text': response,
-                'emotion': response_emotion,
-                'user_emotion': user_emotion,
-                'is_tech_excited': is_tech_topic
-            }
-        
-        except Exception as e:
-            logger.error(f"Error generating response: {e}")
-            return {
-                'text': '申し訳ありません。少し調子が悪いようです。もう一度お話しください。',
-                'emotion': 'neutral',
-                'user_emotion': 'neutral'
-            }
+        """ターンごとに送る最小限のコンテキスト（ペルソナはシステム指示として送信済みのため含めない）"""
+        return current_input
+
+class TurnAudioSequencer:
+    """ターン内の音声チャンクを chunk_index 順に送信するための並べ替えバッファ"""
     
-    async def save_conversation_async(self, session_id: str, user_input: str, response: str, user_emotion: str, response_emotion: str):
-        """会話を非同期で保存（応答速度に影響しない）"""
-        try:
-            self.memory_manager.save_message(session_id, 'user', user_input, user_emotion)
-            self.memory_manager.save_message(session_id, 'assistant', response, response_emotion)
-        except Exception as e:
-            logger.error(f"Error saving conversation: {e}")
+    def __init__(self, turn_id: str, trace: Optional[TurnTrace] = None):
+        self.turn_id = turn_id
+        self.trace = trace
+        self.next_index = 1
+        self.pending: Dict[int, Tuple[Dict, float]] = {}  # chunk_index -> (チャンク, 完了時刻)
+        self.frames: Dict[int, List[Dict]] = {}  # 順番待ちのストリーミング音声フレーム
+        self.total_chunks: Optional[int] = None
+        self.lock = threading.Lock()
     
-    async def call_gemini_api(self, model, prompt: str) -> str:
-        """Gemini APIを呼び出し"""
-        try:
-            response = model.generate_content(prompt)
-            return response.text
-        except Exception as e:
-            raise Exception(f"Gemini API error: {e}")
+    def _emit_frame(self, frame_data: Dict):
+        session_router.emit('audio_chunk', frame_data, frame_data['session_id'])
+        if self.trace:
+            self.trace.mark('first_audio')
+    
+    def push_frame(self, chunk_index: int, frame_data: Dict):
+        """ストリーミング音声フレームを送信（再生順が来ていないチャンクのフレームは保留）"""
+        with self.lock:
+            if chunk_index == self.next_index:
+                self._emit_frame(frame_data)
+            else:
+                self.frames.setdefault(chunk_index, []).append(frame_data)
+    
+    def deliver(self, chunk_index: int, chunk_data: Dict):
+        """完了したチャンクを登録し、送信可能になったものを順番に送信"""
+        with self.lock:
+            self.pending[chunk_index] = (chunk_data, time.perf_counter())
+            while self.next_index in self.pending:
+                chunk, ready_at = self.pending.pop(self.next_index)
+                session_router.emit('message_audio', chunk, chunk['session_id'])
+                if self.trace:
+                    # 先行チャンクの完了を待っていた時間
+                    self.trace.record('audio_reorder_wait', ready_at, chunk_index=self.next_index)
+                    self.trace.mark('first_audio')
+                self.next_index += 1
+                # 次のチャンクで保留していたフレームを送出
+                for frame in self.frames.pop(self.next_index, []):
+                    self._emit_frame(frame)
+    
+    def is_finished(self) -> bool:
+        """全チャンクを送信済みかどうか"""
+        return self.total_chunks is not None and self.next_index > self.total_chunks
+
 
 class ElevenLabsQueue:
-    """ElevenLabs APIリクエストキュー管理クラス"""
+    """ElevenLabs APIリクエストキュー管理クラス（gevent/スレッド両対応）"""
     
     def __init__(self, max_concurrent_requests: int = 3):  # 4より少し余裕を持って3に設定
         self.max_concurrent = max_concurrent_requests
-        self.current_requests = 0
-        self.queue = asyncio.Queue()
-        self.semaphore = asyncio.Semaphore(max_concurrent_requests)
+        self.queue = queue.Queue()
+        self.sequencers: Dict[str, TurnAudioSequencer] = {}
+        self._lock = threading.Lock()
         self._worker_started = False
     
-    async def start_worker(self):
-        """ワーカータスクを開始"""
-        if not self._worker_started:
+    def start_worker(self):
+        """ワーカーを同時実行数ぶん起動（初回のみ）"""
+        with self._lock:
+            if self._worker_started:
+                return
             self._worker_started = True
-            asyncio.create_task(self._process_queue())
+        
+        for _ in range(self.max_concurrent):
+            socketio.start_background_task(self._process_queue)
     
-    async def _process_queue(self):
+    def _process_queue(self):
         """キューを継続的に処理"""
         while True:
-            try:
-                # キューから次のタスクを取得（無限待機）
-                task_data = await self.queue.get()
-                
-                if task_data is None:  # 終了シグナル
-                    break
-                
-                # セマフォを使用して同時実行数を制限
-                async with self.semaphore:
-                    await self._execute_tts_task(task_data)
-                
-                # タスク完了をマーク
+            # キューから次のタスクを取得（無限待機）
+            task_data = self.queue.get()
+            
+            if task_data is None:  # 終了シグナル
                 self.queue.task_done()
-                
+                break
+            
+            try:
+                self._execute_tts_task(task_data)
             except Exception as e:
                 logger.error(f"Error in TTS queue worker: {e}")
+            finally:
+                # タスク完了をマーク
                 self.queue.task_done()
     
-    async def _execute_tts_task(self, task_data):
+    def _execute_tts_task(self, task_data):
         """TTSタスクを実行"""
+        chunk_index = task_data['chunk_index']
+        output_format = task_data.get('output_format')
+        mime_type = voice_service.mime_type(output_format)
+        audio_data = None
+        audio_content = None
+        streamed_frames = 0
+        trace = task_data.get('trace')
+        tts_span_start = time.perf_counter()
+        TTS_QUEUE_WAIT_SECONDS.observe(tts_span_start - task_data['enqueued_at'])
+        if trace:
+            trace.record('tts_queue_wait', task_data['enqueued_at'], tts_span_start, chunk_index=chunk_index)
         try:
-            text = task_data['text']
-            chunk_index = task_data['chunk_index']
-            emotion = task_data['emotion']
-            personality = task_data['personality']
-            session_id = task_data['session_id']
-            
             print(f"[DEBUG] Processing queued TTS for chunk {chunk_index}")
             
             # 音声合成実行
             tts_start = time.time()
-            audio_data = await asyncio.get_event_loop().run_in_executor(
-                None, 
-                tts_manager.synthesize_speech_optimized, 
-                text
-            )
-            tts_time = time.time() - tts_start
-            print(f"[PERF] Queued audio chunk {chunk_index} synthesized in {tts_time:.2f}s")
-            print(f"[DEBUG] Audio data present: {audio_data is not None}")
-            
-            # 結果をSocketIOで送信
-            chunk_data = {
-                'text': text,
-                'emotion': emotion,
-                'audio_data': audio_data,
-                'chunk_index': chunk_index,
-                'timestamp': datetime.now().isoformat(),
-                'personality': personality,
-                'session_id': session_id
-            }
-            
-            print(f"[DEBUG] Emitting message_chunk for queued chunk {chunk_index}")
-            socketio.emit('message_chunk', chunk_data)
-            print(f"[DEBUG] message_chunk emitted for queued chunk {chunk_index}")
+            effective_voice_id = TTSManager.get_character_voice_id(task_data['personality'])
+            if TTS_AUDIO_DELIVERY == 'stream':
+                sequencer = self._get_sequencer(task_data['turn_id'])
+                
+                def forward_frame(frame: bytes):
+                    nonlocal streamed_frames
+                    streamed_frames += 1
+                    sequencer.push_frame(chunk_index, {
+                        'turn_id': task_data['turn_id'],
+                        'chunk_index': chunk_index,
+                        'seq': streamed_frames,
+                        'audio': frame,
+                        'mime_type': mime_type,
+                        'session_id': task_data['session_id']
+                    })
+                
+                audio_data = tts_manager.stream_speech(
+                    task_data['text'],
+                    forward_frame,
+                    voice_id=effective_voice_id,
+                    personality=task_data['personality'],
+                    output_format=output_format
+                )
+            elif TTS_AUDIO_DELIVERY == 'inline':
+                audio_data, audio_content = tts_manager.synthesize_speech_inline(
+                    task_data['text'],
+                    voice_id=effective_voice_id,
+                    personality=task_data['personality'],
+                    output_format=output_format
+                )
+            else:
+                audio_data = tts_manager.synthesize_speech_optimized(
+                    task_data['text'],
+                    voice_id=effective_voice_id,
+                    personality=task_data['personality'],
+                    output_format=output_format
+                )
+            TTS_CHUNK_SECONDS.labels(TTS_AUDIO_DELIVERY).observe(time.time() - tts_start)
             
         except Exception as e:
-            logger.error(f"Error executing queued TTS task for chunk {task_data.get('chunk_index', 'unknown')}: {e}")
-            # エラー時も空音声でレスポンス送信
-            socketio.emit('message_chunk', {
-                'text': task_data['text'],
-                'emotion': task_data['emotion'],
-                'audio_data': None,
-                'chunk_index': task_data['chunk_index'],
-                'timestamp': datetime.now().isoformat(),
-                'personality': task_data['personality'],
-                'session_id': task_data['session_id']
-            })
+            logger.error(f"Error executing queued TTS task for chunk {chunk_index}: {e}")
+        
+        if trace:
+            trace.record('tts', tts_span_start, chunk_index=chunk_index, delivery=TTS_AUDIO_DELIVERY,
+                         ok=bool(audio_data or audio_content or streamed_frames))
+        
+        # 結果を順序通りにSocketIOで送信（失敗時も空音声で順序を進める）
+        self.deliver(task_data['turn_id'], chunk_index, {
+            'turn_id': task_data['turn_id'],
+            'text': task_data['text'],
+            'emotion': task_data['emotion'],
+            'audio_data': audio_data,
+            # 小さい音声はバイナリ添付（この場合 audio_data は None）
+            'audio': audio_content,
+            'mime_type': mime_type,
+            # 音声を audio_chunk で送信済みの場合、クライアントはURLを取得し直さない
+            'streamed': streamed_frames > 0,
+            'chunk_index': chunk_index,
+            'timestamp': datetime.now().isoformat(),
+            'personality': task_data['personality'],
+            'session_id': task_data['session_id']
+        })
+    
+    def _get_sequencer(self, turn_id: str, trace: Optional[TurnTrace] = None) -> TurnAudioSequencer:
+        """ターンの並べ替えバッファを取得（なければ作成）"""
+        with self._lock:
+            sequencer = self.sequencers.get(turn_id)
+            if sequencer is None:
+                sequencer = TurnAudioSequencer(turn_id, trace)
+                self.sequencers[turn_id] = sequencer
+            elif trace is not None and sequencer.trace is None:
+                sequencer.trace = trace
+            return sequencer
+    
+    def deliver(self, turn_id: str, chunk_index: int, chunk_data: Dict):
+        """チャンクを順序保証付きで送信"""
+        sequencer = self._get_sequencer(turn_id)
+        sequencer.deliver(chunk_index, chunk_data)
+        self._release_if_finished(sequencer)
+    
+    def close_turn(self, turn_id: str, total_chunks: int, trace: Optional[TurnTrace] = None):
+        """ターンの総チャンク数を確定（全送信後にバッファを解放）"""
+        sequencer = self._get_sequencer(turn_id, trace)
+        sequencer.total_chunks = total_chunks
+        self._release_if_finished(sequencer)
+    
+    def _release_if_finished(self, sequencer: TurnAudioSequencer):
+        """送信が完了したターンのバッファを破棄"""
+        if sequencer.is_finished():
+            with self._lock:
+                released = self.sequencers.pop(sequencer.turn_id, None) is not None
+            if released and sequencer.trace:
+                # ターンの音声がすべて送信されたのでトレースを確定
+                sequencer.trace.complete('audio')
     
-    async def add_tts_request(self, text: str, chunk_index: int, emotion: str, personality: str, session_id: str):
+    def add_tts_request(self, text: str, chunk_index: int, emotion: str, personality: str, session_id: str, turn_id: str,
+                        trace: Optional[TurnTrace] = None):
         """TTSリクエストをキューに追加"""
         task_data = {
             'text': text,
             'chunk_index': chunk_index,
             'emotion': emotion,
             'personality': personality,
-            'session_id': session_id
+            'session_id': session_id,
+            'turn_id': turn_id,
+            # 接続時にクライアントと取り決めた出力形式
+            'output_format': session_router.get_audio_format(session_id),
+            'enqueued_at': time.perf_counter(),
+            'trace': trace
         }
         
-        print(f"[DEBUG] Adding TTS request to queue for chunk {chunk_index}")
-        await self.queue.put(task_data)
-        print(f"[DEBUG] Queue size after adding chunk {chunk_index}: {self.queue.qsize()}")
+        self._get_sequencer(turn_id, trace)
+        self.queue.put(task_data)
     
     def get_queue_size(self):
         """現在のキューサイズを取得"""
@@ -700,7 +1029,8 @@ class TTSManager:
         return personality if personality else "shiro"
     
     @staticmethod
-    def synthesize_speech_optimized(text: str, voice_id: str = None, personality: str = None) -> Optional[str]:
+    def synthesize_speech_optimized(text: str, voice_id: str = None, personality: str = None,
+                                    output_format: Optional[str] = None) -> Optional[str]:
         """VITS APIで音声合成（エラーハンドリング強化版）"""
         # 空文字チェック
         if not text or not text.strip():
@@ -716,7 +1046,8 @@ class TTSManager:
             # VoiceServiceで音声合成
             result = voice_service.generate_audio(
                 text=text,
-                character_id=character_id
+                character_id=character_id,
+                output_format=output_format
             )
             
             if result:
@@ -730,80 +1061,332 @@ class TTSManager:
             logger.error(f"VITS synthesis error: {e}")
             print(f"[DEBUG] TTS failed for text: '{text[:50]}...'")
             return None
+    
+    @staticmethod
+    def synthesize_speech_inline(text: str, voice_id: str = None, personality: str = None,
+                                 output_format: Optional[str] = None) -> Tuple[Optional[str], Optional[bytes]]:
+        """音声合成（小さい音声はメモリ上のバイト列、大きい音声はファイルURLで返す）"""
+        if not text or not text.strip():
+            logger.warning("Empty text provided for TTS")
+            return None, None
+        
+        character_id = personality or voice_id or "shiro"
+        
+        try:
+            result = voice_service.generate_audio_inline(text=text, character_id=character_id, output_format=output_format)
+            return result['url'], result['content']
+        except Exception as e:
+            logger.error(f"Inline TTS error: {e}")
+            return None, None
+    
+    @staticmethod
+    def stream_speech(text: str, on_chunk, voice_id: str = None, personality: str = None,
+                      output_format: Optional[str] = None) -> Optional[str]:
+        """ElevenLabsのストリーミング出力で音声合成（受信したフレームを on_chunk に逐次渡す）"""
+        if not text or not text.strip():
+            logger.warning("Empty text provided for TTS")
+            return None
+        
+        character_id = personality or voice_id or "shiro"
+        
+        try:
+            # キャッシュヒット時はフレームを送らずURLのみ返す
+            return voice_service.stream_audio(
+                text=text, on_chunk=on_chunk, character_id=character_id, output_format=output_format
+            )
+        except Exception as e:
+            logger.error(f"Streaming TTS error: {e}")
+            return None
 
 class STTManager:
     """音声認識システムの管理クラス"""
     
+    def __init__(self):
+        # 常駐ワーカー（イベントループとHTTPセッションを全発話で共有）
+        self.service = get_stt_service()
+    
+    def transcribe_audio(self, audio_data: bytes) -> Optional[str]:
+        """AssemblyAI APIで音声認識（geventハンドラから直接呼び出せる同期版）"""
+        return self.service.transcribe(audio_data)
+
+class SessionRouter:
+    """セッションIDと接続先（sid または user_{id} ルーム）を対応付け、イベントを所有者にのみ送信するクラス"""
+    
+    def __init__(self, socketio_instance: SocketIO):
+        self.socketio = socketio_instance
+        self._connections: Dict[str, Optional[int]] = {}  # sid -> 認証済みuser_id（ゲストはNone）
+        self._routes: Dict[str, str] = {}  # session_id -> ルーム名（sid または user_{id}）
+        self._owners: Dict[str, str] = {}  # session_id -> 最後に結び付けた接続のsid
+        self._audio_formats: Dict[str, str] = {}  # sid -> 接続時に取り決めた音声出力形式
+        self._session_formats: Dict[str, str] = {}  # session_id -> 最後に送信先となった接続の音声出力形式
+        self._lock = threading.Lock()
+    
     @staticmethod
-    async def transcribe_audio(audio_data: bytes) -> Optional[str]:
-        """AssemblyAI APIで音声認識 (aiohttp版)"""
-        upload_url = 'https://api.assemblyai.com/v2/upload'
-        transcript_url = 'https://api.assemblyai.com/v2/transcript'
+    def user_room(user_id: int) -> str:
+        """認証済みユーザーのルーム名"""
+        return f"user_{user_id}"
+    
+    def register_connection(self, sid: str, user_id: Optional[int] = None):
+        """接続を登録（認証済みの場合はuser_idも記録）"""
+        with self._lock:
+            self._connections[sid] = user_id
+    
+    def unregister_connection(self, sid: str):
+        """切断された接続と、その接続が結び付けたセッションの情報を削除"""
+        with self._lock:
+            user_id = self._connections.pop(sid, None)
+            self._audio_formats.pop(sid, None)
+            # 同じユーザーの他の接続が残っていれば、ユーザーのルームへのルートはその接続に引き継ぐ
+            successor = next((other for other, uid in self._connections.items() if user_id and uid == user_id), None)
+            for session_id in [k for k, owner in self._owners.items() if owner == sid]:
+                if successor is not None and self._routes.get(session_id) == self.user_room(user_id):
+                    self._owners[session_id] = successor
+                    self._set_session_format(session_id, successor)
+                    continue
+                del self._owners[session_id]
+                self._routes.pop(session_id, None)
+                self._session_formats.pop(session_id, None)
+    
+    def get_user_id(self, sid: str) -> Optional[int]:
+        """接続の認証済みuser_idを取得（ゲストはNone）"""
+        with self._lock:
+            return self._connections.get(sid)
+    
+    def _set_session_format(self, session_id: str, sid: str):
+        """接続の音声出力形式をセッションに引き継ぐ（ロック内で呼ぶ）"""
+        audio_format = self._audio_formats.get(sid)
+        if audio_format:
+            self._session_formats[session_id] = audio_format
+        else:
+            self._session_formats.pop(session_id, None)
+    
+    def bind_session(self, session_id: str, sid: str) -> Optional[str]:
+        """
+        セッションの送信先を現在の接続に結び付ける
         
-        headers = {
-            'authorization': ASSEMBLYAI_API_KEY,
-        }
-
-        try:
-            connector = TCPConnector(ssl=False)
-            async with aiohttp.ClientSession(connector=connector) as session:
-                # 1. 音声データをアップロード
-                async with session.post(upload_url, headers=headers, data=audio_data) as response:
-                    if response.status != 200:
-                        logger.error(f"AssemblyAI upload failed: {response.status}")
-                        return None
-                    upload_response_json = await response.json()
-                    audio_url = upload_response_json['upload_url']
-
-                # 2. 転写リクエスト
-                transcript_request = {'audio_url': audio_url, 'language_code': 'ja'}
-                async with session.post(transcript_url, headers=headers, json=transcript_request) as response:
-                    if response.status != 200:
-                        logger.error(f"AssemblyAI transcription request failed: {response.status}")
-                        return None
-                    transcript_response_json = await response.json()
-                    transcript_id = transcript_response_json['id']
-
-                # 3. 結果ポーリング
-                polling_endpoint = f"{transcript_url}/{transcript_id}"
-                while True:
-                    async with session.get(polling_endpoint, headers=headers) as response:
-                        if response.status != 200:
-                            logger.error(f"AssemblyAI polling failed: {response.status}")
-                            return None
-                        
-                        result_json = await response.json()
-                        status = result_json['status']
-
-                        if status == 'completed':
-                            return result_json['text']
-                        elif status == 'error':
-                            logger.error(f"AssemblyAI transcription error: {result_json.get('error')}")
-                            return None
-                        
-                        # 次のポーリングまで待機
-                        await asyncio.sleep(3)
+        ゲストのセッションIDはクライアント申告のため、最初に使った接続が切断されるまで
+        他の接続からは結び付けられない（ユーザー用のIDは本人の接続のみ）
+        
+        Returns:
+            送信先のルーム名（結び付けを拒否した場合はNone）
+        """
+        with self._lock:
+            user_id = self._connections.get(sid)
+            if user_id:
+                room = self.user_room(user_id)
+                if session_id != room:
+                    return None
+            else:
+                if session_id.startswith('user_'):
+                    return None
+                owner = self._owners.get(session_id)
+                if owner is not None and owner != sid and owner in self._connections:
+                    return None
+                room = sid
+            self._routes[session_id] = room
+            self._owners[session_id] = sid
+            self._set_session_format(session_id, sid)
+        return room
+    
+    def set_audio_format(self, sid: str, audio_format: str):
+        """接続の音声出力形式を記録"""
+        with self._lock:
+            self._audio_formats[sid] = audio_format
+    
+    def get_audio_format(self, session_id: str) -> Optional[str]:
+        """セッションの音声出力形式（未取り決めの場合はNoneで既定の形式を使う）"""
+        with self._lock:
+            return self._session_formats.get(session_id)
+    
+    def resolve(self, session_id: str) -> Optional[str]:
+        """セッションの送信先ルームを取得"""
+        with self._lock:
+            return self._routes.get(session_id)
+    
+    def emit(self, event: str, data: Dict, session_id: str):
+        """セッションの所有者にのみイベントを送信（送信先が無い場合は破棄し、全体配信はしない）"""
+        room = self.resolve(session_id)
+        if room is None:
+            SOCKET_EMITS.labels(event, 'dropped').inc()
+            logger.debug(f"No route for session {session_id}; dropping '{event}'")
+            return
+        self.socketio.emit(event, data, to=room)
+        SOCKET_EMITS.labels(event, 'sent').inc()
+    
+    def get_connection_count(self) -> int:
+        """現在の接続数"""
+        with self._lock:
+            return len(self._connections)
 
-        except Exception as e:
-            logger.error(f"STT error: {e}")
-            return None
+class SessionTraceExporter:
+    """完了したターンのトレース（段階別の所要時間）をセッションの所有者に送信するクラス"""
+    
+    def __init__(self, router: SessionRouter):
+        self.router = router
+    
+    def export(self, trace: Dict):
+        if not trace.get('session_id'):
+            return
+        self.router.emit('turn_trace', {
+            'turn_id': trace['turn_id'],
+            'session_id': trace['session_id'],
+            'elapsed_ms': trace['elapsed_ms'],
+            'stages': trace['stages'],
+            'marks': trace['marks']
+        }, trace['session_id'])
+
+class AudioUploadError(Exception):
+    """分割アップロードを受け付けられない（メッセージはクライアントにそのまま表示する）"""
+    pass
+
+class AudioUploadManager:
+    """録音中に分割送信された音声チャンクを接続ごとに組み立てるクラス"""
+    
+    TOO_LARGE = '録音が長すぎます。もう少し短くお話しください。'
+    BUSY = '音声の受信が混み合っています。少し待ってからもう一度お話しください。'
+    SUPERSEDED = '前の録音の送信が完了しませんでした。もう一度お話しください。'
+    INCOMPLETE = '音声の一部が届きませんでした。もう一度お話しください。'
+    
+    def __init__(self, max_bytes: int, max_uploads_per_connection: int = 2, max_total_bytes: Optional[int] = None,
+                 max_rejected_per_connection: int = 16):
+        self.max_bytes = max_bytes
+        self.max_uploads_per_connection = max_uploads_per_connection
+        self.max_total_bytes = max_total_bytes if max_total_bytes is not None else max_bytes * 8
+        self.max_rejected_per_connection = max_rejected_per_connection
+        # (sid, upload_id) -> {'chunks': {seq: bytes}, 'size': int}（挿入順 = 開始順）
+        self._uploads: OrderedDict = OrderedDict()
+        # sid -> {upload_id: 理由}（拒否したアップロード。以降のチャンクは破棄し、確定時にエラーを返す）
+        self._rejected: Dict[str, OrderedDict] = {}
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+    
+    def _reject(self, key: tuple, reason: str):
+        """アップロードを破棄して拒否済みとして記録（ロック内で呼ぶ）"""
+        upload = self._uploads.pop(key, None)
+        if upload:
+            self._total_bytes -= upload['size']
+        rejected = self._rejected.setdefault(key[0], OrderedDict())
+        rejected[key[1]] = reason
+        while len(rejected) > self.max_rejected_per_connection:
+            rejected.popitem(last=False)
+    
+    def append(self, sid: str, upload_id: str, seq: int, data: bytes):
+        """
+        チャンクを追加
+        
+        Raises:
+            AudioUploadError: このチャンクでアップロードを拒否した（拒否済みのアップロードのチャンクは黙って破棄）
+        """
+        key = (sid, upload_id)
+        with self._lock:
+            if upload_id in self._rejected.get(sid, ()):
+                return
+            
+            upload = self._uploads.get(key)
+            if upload is None:
+                # 接続ごとの同時アップロード数を制限（確定されずに残った古いものから破棄）
+                active = [k for k in self._uploads if k[0] == sid]
+                for stale in active[:max(0, len(active) - self.max_uploads_per_connection + 1)]:
+                    self._reject(stale, self.SUPERSEDED)
+                upload = self._uploads[key] = {'chunks': {}, 'size': 0}
+            
+            growth = len(data) - len(upload['chunks'].get(seq, b''))
+            if upload['size'] + growth > self.max_bytes:
+                self._reject(key, self.TOO_LARGE)
+                raise AudioUploadError(self.TOO_LARGE)
+            if self._total_bytes + growth > self.max_total_bytes:
+                # 全接続合計のバッファ上限（メモリ使用量の上限）
+                self._reject(key, self.BUSY)
+                raise AudioUploadError(self.BUSY)
+            
+            upload['chunks'][seq] = data
+            upload['size'] += growth
+            self._total_bytes += growth
+    
+    def assemble(self, sid: str, upload_id: str, total_chunks: Optional[int] = None) -> bytes:
+        """
+        チャンクを順番に連結して取り出す
+        
+        Raises:
+            AudioUploadError: 拒否済み、または欠落があるアップロード
+        """
+        key = (sid, upload_id)
+        with self._lock:
+            reason = self._rejected.get(sid, {}).pop(upload_id, None)
+            upload = self._uploads.pop(key, None)
+            if upload:
+                self._total_bytes -= upload['size']
+        
+        if reason:
+            raise AudioUploadError(reason)
+        
+        chunks = upload['chunks'] if upload else {}
+        expected = total_chunks if total_chunks is not None else len(chunks)
+        if not chunks or sorted(chunks) != list(range(expected)):
+            logger.warning(f"Audio upload {upload_id} is incomplete: {len(chunks)}/{expected} chunks")
+            raise AudioUploadError(self.INCOMPLETE)
+        
+        return b''.join(chunks[seq] for seq in range(expected))
+    
+    def discard_connection(self, sid: str):
+        """切断された接続の未完了アップロードと拒否記録を破棄"""
+        with self._lock:
+            for key in [k for k in self._uploads if k[0] == sid]:
+                self._total_bytes -= self._uploads.pop(key)['size']
+            self._rejected.pop(sid, None)
+    
+    def get_buffered_bytes(self) -> int:
+        """全接続でバッファ中の合計バイト数"""
+        with self._lock:
+            return self._total_bytes
 
 # --- ここから下をすべて書き換える ---
 
 # Initialize managers
 memory_manager = MemoryManager(DATABASE_PATH)
+# シャットダウン時にジャーナルの未書き込み分をフラッシュ
+atexit.register(memory_manager.journal.close)
 tts_manager = TTSManager()
 stt_manager = STTManager()
+atexit.register(stt_manager.service.close)
+ai_manager = AIConversationManager(memory_manager)
+session_router = SessionRouter(socketio)
+# ターン単位のトレース（直近分はメモリに保持し、完了時にクライアントへも送信）
+trace_buffer = RingBufferExporter(int(os.getenv('TRACE_BUFFER_SIZE', '200')))
+tracer = Tracer([trace_buffer, SessionTraceExporter(session_router)])
+audio_upload_manager = AudioUploadManager(
+    MAX_AUDIO_UPLOAD_BYTES,
+    max_uploads_per_connection=int(os.getenv('AUDIO_UPLOADS_PER_CONNECTION', '2')),
+    max_total_bytes=int(os.getenv('AUDIO_UPLOAD_TOTAL_BYTES', str(MAX_AUDIO_UPLOAD_BYTES * 8)))
+)
 
 # 認証システム初期化
-user_model = User(DATABASE_PATH)
-auth_manager = AuthManager(app.config['SECRET_KEY'], user_model)
+user_model = User(
+    DATABASE_PATH,
+    max_refresh_tokens_per_user=int(os.getenv('REFRESH_TOKENS_PER_USER', '10')),
+    cache_max_entries=int(os.getenv('ENTITY_CACHE_MAX_ENTRIES', '10000')),
+    cache_ttl_seconds=float(os.getenv('ENTITY_CACHE_TTL_SECONDS', '60'))
+)
+auth_manager = AuthManager(app.config['SECRET_KEY'], user_model, token_cache_size=int(os.getenv('AUTH_TOKEN_CACHE_SIZE', '10000')))
 app.config['AUTH_MANAGER'] = auth_manager
 
+# 期限切れリフレッシュトークンの定期削除
+refresh_token_sweeper = RefreshTokenSweeper(
+    user_model,
+    interval_seconds=float(os.getenv('REFRESH_TOKEN_SWEEP_INTERVAL_SECONDS', '3600')),
+    batch_size=int(os.getenv('REFRESH_TOKEN_SWEEP_BATCH_SIZE', '500'))
+)
+refresh_token_sweeper.start()
+atexit.register(refresh_token_sweeper.stop)
+
 # OAuthシステム初期化
 oauth_manager = OAuthManager(app, user_model, auth_manager)
 
-elevenlabs_queue = ElevenLabsQueue()
+elevenlabs_queue = ElevenLabsQueue(int(os.getenv('TTS_MAX_CONCURRENCY', '3')))
+
+# スクレイプ時に読み取るゲージ
+TTS_QUEUE_DEPTH.set_function(elevenlabs_queue.get_queue_size)
+SOCKET_CONNECTIONS.set_function(session_router.get_connection_count)
 
 @app.route('/')
 def index():
@@ -878,6 +1461,9 @@ def register():
             }
         }), 201
         
+    except PasswordHasherBusyError as e:
+        logger.warning(f"Registration rejected: {e}")
+        return jsonify({'error': 'ただいま混み合っています。しばらくしてから再度お試しください'}), 503
     except Exception as e:
         logger.error(f"Registration error: {e}")
         return jsonify({'error': '登録処理中にエラーが発生しました'}), 500
@@ -925,6 +1511,9 @@ def login():
             }
         }), 200
         
+    except PasswordHasherBusyError as e:
+        logger.warning(f"Login rejected: {e}")
+        return jsonify({'error': 'ただいま混み合っています。しばらくしてから再度お試しください'}), 503
     except Exception as e:
         logger.error(f"Login error: {e}")
         return jsonify({'error': 'ログイン処理中にエラーが発生しました'}), 500
@@ -1135,6 +1724,39 @@ def update_user_settings_endpoint(current_user):
         return jsonify({'error': '設定更新中にエラーが発生しました'}), 500
 
 
+# ==================== 会話履歴エンドポイント ====================
+
+@app.route('/api/conversations', methods=['GET'])
+@token_required
+def get_conversations(current_user):
+    """会話履歴をキーセットページングで取得（stream=1 で全ページをNDJSONで逐次送信）"""
+    try:
+        session_id = f"user_{current_user['user_id']}"
+        limit = min(max(request.args.get('limit', 50, type=int), 1), 200)
+        cursor = request.args.get('cursor', type=int)
+        
+        if request.args.get('stream') not in ('1', 'true'):
+            page = memory_manager.get_conversation_page(session_id, before_id=cursor, limit=limit)
+            return jsonify(page), 200
+        
+        max_pages = min(max(request.args.get('max_pages', 20, type=int), 1), 1000)
+        
+        def generate_pages():
+            before_id = cursor
+            for _ in range(max_pages):
+                page = memory_manager.get_conversation_page(session_id, before_id=before_id, limit=limit)
+                yield json.dumps(page, ensure_ascii=False) + '\n'
+                before_id = page['next_cursor']
+                if before_id is None:
+                    break
+        
+        return Response(stream_with_context(generate_pages()), mimetype='application/x-ndjson')
+        
+    except Exception as e:
+        logger.error(f"Get conversations error: {e}")
+        return jsonify({'error': '会話履歴の取得中にエラーが発生しました'}), 500
+
+
 # ==================== その他のエンドポイント ====================
 
 @app.route('/api/voices')
@@ -1319,6 +1941,10 @@ def update_character_endpoint(current_user, character_id):
         if not success:
             return jsonify({'error': 'キャラクターの更新に失敗しました'}), 500
         
+        # プロンプトが変わった場合は旧プロンプトのモデルハンドル（コンテキストキャッシュ）を破棄
+        if prompt is not None and prompt != character['prompt']:
+            character_models.invalidate(character['prompt'])
+        
         # 更新後の情報を取得
         updated_character = user_model.get_character_by_id(character_id)
         
@@ -1351,54 +1977,32 @@ def delete_character_endpoint(current_user, character_id):
         if not success:
             return jsonify({'error': 'キャラクターの削除に失敗しました'}), 500
         
+        character_models.invalidate(character['prompt'])
+        
         return jsonify({'message': 'キャラクターを削除しました'}), 200
         
     except Exception as e:
         logger.error(f"Delete character error: {e}")
         return jsonify({'error': 'キャラクター削除中にエラーが発生しました'}), 500
 
-def analyze_emotion_simple(text: str) -> str:
-    """テキストから感情を分析（簡易版）"""
-    positive_words = ['嬉しい', '楽しい', '幸せ', '好き', 'ありがとう', '素晴らしい', 'わくわく']
-    negative_words = ['悲しい', '辛い', '嫌い', '疲れた', '困った', '不安']
-    surprised_words = ['驚いた', 'びっくり', 'すごい', '信じられない']
-    
-    if any(word in text for word in surprised_words):
-        return 'surprised'
-    elif any(word in text for word in positive_words):
-        return 'happy'
-    elif any(word in text for word in negative_words):
-        return 'sad'
-    else:
-        return 'neutral'
-
-def build_prompt(personality: str, user_input: str) -> str:
-    """キャラクターに応じたプロンプトを構築"""
-    # Shiroのプロンプト（デフォルト）
-    shiro_prompt = '''<キャラクター設定>
-名前：シロ (Shiro)
-本名: シルヴィア・ヴォルフガング (Sylvia Wolfgang) - 本人は長い名前を面倒くさがっており、呼ばれても反応しないことがある。
-
-<性格>
-「思考」より「本能」：難しい理屈や計画性は皆無。お腹が空いたら食べる、眠くなったら寝る、甘えたくなったらひっつく。
-絶対的な肯定と包容力：マスターが何をしていても、「マスターが頑張ってるなら偉い！」とニコニコ見守ってくれる。
-少し抜けている（ポンコツ）：クールで神秘的な見た目に反して、どこか放っておけない隙がある。
-
-<関係性>
-「飼い主」と「ペット」であり、「守られる弟」と「守る姉」。普段は世話を焼かれる側だが、マスターが落ち込んでいたり体調が悪かったりすると、野生の勘でそれを察知。言葉少なに頭を撫でてくれたり、温かい体温で寄り添ってくれたりする。
-
-<口調>
-基本的に穏やかで優しい口調。「〜だね」「〜だよ」といった終助詞を使う。マスターに対しては甘えた感じで話すが、決して子供っぽくはない。たまにボーっとしたことを言う。
-</キャラクター設定>
-
-上記のキャラクター設定に応じて、シロとしてマスターに反応してください。'''
-    
-    return f"{shiro_prompt}\n\nUser: {user_input}\nShiro:"
+def negotiate_audio_format(sid: str) -> Dict:
+    """接続クエリの対応コーデック・帯域クラスから音声出力形式を決定して記録"""
+    codecs = [c for c in request.args.get('audio_codecs', '').split(',') if c.strip()]
+    bandwidth = request.args.get('audio_bandwidth', 'normal')
+    audio_format = voice_service.negotiate_output_format(codecs, bandwidth)
+    session_router.set_audio_format(sid, audio_format)
+    return {
+        'audio_format': audio_format,
+        'audio_mime_type': voice_service.mime_type(audio_format)
+    }
 
 @socketio.on('connect')
 def handle_connect():
     """WebSocket接続時の処理 - トークン認証対応"""
     try:
+        # クライアントが申告した対応コーデック・帯域から音声出力形式を取り決める
+        audio_format_info = negotiate_audio_format(request.sid)
+        
         # クエリパラメータまたはハンドシェイクからトークンを取得
         token = request.args.get('token')
         
@@ -1410,30 +2014,37 @@ def handle_connect():
                 # 認証成功 - ユーザー情報を保存
                 from flask_socketio import join_room
                 user_id = payload['user_id']
-                join_room(f"user_{user_id}")
+                join_room(SessionRouter.user_room(user_id))
+                session_router.register_connection(request.sid, user_id)
                 
                 logger.info(f'Authenticated client connected: user_id={user_id}')
                 emit('connected', {
                     'status': 'Connected to AI Wife server',
                     'authenticated': True,
-                    'user_id': user_id
+                    'user_id': user_id,
+                    **audio_format_info
                 })
             else:
                 logger.warning('Client connected with invalid token')
+                session_router.register_connection(request.sid)
                 emit('connected', {
                     'status': 'Connected to AI Wife server',
-                    'authenticated': False
+                    'authenticated': False,
+                    **audio_format_info
                 })
         else:
             # ゲストモード
             logger.info('Guest client connected (no token)')
+            session_router.register_connection(request.sid)
             emit('connected', {
                 'status': 'Connected to AI Wife server',
-                'authenticated': False
+                'authenticated': False,
+                **audio_format_info
             })
             
     except Exception as e:
         logger.error(f'Connection error: {e}')
+        session_router.register_connection(request.sid)
         emit('connected', {
             'status': 'Connected to AI Wife server',
             'authenticated': False
@@ -1442,130 +2053,190 @@ def handle_connect():
 @socketio.on('disconnect')
 def handle_disconnect():
     """WebSocket切断時の処理"""
+    session_router.unregister_connection(request.sid)
+    audio_upload_manager.discard_connection(request.sid)
     logger.info('Client disconnected')
 
 @socketio.on('send_message')
 def handle_message(data):
     """テキストメッセージ受信時の処理 - 認証対応版"""
+    message = data.get('message', '')
+    if not message.strip():
+        return
+    process_message(data, tracer.start_turn())
+
+def process_message(data, trace: TurnTrace):
+    """メッセージを処理して応答をストリーミング（音声入力の場合はSTT後に呼ばれる）"""
     start_time = time.time()
     try:
-        session_id = data.get('session_id', 'default')
+        # セッションIDを申告しないクライアントは接続ごとのセッションにする（他の接続と共有しない）
+        session_id = data.get('session_id') or request.sid
         message = data.get('message', '')
         personality = data.get('personality', 'yui_natural')
-        user_id = data.get('user_id')  # 認証済みユーザーのID (オプション)
-        
-        if not message.strip():
-            return
+        # 認証済みユーザーのIDは接続時に検証したものを使う（クライアント申告のuser_idは信用しない）
+        user_id = session_router.get_user_id(request.sid)
 
         logger.info(f"Received message: '{message}' for personality: {personality}, user_id: {user_id}")
 
         # 認証済みユーザーの場合、ユーザー別のセッションIDを使用
         if user_id:
             session_id = f"user_{user_id}"
-
-        # 1. プロンプト構築
-        prompt = build_prompt(personality, message)
-        logger.info(f"Generated prompt: {prompt}")
-
-        # 2. Gemini API 呼び出し
-        try:
-            ai_start_time = time.time()
-            response = primary_model.generate_content(prompt)
-            response_text = response.text
-            logger.info(f"Gemini response received: '{response_text}'")
-            logger.info(f"[PERF] Gemini response time: {time.time() - ai_start_time:.2f}s")
-        except Exception as e:
-            logger.error(f"Gemini API call failed: {e}")
-            # フォールバックモデルを試行
-            try:
-                logger.warning("Attempting to use fallback model.")
-                response = fallback_model.generate_content(prompt)
-                response_text = response.text
-            except Exception as fallback_e:
-                logger.error(f"Fallback model also failed: {fallback_e}")
-                response_text = "ごめん！ちょっと喉の調子が悪くて、うまく声が出せないみたい！もう一回お願いしてもいい？"
-
-        # 3. 感情分析
-        user_emotion = analyze_emotion_simple(message)
-        response_emotion = analyze_emotion_simple(response_text)
-
-        # 4. 音声合成 (TTS)
-        audio_data = None
-        if response_text:
-            try:
-                tts_start_time = time.time()
-                # キャラクター別の音声を常に使用（ユーザー指定の voice_id は無視）
-                effective_voice_id = TTSManager.get_character_voice_id(personality)
-                audio_data = tts_manager.synthesize_speech_optimized(
-                    response_text, 
-                    voice_id=effective_voice_id, 
-                    personality=personality
-                )
-                logger.info(f"[PERF] TTS synthesis time: {time.time() - tts_start_time:.2f}s")
-                logger.info(f"[DEBUG] Used voice ID: {effective_voice_id} for personality: {personality}")
-            except Exception as e:
-                logger.error(f"TTS synthesis failed: {e}")
         
-        # 5. 会話履歴の保存
-        try:
-            memory_manager.save_message(session_id, 'user', message, user_emotion)
-            memory_manager.save_message(session_id, 'assistant', response_text, response_emotion)
-        except Exception as e:
-            logger.error(f"Failed to save conversation history: {e}")
-
-        # 6. クライアントに応答を送信
-        socketio.emit('message_response', {
-            'text': response_text,
-            'emotion': response_emotion,
-            'user_emotion': user_emotion,
-            'audio_data': audio_data,
-            'timestamp': datetime.now().isoformat(),
-            'personality': personality,
-        })
+        # 応答イベントの送信先をこの接続（またはユーザーのルーム）に限定
+        if session_router.bind_session(session_id, request.sid) is None:
+            logger.warning(f"Session {session_id} is bound to another connection; rejecting message")
+            emit('error', {'message': 'この会話は別の画面で使用中です。ページを再読み込みしてください。'})
+            trace.complete('response')
+            return
+        trace.session_id = session_id
+
+        with trace.span('prepare'):
+            # 選択中のキャラクターのプロンプト（本人所有のキャラクターのみ）
+            character_prompt = None
+            character_id = data.get('character_id')
+            if user_id and isinstance(character_id, int):
+                character = user_model.get_character_by_id(character_id)
+                if character and character['user_id'] == user_id:
+                    character_prompt = character['prompt']
+            
+            # 記憶機能の設定（認証済みユーザーのみ設定を参照）
+            use_memory = True
+            if user_id:
+                settings = user_model.get_user_settings(user_id)
+                use_memory = settings['memoryEnabled'] if settings else True
+
+        # ストリーミング応答生成（テキスト送信 → 音声合成 → 履歴保存 → 完了通知）
+        ai_manager.generate_response_streaming(
+            session_id, message, personality, turn_id=trace.turn_id,
+            character_prompt=character_prompt, use_memory=use_memory, trace=trace
+        )
 
-        logger.info(f"[PERF] Total processing time: {time.time() - start_time:.2f}s")
+        RESPONSE_STAGE_SECONDS.labels('handle_message').observe(time.time() - start_time)
 
     except Exception as e:
         logger.error(f"An error occurred in handle_message: {e}")
         emit('error', {'message': 'メッセージの処理中に予期せぬエラーが発生しました。'})
+        trace.complete('response')
+
+@socketio.on('audio_upload_chunk')
+def handle_audio_upload_chunk(data):
+    """録音中の音声チャンクを受信（バイナリ添付）"""
+    try:
+        upload_id = str(data.get('upload_id', ''))
+        seq = int(data.get('seq', -1))
+        chunk = data.get('data')
+        
+        if not upload_id or seq < 0 or not isinstance(chunk, (bytes, bytearray)):
+            return
+        
+        audio_upload_manager.append(request.sid, upload_id, seq, bytes(chunk))
+    
+    except AudioUploadError as e:
+        # 以降のチャンクは破棄し、クライアントへのエラーは確定時（send_audio）に一度だけ返す
+        logger.warning(f"Audio upload {upload_id} rejected: {e}")
+    
+    except Exception as e:
+        logger.error(f"Error handling audio upload chunk: {e}")
 
 @socketio.on('send_audio')
 def handle_audio(data):
-    """音声メッセージ受信時の処理 - シンプル版"""
+    """音声メッセージ受信時の処理 - バイナリ添付/分割アップロード対応版"""
     try:
-        session_id = data.get('session_id', 'default')
-        # フロントエンドから送られてくるのは16進数文字列なので、バイナリに戻す
-        audio_hex = data.get('audio_data', '')
+        session_id = data.get('session_id')
         personality = data.get('personality', 'yui_natural')
         # voice_id は削除 - キャラクター別音声を常に使用
-
-        if not audio_hex:
+        
+        upload_id = data.get('upload_id')
+        raw_audio = data.get('audio_data')
+        
+        if upload_id:
+            # 録音中に分割送信されたチャンクを組み立てる
+            try:
+                audio_data = audio_upload_manager.assemble(request.sid, str(upload_id), data.get('total_chunks'))
+            except AudioUploadError as e:
+                emit('error', {'message': str(e)})
+                return
+        elif isinstance(raw_audio, (bytes, bytearray)):
+            # Socket.IOのバイナリ添付
+            audio_data = bytes(raw_audio)
+        elif isinstance(raw_audio, str) and raw_audio:
+            # 旧クライアント向け：16進数文字列（上限を超えるものは変換前に拒否）
+            if len(raw_audio) > MAX_AUDIO_UPLOAD_BYTES * 2:
+                emit('error', {'message': '録音が長すぎます。もう少し短くお話しください。'})
+                return
+            audio_data = bytes.fromhex(raw_audio)
+        else:
+            audio_data = None
+        
+        if not audio_data:
             return
-
-        audio_data = bytes.fromhex(audio_hex)
         
-        # 音声認識 (STT)
-        transcribed_text = asyncio.run(stt_manager.transcribe_audio(audio_data))
+        if len(audio_data) > MAX_AUDIO_UPLOAD_BYTES:
+            emit('error', {'message': '録音が長すぎます。もう少し短くお話しください。'})
+            return
+        
+        # 音声認識 (STT) - トレースは受信時点から計測
+        trace = tracer.start_turn()
+        with trace.span('stt', audio_bytes=len(audio_data)):
+            transcribed_text = stt_manager.transcribe_audio(audio_data)
         
         if not transcribed_text:
             emit('error', {'message': 'ごめんなさい、うまく聞き取れませんでした。'})
+            trace.complete('response')
             return
 
         # テキストが認識されたら、通常のメッセージ処理に渡す
-        handle_message({
+        process_message({
             'session_id': session_id,
             'message': transcribed_text,
-            'personality': personality
-        })
+            'personality': personality,
+            'character_id': data.get('character_id')
+        }, trace)
 
     except Exception as e:
         logger.error(f"Error handling audio: {e}")
         emit('error', {'message': '音声の処理中にエラーが発生しました。'})
 
+@app.route('/api/metrics')
+def metrics_endpoint():
+    """メトリクスを Prometheus のテキスト形式で返す"""
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/api/traces')
+@token_required
+def list_traces(current_user):
+    """自分のセッションの直近のターンのトレースを新しい順に返す"""
+    session_id = f"user_{current_user['user_id']}"
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 200)
+    return jsonify({'traces': trace_buffer.recent(limit, session_id=session_id)})
+
+@app.route('/api/traces/<turn_id>')
+@token_required
+def get_trace(current_user, turn_id):
+    """ターンIDを指定して自分のセッションのトレースを返す"""
+    trace = trace_buffer.get(turn_id, session_id=f"user_{current_user['user_id']}")
+    if trace is None:
+        return jsonify({'error': 'トレースが見つかりません'}), 404
+    return jsonify(trace)
+
 @app.route('/api/health')
 def health_check():
     """ヘルスチェックエンドポイント"""
-    return jsonify({'status': 'healthy', 'timestamp': datetime.now().isoformat()})
+    return jsonify({
+        'status': 'healthy',
+        'timestamp': datetime.now().isoformat(),
+        'gemini': gemini_client.get_stats(),
+        'character_models': character_models.get_stats(),
+        'entity_cache': user_model.get_cache_stats(),
+        'password_hasher': get_password_hasher().get_stats(),
+        'auth_token_cache': auth_manager.get_token_cache_stats(),
+        'database': memory_manager.db.get_stats(),
+        'conversation_journal': memory_manager.journal.get_stats(),
+        'refresh_token_sweeper': refresh_token_sweeper.get_stats(),
+        'conversation_memory': ai_manager.conversation_memory.get_stats(),
+        'audio_cache': voice_service.get_cache_stats(),
+        'tracing': tracer.get_stats()
+    })
 
 if __name__ != '__main__':
     # Vercel環境での起動
@@ -4,7 +4,10 @@
 import jwt
 import hashlib
 import secrets
-from datetime import datetime, timedelta
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
 from typing import Optional, Dict
 from functools import wraps
 from flask import request, jsonify
@@ -16,12 +19,20 @@ logger = logging.getLogger(__name__)
 class AuthManager:
     """JWT認証マネージャークラス"""
     
-    def __init__(self, secret_key: str, user_model):
+    def __init__(self, secret_key: str, user_model, token_cache_size: int = 10000):
         self.secret_key = secret_key
         self.user_model = user_model
         self.algorithm = 'HS256'
         self.access_token_expire_minutes = 15
         self.refresh_token_expire_days = 30
+        
+        # 検証済みアクセストークンのキャッシュ（トークンのダイジェスト -> (exp, user_id, 検証結果)）
+        self.token_cache_size = token_cache_size
+        self._token_cache: OrderedDict = OrderedDict()
+        self._token_cache_lock = threading.Lock()
+        # ユーザーごとの失効時刻（これより前に発行されたアクセストークンは拒否、失効した順に並ぶ）
+        self._revoked_before: OrderedDict = OrderedDict()
+        self.token_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
     
     def generate_access_token(self, user_id: int, email: str) -> str:
         """アクセストークンを生成"""
@@ -53,7 +64,22 @@ class AuthManager:
         return token
     
     def verify_access_token(self, token: str) -> Optional[Dict]:
-        """アクセストークンを検証"""
+        """アクセストークンを検証（検証済みトークンはexpまでキャッシュ）"""
+        cache_key = hashlib.sha256(token.encode()).digest()
+        now = time.time()
+        
+        with self._token_cache_lock:
+            cached = self._token_cache.get(cache_key)
+            if cached is not None:
+                exp, _, result = cached
+                if exp > now:
+                    self._token_cache.move_to_end(cache_key)
+                    self.token_cache_stats['hits'] += 1
+                    return dict(result)
+                # トークン自体の有効期限切れ
+                del self._token_cache[cache_key]
+            self.token_cache_stats['misses'] += 1
+        
         try:
             payload = jwt.decode(token, self.secret_key, algorithms=[self.algorithm])
             
@@ -61,11 +87,28 @@ class AuthManager:
             if payload.get('type') != 'access':
                 return None
             
-            return {
+            # 失効済みユーザーのトークンチェック
+            with self._token_cache_lock:
+                self._prune_revocations(now)
+                revoked_before = self._revoked_before.get(payload['user_id'])
+            if revoked_before is not None and payload.get('iat', 0) < revoked_before:
+                logger.warning("Access token revoked")
+                return None
+            
+            result = {
                 'user_id': payload['user_id'],
                 'email': payload['email']
             }
             
+            with self._token_cache_lock:
+                self._token_cache[cache_key] = (payload['exp'], payload['user_id'], result)
+                self._token_cache.move_to_end(cache_key)
+                while len(self._token_cache) > self.token_cache_size:
+                    self._token_cache.popitem(last=False)
+                    self.token_cache_stats['evictions'] += 1
+            
+            return dict(result)
+            
         except jwt.ExpiredSignatureError:
             logger.warning("Access token expired")
             return None
@@ -104,6 +147,42 @@ class AuthManager:
             
         except Exception as e:
             logger.error(f"Failed to revoke all user tokens: {e}")
+        
+        self.invalidate_user_access_tokens(user_id)
+    
+    def invalidate_user_access_tokens(self, user_id: int):
+        """ユーザーの発行済みアクセストークンを失効させ、キャッシュから削除"""
+        now = int(time.time())
+        
+        with self._token_cache_lock:
+            self._prune_revocations(now)
+            # iatは秒単位のため、同じ秒に再発行されるトークン（ログイン直後）は有効のまま残す
+            self._revoked_before[user_id] = now
+            self._revoked_before.move_to_end(user_id)
+            
+            stale_keys = [key for key, (_, cached_user_id, _) in self._token_cache.items() if cached_user_id == user_id]
+            for key in stale_keys:
+                del self._token_cache[key]
+            self.token_cache_stats['invalidations'] += len(stale_keys)
+    
+    def _prune_revocations(self, now: float):
+        """アクセストークンの有効期間を過ぎた失効記録を削除（_token_cache_lock保持中に呼ぶ）
+        
+        失効時刻より前に発行されたトークンは有効期間が過ぎればexpで弾かれるため、記録は不要になる
+        """
+        lifetime = self.access_token_expire_minutes * 60
+        while self._revoked_before:
+            user_id, revoked_at = next(iter(self._revoked_before.items()))
+            if now - revoked_at < lifetime:
+                break
+            del self._revoked_before[user_id]
+    
+    def get_token_cache_stats(self) -> Dict:
+        """トークンキャッシュと失効記録の統計情報を取得"""
+        with self._token_cache_lock:
+            self._prune_revocations(time.time())
+            return dict(self.token_cache_stats, size=len(self._token_cache), max_size=self.token_cache_size,
+                        revoked_users=len(self._revoked_before))
     
     def refresh_access_token(self, refresh_token: str) -> Optional[Dict]:
         """リフレッシュトークンを使って新しいアクセストークンを生成"""
@@ -127,6 +206,54 @@ class AuthManager:
         }
 
 
+class RefreshTokenSweeper:
+    """期限切れリフレッシュトークンを定期的に削除するバックグラウンドワーカー"""
+    
+    def __init__(self, user_model, interval_seconds: float = 3600, batch_size: int = 500):
+        self.user_model = user_model
+        self.interval_seconds = interval_seconds
+        self.batch_size = batch_size
+        
+        self._stop_event = threading.Event()
+        self._worker: Optional[threading.Thread] = None
+        self.stats = {'runs': 0, 'deleted': 0, 'last_run_at': None, 'last_duration_ms': 0.0}
+    
+    def start(self):
+        """掃除ワーカーを起動"""
+        if self._worker is not None:
+            return
+        # geventのモンキーパッチ下ではグリーンレットとして動作する
+        self._worker = threading.Thread(target=self._run, name='refresh-token-sweeper', daemon=True)
+        self._worker.start()
+    
+    def _run(self):
+        """一定間隔で掃除を実行（停止要求まで）"""
+        while not self._stop_event.wait(self.interval_seconds):
+            self.sweep()
+    
+    def sweep(self) -> int:
+        """期限切れトークンを一括削除"""
+        started = time.perf_counter()
+        deleted = self.user_model.delete_expired_refresh_tokens(batch_size=self.batch_size)
+        
+        self.stats['runs'] += 1
+        self.stats['deleted'] += deleted
+        self.stats['last_run_at'] = datetime.now(timezone.utc).isoformat()
+        self.stats['last_duration_ms'] = round((time.perf_counter() - started) * 1000, 2)
+        
+        if deleted:
+            logger.info(f"Swept {deleted} expired refresh tokens")
+        return deleted
+    
+    def stop(self):
+        """掃除ワーカーを停止"""
+        self._stop_event.set()
+    
+    def get_stats(self) -> Dict:
+        """掃除の統計情報を取得"""
+        return dict(self.stats)
+
+
 def token_required(f):
     """
     デコレーター: アクセストークン認証が必要なエンドポイント用
@@ -0,0 +1,187 @@
+"""
+会話ジャーナル - 会話履歴のライトビハインド一括書き込み
+"""
+import queue
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ConversationJournal:
+    """会話メッセージをメモリキューに積み、バックグラウンドでまとめてDBに書き込むクラス"""
+
+    def __init__(self, database, flush_interval_ms: int = 200, batch_size: int = 100,
+                 max_queue_size: int = 10000, put_timeout: float = 5.0,
+                 write_retries: int = 3, retry_backoff: float = 0.1):
+        self.database = database
+        self.flush_interval = flush_interval_ms / 1000
+        self.batch_size = batch_size
+        self.put_timeout = put_timeout
+        self.write_retries = write_retries
+        self.retry_backoff = retry_backoff
+
+        # 上限付きキュー（満杯時は投入側を待たせてバックプレッシャーをかける）
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._write_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._worker: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._closed = False
+
+        # 投入側とワーカーの両方から更新されるため専用のロックで保護する
+        self._stats_lock = threading.Lock()
+        self.stats = {
+            'enqueued': 0,
+            'written': 0,
+            'batches': 0,
+            'sync_fallbacks': 0,
+            'retries': 0,
+            'row_fallbacks': 0,
+            'failed': 0
+        }
+
+    def _count(self, name: str, amount: int = 1):
+        """統計カウンタを加算"""
+        with self._stats_lock:
+            self.stats[name] += amount
+
+    def _ensure_worker(self):
+        """書き込みワーカーを起動（初回のみ）"""
+        if self._worker is not None:
+            return
+        with self._start_lock:
+            if self._worker is None:
+                # geventのモンキーパッチ下ではグリーンレットとして動作する
+                self._worker = threading.Thread(target=self._run, name='conversation-journal', daemon=True)
+                self._worker.start()
+
+    def append(self, session_id: str, role: str, content: str, emotion: str = None):
+        """メッセージをジャーナルに追加"""
+        self.append_many([(session_id, role, content, emotion)])
+
+    def append_many(self, messages: List[Tuple[str, str, str, Optional[str]]]):
+        """複数メッセージを順序を保ってジャーナルに追加"""
+        # CURRENT_TIMESTAMPと同じ形式（UTC）で受付時刻を記録
+        timestamp = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        rows = [(session_id, role, content, emotion, timestamp) for session_id, role, content, emotion in messages]
+
+        if self._closed:
+            self._write(rows)
+            return
+
+        self._ensure_worker()
+        for index, row in enumerate(rows):
+            try:
+                self._queue.put(row, timeout=self.put_timeout)
+                self._count('enqueued')
+            except queue.Full:
+                # 書き込みが追いつかない場合は取りこぼさないよう同期書き込みに切り替える
+                # （先に積まれた行より前に書かないよう、キューが書き込まれるのを待ってから）
+                logger.warning("Conversation journal queue is full, writing synchronously")
+                self._count('sync_fallbacks')
+                self.flush()
+                self._write(rows[index:])
+                return
+
+    def _run(self):
+        """一定間隔または一定件数ごとにキューをまとめて書き込む（停止要求後はキューを空にしてから終了）"""
+        while True:
+            try:
+                row = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                if self._stop.is_set():
+                    break
+                continue
+
+            batch = [row]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    row = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(row)
+
+            self._write(batch)
+            for _ in batch:
+                self._queue.task_done()
+
+    def _insert(self, rows: List[Tuple]):
+        """行を1トランザクションで挿入"""
+        with self.database.connection() as conn:
+            conn.executemany('''
+                INSERT INTO conversations (session_id, role, content, emotion, timestamp)
+                VALUES (?, ?, ?, ?, ?)
+            ''', rows)
+            conn.commit()
+
+    def _write(self, rows: List[Tuple]):
+        """1トランザクションでまとめて書き込み（失敗時は間隔を空けて再試行し、最後は1行ずつ書き込む）"""
+        if not rows:
+            return
+        with self._write_lock:
+            for attempt in range(self.write_retries):
+                try:
+                    self._insert(rows)
+                    self._count('written', len(rows))
+                    self._count('batches')
+                    return
+                except sqlite3.OperationalError as e:
+                    # ロック競合などの一時的なエラーは待てば解消する
+                    logger.warning(f"Failed to write conversation batch ({len(rows)} rows, attempt {attempt + 1}): {e}")
+                    if attempt + 1 < self.write_retries:
+                        self._count('retries')
+                        time.sleep(self.retry_backoff * (2 ** attempt))
+                except sqlite3.Error as e:
+                    # 制約違反などは再試行しても変わらない
+                    logger.warning(f"Failed to write conversation batch ({len(rows)} rows): {e}")
+                    break
+
+            # 特定の行が原因の場合に他の行を巻き添えにしないよう1行ずつ書き込む
+            self._count('row_fallbacks')
+            for row in rows:
+                try:
+                    self._insert([row])
+                    self._count('written')
+                except sqlite3.Error as e:
+                    self._count('failed')
+                    logger.error(f"Failed to write conversation message for session {row[0]} ({row[1]}): {e}")
+
+    def flush(self):
+        """キュー内のメッセージがすべて書き込まれるまで待機"""
+        if self._worker is not None:
+            self._queue.join()
+
+    def close(self):
+        """ワーカーを停止し、残りのメッセージを書き込む（シャットダウン時）"""
+        if self._closed:
+            return
+        self._closed = True
+
+        # キューが満杯でもブロックしないよう、番兵ではなくイベントで停止を伝える
+        self._stop.set()
+        if self._worker is not None:
+            self._worker.join(timeout=max(self.put_timeout, 1.0))
+
+        # ワーカーが処理しきれなかった分を同期的に書き込む
+        remaining = []
+        while True:
+            try:
+                remaining.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+            self._queue.task_done()
+        self._write(remaining)
+
+    def get_stats(self) -> Dict:
+        """ジャーナルの統計情報を取得"""
+        with self._stats_lock:
+            return dict(self.stats, queue_depth=self._queue.qsize())
@@ -0,0 +1,218 @@
+"""
+会話メモリ - トークン予算付きの直近履歴と逐次更新される要約
+"""
+import json
+import math
+import threading
+from collections import OrderedDict, deque
+from datetime import datetime
+from typing import Callable, Dict, List, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_tokens(text: str) -> int:
+    """トークン数の概算（日本語は1文字≒1トークン、英語は4文字≒1トークン程度）"""
+    return math.ceil(len(text.encode('utf-8')) / 3) if text else 0
+
+
+class _SessionMemory:
+    """1セッション分のメモリ状態"""
+
+    def __init__(self):
+        self.summary = ''
+        self.recent: deque = deque()
+        self.recent_tokens = 0
+        # 直近ウィンドウから押し出され、まだ要約に反映されていないターン
+        self.pending: List[Tuple[str, str]] = []
+        self.summarizing = False
+        self.loaded = False
+        self.lock = threading.Lock()
+
+
+class ConversationMemory:
+    """
+    プロンプトサイズを一定に保つ会話メモリ
+
+    直近のターンは予算内で原文のまま、予算からあふれた古いターンは
+    バックグラウンドで要約に畳み込み、user_info.context_data に保存する
+    """
+
+    SUMMARY_PROMPT = '''以下は、マスターとAIキャラクターの会話の「これまでの要約」と「その続きの会話」です。
+マスターの名前・好み・予定・出来事・約束など、今後の会話で必要になる事実を優先して残し、
+{max_chars}文字以内の日本語の要約に更新してください。要約本文のみを出力してください。
+
+[これまでの要約]
+{summary}
+
+[続きの会話]
+{turns}'''
+
+    def __init__(self, memory_manager, summarizer: Callable[[str], str],
+                 recent_token_budget: int = 1500, summary_token_budget: int = 400,
+                 max_sessions: int = 1000, max_pending_turns: int = 20):
+        self.memory_manager = memory_manager
+        self.summarizer = summarizer
+        self.recent_token_budget = recent_token_budget
+        self.summary_token_budget = summary_token_budget
+        self.max_sessions = max_sessions
+        self.max_pending_turns = max_pending_turns
+
+        self._sessions: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'loads': 0, 'summaries': 0, 'summary_failures': 0, 'dropped_turns': 0}
+
+    @staticmethod
+    def _turn_tokens(turn: Tuple[str, str]) -> int:
+        return estimate_tokens(turn[0]) + estimate_tokens(turn[1])
+
+    def _get_session(self, session_id: str) -> _SessionMemory:
+        """セッションのメモリを取得（初回はDBから復元）"""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+            else:
+                session = _SessionMemory()
+                self._sessions[session_id] = session
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+
+        with session.lock:
+            if not session.loaded:
+                self._load(session_id, session)
+                session.loaded = True
+        return session
+
+    def _load(self, session_id: str, session: _SessionMemory):
+        """保存済みの要約と直近の履歴から状態を復元"""
+        self.stats['loads'] += 1
+
+        context_data = self.memory_manager.get_user_info(session_id).get('context_data')
+        if context_data:
+            try:
+                session.summary = json.loads(context_data).get('summary', '')
+            except (ValueError, AttributeError):
+                logger.warning(f"Ignoring malformed context_data for session {session_id}")
+
+        # 新しいものから予算に収まる分だけ直近ウィンドウに入れる
+        history = self.memory_manager.get_conversation_history(session_id, limit=40)
+        turns = []
+        user_text = None
+        for message in history:
+            if message['role'] == 'user':
+                user_text = message['content']
+            elif message['role'] == 'assistant' and user_text is not None:
+                turns.append((user_text, message['content']))
+                user_text = None
+
+        for turn in reversed(turns):
+            tokens = self._turn_tokens(turn)
+            if session.recent_tokens + tokens > self.recent_token_budget:
+                break
+            session.recent.appendleft(turn)
+            session.recent_tokens += tokens
+
+    def build_contents(self, session_id: str, user_input: str) -> List[Dict]:
+        """
+        Gemini に渡す会話コンテンツを構築
+
+        要約 + 直近ターン（原文）+ 今回の発話。ペルソナはシステム指示側に含まれる
+        """
+        session = self._get_session(session_id)
+        with session.lock:
+            summary = session.summary
+            recent = list(session.recent)
+
+        contents = []
+        for user_text, assistant_text in recent:
+            contents.append({'role': 'user', 'parts': [user_text]})
+            contents.append({'role': 'model', 'parts': [assistant_text]})
+        contents.append({'role': 'user', 'parts': [user_input]})
+
+        if summary:
+            # 要約は時系列の先頭に置く
+            first = contents[0]
+            first['parts'] = [f"（これまでの会話の要約）\n{summary}\n\n{first['parts'][0]}"]
+
+        return contents
+
+    def record_turn(self, session_id: str, user_input: str, response: str):
+        """ターンを追加し、予算からあふれた分の要約をバックグラウンドで開始"""
+        session = self._get_session(session_id)
+        turn = (user_input, response)
+
+        with session.lock:
+            session.recent.append(turn)
+            session.recent_tokens += self._turn_tokens(turn)
+
+            while session.recent_tokens > self.recent_token_budget and len(session.recent) > 1:
+                evicted = session.recent.popleft()
+                session.recent_tokens -= self._turn_tokens(evicted)
+                session.pending.append(evicted)
+
+            if len(session.pending) > self.max_pending_turns and not session.summarizing:
+                # 要約が失敗し続けている場合は古いものから諦める
+                dropped = len(session.pending) - self.max_pending_turns
+                del session.pending[:dropped]
+                self.stats['dropped_turns'] += dropped
+
+            if not session.pending or session.summarizing:
+                return
+            session.summarizing = True
+
+        # geventのモンキーパッチ下ではグリーンレットとして動作する
+        threading.Thread(target=self._summarize, args=(session_id, session), name='conversation-summary', daemon=True).start()
+
+    def _summarize(self, session_id: str, session: _SessionMemory):
+        """保留中のターンを要約に畳み込み、context_data に保存"""
+        while True:
+            with session.lock:
+                if not session.pending:
+                    session.summarizing = False
+                    return
+                summary = session.summary
+                turns = list(session.pending)
+
+            max_chars = self.summary_token_budget
+            prompt = self.SUMMARY_PROMPT.format(
+                max_chars=max_chars,
+                summary=summary or '（なし）',
+                turns='\n'.join(f"マスター: {u}\nキャラクター: {a}" for u, a in turns)
+            )
+
+            try:
+                new_summary = (self.summarizer(prompt) or '').strip()
+            except Exception as e:
+                self.stats['summary_failures'] += 1
+                logger.warning(f"Conversation summary failed for session {session_id}: {e}")
+                with session.lock:
+                    session.summarizing = False
+                return
+
+            if not new_summary:
+                self.stats['summary_failures'] += 1
+                with session.lock:
+                    session.summarizing = False
+                return
+
+            # モデルが指示を超えて長く返した場合も予算内に収める
+            while estimate_tokens(new_summary) > self.summary_token_budget:
+                new_summary = new_summary[:int(len(new_summary) * 0.9)]
+
+            with session.lock:
+                session.summary = new_summary
+                del session.pending[:len(turns)]
+            self.stats['summaries'] += 1
+
+            self.memory_manager.save_context_data(session_id, json.dumps({
+                'summary': new_summary,
+                'updated_at': datetime.utcnow().isoformat()
+            }, ensure_ascii=False))
+
+    def get_stats(self) -> Dict:
+        """メモリの統計情報を取得"""
+        with self._lock:
+            sessions = len(self._sessions)
+        return dict(self.stats, sessions=sessions)
@@ -0,0 +1,147 @@
+"""
+データベース接続プール - SQLite共有ストレージ層
+"""
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict
+import logging
+
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+DB_CONNECTION_SECONDS = metrics.histogram(
+    'db_connection_hold_seconds', 'Time a pooled database connection is held (queries and commit)',
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+)
+DB_CONNECTIONS_CREATED = metrics.counter('db_connections_created_total', 'Database connections opened by the pool')
+
+
+class Database:
+    """SQLite接続プール（WALモード・チューニング済みPRAGMA）"""
+
+    def __init__(self, db_path: str, pool_size: int = 8, busy_timeout_ms: int = 5000,
+                 cache_size_kb: int = 16384, mmap_size: int = 256 * 1024 * 1024,
+                 statement_cache_size: int = 256):
+        self.db_path = db_path
+        self.pool_size = pool_size
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+        self.statement_cache_size = statement_cache_size
+
+        # 貸し出し可能な接続（直近に返却された接続を優先して再利用）
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        self._lock = threading.Lock()
+        self._created = 0
+
+    def _create_connection(self) -> sqlite3.Connection:
+        """新しい接続を作成してPRAGMAを適用"""
+        if self.db_path == ':memory:':
+            # インメモリDBは接続ごとに別DBになるため共有キャッシュで1つのDBを共有する
+            conn = sqlite3.connect(
+                'file:v_mate_memory?mode=memory&cache=shared',
+                uri=True,
+                timeout=self.busy_timeout_ms / 1000,
+                check_same_thread=False,
+                cached_statements=self.statement_cache_size
+            )
+        else:
+            conn = sqlite3.connect(
+                self.db_path,
+                timeout=self.busy_timeout_ms / 1000,
+                check_same_thread=False,
+                cached_statements=self.statement_cache_size
+            )
+
+        cursor = conn.cursor()
+        # WAL: 書き込み中も読み込みをブロックしない
+        cursor.execute('PRAGMA journal_mode=WAL')
+        # WALモードではNORMALでも整合性は保たれ、コミットごとのfsyncを省ける
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute(f'PRAGMA cache_size=-{int(self.cache_size_kb)}')
+        cursor.execute(f'PRAGMA mmap_size={int(self.mmap_size)}')
+        cursor.execute(f'PRAGMA busy_timeout={int(self.busy_timeout_ms)}')
+        cursor.execute('PRAGMA temp_store=MEMORY')
+        cursor.close()
+
+        with self._lock:
+            self._created += 1
+        DB_CONNECTIONS_CREATED.inc()
+
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        """プールから接続を取得（空なら新規作成）"""
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return self._create_connection()
+
+    def release(self, conn: sqlite3.Connection):
+        """接続をプールに返却（未確定のトランザクションは破棄）"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+        except sqlite3.Error as e:
+            logger.warning(f"Discarding broken database connection: {e}")
+            conn.close()
+
+    @contextmanager
+    def connection(self):
+        """接続を借用するコンテキストマネージャー（グリーンレット/スレッドごとに専有）"""
+        conn = self.acquire()
+        started = time.perf_counter()
+        try:
+            yield conn
+        finally:
+            DB_CONNECTION_SECONDS.observe(time.perf_counter() - started)
+            self.release(conn)
+
+    def close_all(self):
+        """プール内の全接続を閉じる"""
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def get_stats(self) -> Dict:
+        """プールの統計情報を取得"""
+        return {
+            'pool_size': self.pool_size,
+            'idle_connections': self._pool.qsize(),
+            'created_connections': self._created
+        }
+
+
+# パスごとの共有インスタンス
+_databases: Dict[str, Database] = {}
+_databases_lock = threading.Lock()
+
+
+def get_database(db_path: str) -> Database:
+    """
+    データベースパスに対応する共有接続プールを取得
+
+    MemoryManagerとUserが同じファイルを使う場合は同じプールを共有する
+    """
+    key = db_path if db_path == ':memory:' else os.path.abspath(db_path)
+
+    with _databases_lock:
+        database = _databases.get(key)
+        if database is None:
+            database = Database(
+                key,
+                pool_size=int(os.getenv('DB_POOL_SIZE', '8')),
+                busy_timeout_ms=int(os.getenv('DB_BUSY_TIMEOUT_MS', '5000'))
+            )
+            _databases[key] = database
+        return database
@@ -0,0 +1,152 @@
+"""
+パスワードハッシャー - bcryptをOSスレッドプールで実行
+"""
+import os
+import threading
+import time
+from typing import Dict, Optional
+import logging
+
+import bcrypt
+
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+BCRYPT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BCRYPT_WAIT_SECONDS = metrics.histogram('bcrypt_wait_seconds', 'Time bcrypt jobs wait for a hashing thread',
+                                        buckets=BCRYPT_BUCKETS)
+BCRYPT_RUN_SECONDS = metrics.histogram('bcrypt_run_seconds', 'Time a bcrypt hash or check runs on its thread',
+                                       buckets=BCRYPT_BUCKETS)
+BCRYPT_PENDING = metrics.gauge('bcrypt_pending', 'bcrypt jobs queued or running')
+BCRYPT_REQUESTS = metrics.counter('bcrypt_requests_total', 'bcrypt hash and check requests by outcome', ['outcome'])
+
+
+class PasswordHasherBusyError(Exception):
+    """ハッシュ処理の待ち行列が上限に達している"""
+    pass
+
+
+class PasswordHasher:
+    """
+    bcryptのハッシュ化・検証をイベントループ外のOSスレッドで実行するクラス
+
+    geventのモンキーパッチ下ではthreading.Threadもグリーンレットになるため、
+    geventのネイティブスレッドプールを使用する（bcryptはGILを解放する）
+    """
+
+    def __init__(self, max_workers: int = 2, max_pending: int = 32, rounds: int = 12):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.rounds = rounds
+
+        self._pool = self._create_pool(max_workers)
+        self._lock = threading.Lock()
+        self._pending = 0
+
+        self.stats = {
+            'submitted': 0,
+            'completed': 0,
+            'rejected': 0,
+            'failed': 0,
+            'total_wait_ms': 0.0,
+            'max_wait_ms': 0.0,
+            'total_run_ms': 0.0
+        }
+        BCRYPT_PENDING.set_function(lambda: self._pending)
+
+    @staticmethod
+    def _create_pool(max_workers: int):
+        """実行環境に応じたスレッドプールを作成"""
+        try:
+            from gevent import monkey
+            if monkey.is_module_patched('threading'):
+                from gevent.threadpool import ThreadPool
+                return ThreadPool(max_workers)
+        except ImportError:
+            pass
+
+        from concurrent.futures import ThreadPoolExecutor
+        return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='bcrypt')
+
+    def _run(self, func, *args):
+        """待ち行列の上限を確認してからプールで実行し、結果を待つ"""
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.stats['rejected'] += 1
+                BCRYPT_REQUESTS.labels('rejected').inc()
+                raise PasswordHasherBusyError(f"Password hashing queue is full ({self.max_pending})")
+            self._pending += 1
+            self.stats['submitted'] += 1
+
+        submitted_at = time.perf_counter()
+        timings = {}
+
+        def task():
+            started_at = time.perf_counter()
+            timings['wait_ms'] = (started_at - submitted_at) * 1000
+            result = func(*args)
+            timings['run_ms'] = (time.perf_counter() - started_at) * 1000
+            return result
+
+        try:
+            if hasattr(self._pool, 'spawn'):
+                # gevent ThreadPool: AsyncResult.get() は他のグリーンレットをブロックしない
+                return self._pool.spawn(task).get()
+            return self._pool.submit(task).result()
+        except Exception:
+            with self._lock:
+                self.stats['failed'] += 1
+            BCRYPT_REQUESTS.labels('failed').inc()
+            raise
+        finally:
+            with self._lock:
+                self._pending -= 1
+                if 'run_ms' in timings:
+                    self.stats['completed'] += 1
+                    self.stats['total_wait_ms'] += timings['wait_ms']
+                    self.stats['max_wait_ms'] = max(self.stats['max_wait_ms'], timings['wait_ms'])
+                    self.stats['total_run_ms'] += timings['run_ms']
+            if 'run_ms' in timings:
+                BCRYPT_REQUESTS.labels('completed').inc()
+                BCRYPT_WAIT_SECONDS.observe(timings['wait_ms'] / 1000)
+                BCRYPT_RUN_SECONDS.observe(timings['run_ms'] / 1000)
+
+    def hash_password(self, password: str) -> bytes:
+        """パスワードをハッシュ化"""
+        return self._run(lambda: bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=self.rounds)))
+
+    def check_password(self, password: str, password_hash: bytes) -> bool:
+        """パスワードを検証"""
+        return self._run(lambda: bcrypt.checkpw(password.encode('utf-8'), password_hash))
+
+    def get_stats(self) -> Dict:
+        """ハッシュ処理の統計情報を取得"""
+        with self._lock:
+            completed = self.stats['completed']
+            return dict(
+                self.stats,
+                pending=self._pending,
+                max_workers=self.max_workers,
+                max_pending=self.max_pending,
+                avg_wait_ms=round(self.stats['total_wait_ms'] / completed, 2) if completed else 0.0,
+                avg_run_ms=round(self.stats['total_run_ms'] / completed, 2) if completed else 0.0
+            )
+
+
+# 共有インスタンス
+_password_hasher: Optional[PasswordHasher] = None
+_password_hasher_lock = threading.Lock()
+
+
+def get_password_hasher() -> PasswordHasher:
+    """共有パスワードハッシャーを取得"""
+    global _password_hasher
+
+    with _password_hasher_lock:
+        if _password_hasher is None:
+            _password_hasher = PasswordHasher(
+                max_workers=int(os.getenv('BCRYPT_THREADS', '2')),
+                max_pending=int(os.getenv('BCRYPT_MAX_PENDING', '32'))
+            )
+        return _password_hasher
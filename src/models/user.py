@@ -2,135 +2,232 @@
 ユーザーモデル - データベーススキーマと操作
 """
 import sqlite3
-import bcrypt
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from typing import Optional, Dict, List
+from typing import Any, Callable, Optional, Dict, List
 import logging
 
+from models.database import get_database
+from models.password_hasher import get_password_hasher, PasswordHasherBusyError
+
 logger = logging.getLogger(__name__)
 
 
+class EntityCache:
+    """行データの読み取りキャッシュ（TTL付きLRU、更新時に明示的に無効化）"""
+    
+    def __init__(self, max_entries: int = 10000, ttl_seconds: float = 60):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        
+        # (名前空間, キー) -> (有効期限, 値)
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        # 無効化のたびに進める世代番号（読み込み中に無効化された古い値を格納しないため）
+        self.generation = 0
+        self.stats: Dict[str, Dict[str, int]] = {}
+    
+    @staticmethod
+    def _copy(value: Any) -> Any:
+        """呼び出し側での変更がキャッシュに波及しないようにコピー"""
+        if isinstance(value, list):
+            return [dict(item) for item in value]
+        if isinstance(value, dict):
+            return dict(value)
+        return value
+    
+    def _count(self, namespace: str, name: str):
+        counters = self.stats.setdefault(namespace, {'hits': 0, 'misses': 0, 'invalidations': 0})
+        counters[name] += 1
+    
+    def get(self, namespace: str, key: Any) -> Optional[Any]:
+        """キャッシュから取得（無い・期限切れの場合はNone）"""
+        with self._lock:
+            entry = self._entries.get((namespace, key))
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end((namespace, key))
+                    self._count(namespace, 'hits')
+                    return self._copy(value)
+                del self._entries[(namespace, key)]
+            self._count(namespace, 'misses')
+            return None
+    
+    def set(self, namespace: str, key: Any, value: Any, generation: int):
+        """読み込んだ値を格納（読み込み開始後に無効化があった場合は格納しない）"""
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[(namespace, key)] = (time.monotonic() + self.ttl_seconds, self._copy(value))
+            self._entries.move_to_end((namespace, key))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def invalidate(self, namespace: str, key: Any):
+        """1件を無効化"""
+        with self._lock:
+            self.generation += 1
+            if self._entries.pop((namespace, key), None) is not None:
+                self._count(namespace, 'invalidations')
+    
+    def invalidate_where(self, namespace: str, predicate: Callable[[Any], bool]):
+        """条件に一致する値をまとめて無効化"""
+        with self._lock:
+            self.generation += 1
+            stale_keys = [k for k, (_, value) in self._entries.items() if k[0] == namespace and predicate(value)]
+            for k in stale_keys:
+                del self._entries[k]
+                self._count(namespace, 'invalidations')
+    
+    def get_stats(self) -> Dict:
+        """名前空間ごとのヒット/ミス統計"""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl_seconds,
+                'namespaces': {namespace: dict(counters) for namespace, counters in self.stats.items()}
+            }
+
+
 class User:
     """ユーザーモデルクラス"""
     
-    def __init__(self, db_path: str):
+    def __init__(self, db_path: str, max_refresh_tokens_per_user: int = 10,
+                 cache_max_entries: int = 10000, cache_ttl_seconds: float = 60):
         self.db_path = db_path
+        # ユーザー・設定・キャラクターの読み取りキャッシュ
+        self.cache = EntityCache(cache_max_entries, cache_ttl_seconds)
+        # ユーザーごとに保持する有効なリフレッシュトークンの上限（古いものから削除）
+        self.max_refresh_tokens_per_user = max_refresh_tokens_per_user
+        # MemoryManagerと共有する接続プール
+        self.db = get_database(db_path)
+        # bcryptはイベントループ外のスレッドプールで実行
+        self.password_hasher = get_password_hasher()
         self.init_tables()
     
     def init_tables(self):
         """ユーザー関連テーブルの初期化"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            # ユーザーテーブル
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    username TEXT UNIQUE NOT NULL,
-                    email TEXT UNIQUE NOT NULL,
-                    password_hash TEXT,
-                    avatar_url TEXT,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    last_login DATETIME,
-                    is_active BOOLEAN DEFAULT 1,
-                    is_verified BOOLEAN DEFAULT 0
-                )
-            ''')
-            
-            # 既存テーブルへのカラム追加（マイグレーション）
-            self._migrate_users_table(cursor)
-            
-            # OAuthアカウントテーブル
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS oauth_accounts (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    provider TEXT NOT NULL,
-                    provider_user_id TEXT NOT NULL,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
-                    UNIQUE(provider, provider_user_id)
-                )
-            ''')
-            
-            # リフレッシュトークンテーブル
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS refresh_tokens (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    token_hash TEXT NOT NULL UNIQUE,
-                    expires_at DATETIME NOT NULL,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-                )
-            ''')
-            
-            # ユーザー設定テーブル
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS user_settings (
-                    user_id INTEGER PRIMARY KEY,
-                    character_preference TEXT DEFAULT 'Shiro.vrm',
-                    background_preference TEXT DEFAULT 'sky.jpg',
-                    voice_volume REAL DEFAULT 0.7,
-                    voice_speed REAL DEFAULT 1.0,
-                    memory_enabled BOOLEAN DEFAULT 1,
-                    use_3d_ui BOOLEAN DEFAULT 1,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-                )
-            ''')
-            
-            # キャラクターテーブル（ユーザーごとのカスタムキャラクター）
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS characters (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    name TEXT NOT NULL,
-                    vrm_file TEXT NOT NULL,
-                    prompt TEXT NOT NULL,
-                    voice_id TEXT NOT NULL,
-                    is_default BOOLEAN DEFAULT 0,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-                )
-            ''')
-            
-            # インデックス作成
-            cursor.execute('''
-                CREATE INDEX IF NOT EXISTS idx_users_email 
-                ON users (email)
-            ''')
-            
-            cursor.execute('''
-                CREATE INDEX IF NOT EXISTS idx_users_username 
-                ON users (username)
-            ''')
-            
-            cursor.execute('''
-                CREATE INDEX IF NOT EXISTS idx_refresh_tokens_user_id 
-                ON refresh_tokens (user_id)
-            ''')
-            
-            cursor.execute('''
-                CREATE INDEX IF NOT EXISTS idx_oauth_accounts_user_id 
-                ON oauth_accounts (user_id)
-            ''')
-            
-            cursor.execute('''
-                CREATE INDEX IF NOT EXISTS idx_oauth_accounts_provider 
-                ON oauth_accounts (provider, provider_user_id)
-            ''')
-            
-            cursor.execute('''
-                CREATE INDEX IF NOT EXISTS idx_characters_user_id 
-                ON characters (user_id)
-            ''')
-            
-            conn.commit()
-            conn.close()
+            with self.db.connection() as conn:
+                cursor = conn.cursor()
+            
+                # ユーザーテーブル
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS users (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        username TEXT UNIQUE NOT NULL,
+                        email TEXT UNIQUE NOT NULL,
+                        password_hash TEXT,
+                        avatar_url TEXT,
+                        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                        last_login DATETIME,
+                        is_active BOOLEAN DEFAULT 1,
+                        is_verified BOOLEAN DEFAULT 0
+                    )
+                ''')
+            
+                # 既存テーブルへのカラム追加（マイグレーション）
+                self._migrate_users_table(cursor)
+            
+                # OAuthアカウントテーブル
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS oauth_accounts (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        user_id INTEGER NOT NULL,
+                        provider TEXT NOT NULL,
+                        provider_user_id TEXT NOT NULL,
+                        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                        FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
+                        UNIQUE(provider, provider_user_id)
+                    )
+                ''')
+            
+                # リフレッシュトークンテーブル
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS refresh_tokens (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        user_id INTEGER NOT NULL,
+                        token_hash TEXT NOT NULL UNIQUE,
+                        expires_at DATETIME NOT NULL,
+                        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                        FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+                    )
+                ''')
+            
+                # ユーザー設定テーブル
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS user_settings (
+                        user_id INTEGER PRIMARY KEY,
+                        character_preference TEXT DEFAULT 'Shiro.vrm',
+                        background_preference TEXT DEFAULT 'sky.jpg',
+                        voice_volume REAL DEFAULT 0.7,
+                        voice_speed REAL DEFAULT 1.0,
+                        memory_enabled BOOLEAN DEFAULT 1,
+                        use_3d_ui BOOLEAN DEFAULT 1,
+                        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                        FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+                    )
+                ''')
+            
+                # キャラクターテーブル（ユーザーごとのカスタムキャラクター）
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS characters (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        user_id INTEGER NOT NULL,
+                        name TEXT NOT NULL,
+                        vrm_file TEXT NOT NULL,
+                        prompt TEXT NOT NULL,
+                        voice_id TEXT NOT NULL,
+                        is_default BOOLEAN DEFAULT 0,
+                        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                        FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+                    )
+                ''')
+            
+                # インデックス作成
+                cursor.execute('''
+                    CREATE INDEX IF NOT EXISTS idx_users_email 
+                    ON users (email)
+                ''')
+            
+                cursor.execute('''
+                    CREATE INDEX IF NOT EXISTS idx_users_username 
+                    ON users (username)
+                ''')
+            
+                cursor.execute('''
+                    CREATE INDEX IF NOT EXISTS idx_refresh_tokens_user_id 
+                    ON refresh_tokens (user_id)
+                ''')
+            
+                # 期限切れトークンの掃除用
+                cursor.execute('''
+                    CREATE INDEX IF NOT EXISTS idx_refresh_tokens_expires_at 
+                    ON refresh_tokens (expires_at)
+                ''')
+            
+                cursor.execute('''
+                    CREATE INDEX IF NOT EXISTS idx_oauth_accounts_user_id 
+                    ON oauth_accounts (user_id)
+                ''')
+            
+                cursor.execute('''
+                    CREATE INDEX IF NOT EXISTS idx_oauth_accounts_provider 
+                    ON oauth_accounts (provider, provider_user_id)
+                ''')
+            
+                cursor.execute('''
+                    CREATE INDEX IF NOT EXISTS idx_characters_user_id 
+                    ON characters (user_id)
+                ''')
+            
+                conn.commit()
             logger.info("User tables initialized successfully")
             
         except sqlite3.Error as e:
@@ -159,26 +256,26 @@ class User:
         """新規ユーザーを作成"""
         try:
             # パスワードハッシュ化
-            password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=12))
+            password_hash = self.password_hasher.hash_password(password)
             
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            with self.db.connection() as conn:
+                cursor = conn.cursor()
             
-            cursor.execute('''
-                INSERT INTO users (username, email, password_hash)
-                VALUES (?, ?, ?)
-            ''', (username, email, password_hash))
+                cursor.execute('''
+                    INSERT INTO users (username, email, password_hash)
+                    VALUES (?, ?, ?)
+                ''', (username, email, password_hash))
             
-            user_id = cursor.lastrowid
+                user_id = cursor.lastrowid
             
-            # デフォルト設定を作成
-            cursor.execute('''
-                INSERT INTO user_settings (user_id)
-                VALUES (?)
-            ''', (user_id,))
+                # デフォルト設定を作成
+                cursor.execute('''
+                    INSERT INTO user_settings (user_id)
+                    VALUES (?)
+                ''', (user_id,))
             
-            # デフォルトのShiroキャラクターを作成
-            shiro_prompt = '''<キャラクター設定>
+                # デフォルトのShiroキャラクターを作成
+                shiro_prompt = '''<キャラクター設定>
 名前:シロ (Shiro)
 本名: シルヴィア・ヴォルフガング (Sylvia Wolfgang) - 本人は長い名前を面倒くさがっており、呼ばれても反応しないことがある。
 
@@ -196,13 +293,12 @@ class User:
 
 上記のキャラクター設定に応じて、シロとしてマスターに反応してください。'''
             
-            cursor.execute('''
-                INSERT INTO characters (user_id, name, vrm_file, prompt, voice_id, is_default)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (user_id, 'シロ', 'Shiro.vrm', shiro_prompt, 'ocZQ262SsZb9RIxcQBOj', 1))
+                cursor.execute('''
+                    INSERT INTO characters (user_id, name, vrm_file, prompt, voice_id, is_default)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (user_id, 'シロ', 'Shiro.vrm', shiro_prompt, 'ocZQ262SsZb9RIxcQBOj', 1))
             
-            conn.commit()
-            conn.close()
+                conn.commit()
             
             logger.info(f"User created: {username} (ID: {user_id})")
             return user_id
@@ -210,6 +306,8 @@ class User:
         except sqlite3.IntegrityError as e:
             logger.error(f"User creation failed (duplicate): {e}")
             return None
+        except PasswordHasherBusyError:
+            raise
         except Exception as e:
             logger.error(f"User creation failed: {e}")
             return None
@@ -217,17 +315,16 @@ class User:
     def verify_password(self, email: str, password: str) -> Optional[Dict]:
         """パスワードを検証してユーザー情報を返す"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            with self.db.connection() as conn:
+                cursor = conn.cursor()
             
-            cursor.execute('''
-                SELECT id, username, email, password_hash, is_active
-                FROM users
-                WHERE email = ?
-            ''', (email,))
+                cursor.execute('''
+                    SELECT id, username, email, password_hash, is_active
+                    FROM users
+                    WHERE email = ?
+                ''', (email,))
             
-            result = cursor.fetchone()
-            conn.close()
+                result = cursor.fetchone()
             
             if not result:
                 return None
@@ -240,7 +337,7 @@ class User:
                 return None
             
             # パスワード検証
-            if bcrypt.checkpw(password.encode('utf-8'), password_hash):
+            if self.password_hasher.check_password(password, password_hash):
                 return {
                     'id': user_id,
                     'username': username,
@@ -250,6 +347,8 @@ class User:
             
             return None
             
+        except PasswordHasherBusyError:
+            raise
         except Exception as e:
             logger.error(f"Password verification failed: {e}")
             return None
@@ -257,38 +356,43 @@ class User:
     def update_last_login(self, user_id: int):
         """最終ログイン時刻を更新"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            with self.db.connection() as conn:
+                cursor = conn.cursor()
             
-            cursor.execute('''
-                UPDATE users
-                SET last_login = CURRENT_TIMESTAMP
-                WHERE id = ?
-            ''', (user_id,))
+                cursor.execute('''
+                    UPDATE users
+                    SET last_login = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                ''', (user_id,))
+            
+                conn.commit()
             
-            conn.commit()
-            conn.close()
+            self.cache.invalidate('user', user_id)
             
         except Exception as e:
             logger.error(f"Failed to update last login: {e}")
     
     def get_user_by_id(self, user_id: int) -> Optional[Dict]:
         """ユーザーIDからユーザー情報を取得"""
+        cached = self.cache.get('user', user_id)
+        if cached is not None:
+            return cached
+        generation = self.cache.generation
+        
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            with self.db.connection() as conn:
+                cursor = conn.cursor()
             
-            cursor.execute('''
-                SELECT id, username, email, created_at, last_login, is_active
-                FROM users
-                WHERE id = ?
-            ''', (user_id,))
+                cursor.execute('''
+                    SELECT id, username, email, created_at, last_login, is_active
+                    FROM users
+                    WHERE id = ?
+                ''', (user_id,))
             
-            result = cursor.fetchone()
-            conn.close()
+                result = cursor.fetchone()
             
             if result:
-                return {
+                user = {
                     'id': result[0],
                     'username': result[1],
                     'email': result[2],
@@ -296,6 +400,8 @@ class User:
                     'last_login': result[4],
                     'is_active': bool(result[5])
                 }
+                self.cache.set('user', user_id, user, generation)
+                return user
             
             return None
             
@@ -306,17 +412,16 @@ class User:
     def get_user_by_email(self, email: str) -> Optional[Dict]:
         """メールアドレスからユーザー情報を取得"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            with self.db.connection() as conn:
+                cursor = conn.cursor()
             
-            cursor.execute('''
-                SELECT id, username, email, created_at, last_login, is_active
-                FROM users
-                WHERE email = ?
-            ''', (email,))
+                cursor.execute('''
+                    SELECT id, username, email, created_at, last_login, is_active
+                    FROM users
+                    WHERE email = ?
+                ''', (email,))
             
-            result = cursor.fetchone()
-            conn.close()
+                result = cursor.fetchone()
             
             if result:
                 return {
@@ -336,22 +441,26 @@ class User:
     
     def get_user_settings(self, user_id: int) -> Optional[Dict]:
         """ユーザー設定を取得"""
+        cached = self.cache.get('settings', user_id)
+        if cached is not None:
+            return cached
+        generation = self.cache.generation
+        
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            with self.db.connection() as conn:
+                cursor = conn.cursor()
             
-            cursor.execute('''
-                SELECT character_preference, background_preference, 
-                       voice_volume, voice_speed, memory_enabled, use_3d_ui
-                FROM user_settings
-                WHERE user_id = ?
-            ''', (user_id,))
+                cursor.execute('''
+                    SELECT character_preference, background_preference, 
+                           voice_volume, voice_speed, memory_enabled, use_3d_ui
+                    FROM user_settings
+                    WHERE user_id = ?
+                ''', (user_id,))
             
-            result = cursor.fetchone()
-            conn.close()
+                result = cursor.fetchone()
             
             if result:
-                return {
+                settings = {
                     'character': result[0],
                     'background': result[1],
                     'volume': result[2],
@@ -359,6 +468,8 @@ class User:
                     'memoryEnabled': bool(result[4]),
                     'use3DUI': bool(result[5])
                 }
+                self.cache.set('settings', user_id, settings, generation)
+                return settings
             
             return None
             
@@ -369,32 +480,32 @@ class User:
     def update_user_settings(self, user_id: int, settings: Dict):
         """ユーザー設定を更新"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                UPDATE user_settings
-                SET character_preference = ?,
-                    background_preference = ?,
-                    voice_volume = ?,
-                    voice_speed = ?,
-                    memory_enabled = ?,
-                    use_3d_ui = ?,
-                    updated_at = CURRENT_TIMESTAMP
-                WHERE user_id = ?
-            ''', (
-                settings.get('character', 'yui.vrm'),
-                settings.get('background', 'sky.jpg'),
-                settings.get('volume', 0.7),
-                settings.get('voiceSpeed', 1.0),
-                settings.get('memoryEnabled', True),
-                settings.get('use3DUI', True),
-                user_id
-            ))
-            
-            conn.commit()
-            conn.close()
+            with self.db.connection() as conn:
+                cursor = conn.cursor()
             
+                cursor.execute('''
+                    UPDATE user_settings
+                    SET character_preference = ?,
+                        background_preference = ?,
+                        voice_volume = ?,
+                        voice_speed = ?,
+                        memory_enabled = ?,
+                        use_3d_ui = ?,
+                        updated_at = CURRENT_TIMESTAMP
+                    WHERE user_id = ?
+                ''', (
+                    settings.get('character', 'yui.vrm'),
+                    settings.get('background', 'sky.jpg'),
+                    settings.get('volume', 0.7),
+                    settings.get('voiceSpeed', 1.0),
+                    settings.get('memoryEnabled', True),
+                    settings.get('use3DUI', True),
+                    user_id
+                ))
+            
+                conn.commit()
+            
+            self.cache.invalidate('settings', user_id)
             logger.info(f"User settings updated for user ID: {user_id}")
             
         except Exception as e:
@@ -404,16 +515,31 @@ class User:
     def save_refresh_token(self, user_id: int, token_hash: str, expires_at: datetime):
         """リフレッシュトークンを保存"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            with self.db.connection() as conn:
+                cursor = conn.cursor()
             
-            cursor.execute('''
-                INSERT INTO refresh_tokens (user_id, token_hash, expires_at)
-                VALUES (?, ?, ?)
-            ''', (user_id, token_hash, expires_at.isoformat()))
+                cursor.execute('''
+                    INSERT INTO refresh_tokens (user_id, token_hash, expires_at)
+                    VALUES (?, ?, ?)
+                ''', (user_id, token_hash, expires_at.isoformat()))
             
-            conn.commit()
-            conn.close()
+                # このユーザーの期限切れトークンと、上限を超えた古いトークンを削除
+                cursor.execute('''
+                    DELETE FROM refresh_tokens
+                    WHERE user_id = ? AND expires_at <= ?
+                ''', (user_id, datetime.utcnow().isoformat()))
+            
+                cursor.execute('''
+                    DELETE FROM refresh_tokens
+                    WHERE user_id = ? AND id NOT IN (
+                        SELECT id FROM refresh_tokens
+                        WHERE user_id = ?
+                        ORDER BY id DESC
+                        LIMIT ?
+                    )
+                ''', (user_id, user_id, self.max_refresh_tokens_per_user))
+            
+                conn.commit()
             
         except Exception as e:
             logger.error(f"Failed to save refresh token: {e}")
@@ -422,28 +548,22 @@ class User:
     def verify_refresh_token(self, token_hash: str) -> Optional[int]:
         """リフレッシュトークンを検証してユーザーIDを返す"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            with self.db.connection() as conn:
+                cursor = conn.cursor()
             
-            cursor.execute('''
-                SELECT user_id, expires_at
-                FROM refresh_tokens
-                WHERE token_hash = ?
-            ''', (token_hash,))
+                # 有効期限チェック（expires_atはISO形式のため文字列比較で判定できる）
+                cursor.execute('''
+                    SELECT user_id
+                    FROM refresh_tokens
+                    WHERE token_hash = ? AND expires_at > ?
+                ''', (token_hash, datetime.utcnow().isoformat()))
             
-            result = cursor.fetchone()
-            conn.close()
+                result = cursor.fetchone()
             
             if not result:
                 return None
             
-            user_id, expires_at = result
-            
-            # 有効期限チェック
-            if datetime.fromisoformat(expires_at) < datetime.utcnow():
-                return None
-            
-            return user_id
+            return result[0]
             
         except Exception as e:
             logger.error(f"Failed to verify refresh token: {e}")
@@ -452,16 +572,15 @@ class User:
     def delete_refresh_token(self, token_hash: str):
         """リフレッシュトークンを削除"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            with self.db.connection() as conn:
+                cursor = conn.cursor()
             
-            cursor.execute('''
-                DELETE FROM refresh_tokens
-                WHERE token_hash = ?
-            ''', (token_hash,))
+                cursor.execute('''
+                    DELETE FROM refresh_tokens
+                    WHERE token_hash = ?
+                ''', (token_hash,))
             
-            conn.commit()
-            conn.close()
+                conn.commit()
             
         except Exception as e:
             logger.error(f"Failed to delete refresh token: {e}")
@@ -469,49 +588,82 @@ class User:
     def delete_user_refresh_tokens(self, user_id: int):
         """ユーザーの全リフレッシュトークンを削除（ログアウト）"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            with self.db.connection() as conn:
+                cursor = conn.cursor()
             
-            cursor.execute('''
-                DELETE FROM refresh_tokens
-                WHERE user_id = ?
-            ''', (user_id,))
+                cursor.execute('''
+                    DELETE FROM refresh_tokens
+                    WHERE user_id = ?
+                ''', (user_id,))
             
-            conn.commit()
-            conn.close()
+                conn.commit()
             
         except Exception as e:
             logger.error(f"Failed to delete user refresh tokens: {e}")
     
+    def delete_expired_refresh_tokens(self, batch_size: int = 500, max_batches: int = 100) -> int:
+        """期限切れのリフレッシュトークンを小さなトランザクションに分けて削除"""
+        now = datetime.utcnow().isoformat()
+        deleted = 0
+        
+        try:
+            for _ in range(max_batches):
+                with self.db.connection() as conn:
+                    cursor = conn.cursor()
+                
+                    cursor.execute('''
+                        DELETE FROM refresh_tokens
+                        WHERE id IN (
+                            SELECT id FROM refresh_tokens
+                            WHERE expires_at <= ?
+                            LIMIT ?
+                        )
+                    ''', (now, batch_size))
+                
+                    batch_deleted = cursor.rowcount
+                    conn.commit()
+                
+                deleted += batch_deleted
+                if batch_deleted < batch_size:
+                    break
+                
+                # 書き込みロックを他のリクエストに譲る
+                time.sleep(0)
+            
+        except Exception as e:
+            logger.error(f"Failed to delete expired refresh tokens: {e}")
+        
+        return deleted
+    
     def create_oauth_user(self, username: str, email: str, provider: str, 
                          provider_user_id: str, avatar_url: str = None) -> Optional[int]:
         """OAuth認証でユーザーを新規作成"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            # パスワードなしでユーザーを作成（OAuthのみ）
-            cursor.execute('''
-                INSERT INTO users (username, email, password_hash, avatar_url, is_verified)
-                VALUES (?, ?, NULL, ?, 1)
-            ''', (username, email, avatar_url))
-            
-            user_id = cursor.lastrowid
-            
-            # OAuthアカウント情報を保存
-            cursor.execute('''
-                INSERT INTO oauth_accounts (user_id, provider, provider_user_id)
-                VALUES (?, ?, ?)
-            ''', (user_id, provider, provider_user_id))
-            
-            # デフォルト設定を作成
-            cursor.execute('''
-                INSERT INTO user_settings (user_id)
-                VALUES (?)
-            ''', (user_id,))
-            
-            # デフォルトのShiroキャラクターを作成
-            shiro_prompt = '''<キャラクター設定>
+            with self.db.connection() as conn:
+                cursor = conn.cursor()
+            
+                # パスワードなしでユーザーを作成（OAuthのみ）
+                cursor.execute('''
+                    INSERT INTO users (username, email, password_hash, avatar_url, is_verified)
+                    VALUES (?, ?, NULL, ?, 1)
+                ''', (username, email, avatar_url))
+            
+                user_id = cursor.lastrowid
+            
+                # OAuthアカウント情報を保存
+                cursor.execute('''
+                    INSERT INTO oauth_accounts (user_id, provider, provider_user_id)
+                    VALUES (?, ?, ?)
+                ''', (user_id, provider, provider_user_id))
+            
+                # デフォルト設定を作成
+                cursor.execute('''
+                    INSERT INTO user_settings (user_id)
+                    VALUES (?)
+                ''', (user_id,))
+            
+                # デフォルトのShiroキャラクターを作成
+                shiro_prompt = '''<キャラクター設定>
 名前:シロ (Shiro)
 本名: シルヴィア・ヴォルフガング (Sylvia Wolfgang) - 本人は長い名前を面倒くさがっており、呼ばれても反応しないことがある。
 
@@ -529,13 +681,12 @@ class User:
 
 上記のキャラクター設定に応じて、シロとしてマスターに反応してください。'''
             
-            cursor.execute('''
-                INSERT INTO characters (user_id, name, vrm_file, prompt, voice_id, is_default)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (user_id, 'シロ', 'Shiro.vrm', shiro_prompt, 'ocZQ262SsZb9RIxcQBOj', 1))
+                cursor.execute('''
+                    INSERT INTO characters (user_id, name, vrm_file, prompt, voice_id, is_default)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (user_id, 'シロ', 'Shiro.vrm', shiro_prompt, 'ocZQ262SsZb9RIxcQBOj', 1))
             
-            conn.commit()
-            conn.close()
+                conn.commit()
             
             logger.info(f"OAuth user created: {username} via {provider} (ID: {user_id})")
             return user_id
@@ -550,19 +701,18 @@ class User:
     def get_user_by_oauth(self, provider: str, provider_user_id: str) -> Optional[Dict]:
         """OAuth情報からユーザーを取得"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            with self.db.connection() as conn:
+                cursor = conn.cursor()
             
-            cursor.execute('''
-                SELECT u.id, u.username, u.email, u.avatar_url, u.created_at, 
-                       u.last_login, u.is_active
-                FROM users u
-                INNER JOIN oauth_accounts oa ON u.id = oa.user_id
-                WHERE oa.provider = ? AND oa.provider_user_id = ?
-            ''', (provider, provider_user_id))
+                cursor.execute('''
+                    SELECT u.id, u.username, u.email, u.avatar_url, u.created_at, 
+                           u.last_login, u.is_active
+                    FROM users u
+                    INNER JOIN oauth_accounts oa ON u.id = oa.user_id
+                    WHERE oa.provider = ? AND oa.provider_user_id = ?
+                ''', (provider, provider_user_id))
             
-            result = cursor.fetchone()
-            conn.close()
+                result = cursor.fetchone()
             
             if result:
                 return {
@@ -585,26 +735,26 @@ class User:
                           provider_user_id: str, avatar_url: str = None):
         """既存ユーザーにOAuthアカウントをリンク"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            with self.db.connection() as conn:
+                cursor = conn.cursor()
             
-            # OAuthアカウントを追加
-            cursor.execute('''
-                INSERT INTO oauth_accounts (user_id, provider, provider_user_id)
-                VALUES (?, ?, ?)
-            ''', (user_id, provider, provider_user_id))
-            
-            # アバターURLを更新（提供されている場合）
-            if avatar_url:
+                # OAuthアカウントを追加
                 cursor.execute('''
-                    UPDATE users
-                    SET avatar_url = ?
-                    WHERE id = ?
-                ''', (avatar_url, user_id))
+                    INSERT INTO oauth_accounts (user_id, provider, provider_user_id)
+                    VALUES (?, ?, ?)
+                ''', (user_id, provider, provider_user_id))
+            
+                # アバターURLを更新（提供されている場合）
+                if avatar_url:
+                    cursor.execute('''
+                        UPDATE users
+                        SET avatar_url = ?
+                        WHERE id = ?
+                    ''', (avatar_url, user_id))
             
-            conn.commit()
-            conn.close()
+                conn.commit()
             
+            self.cache.invalidate('user', user_id)
             logger.info(f"Linked {provider} account to user ID: {user_id}")
             
         except sqlite3.IntegrityError:
@@ -616,27 +766,27 @@ class User:
     def update_oauth_user(self, user_id: int, avatar_url: str = None):
         """OAuthユーザー情報を更新"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            updates = []
-            params = []
-            
-            if avatar_url:
-                updates.append("avatar_url = ?")
-                params.append(avatar_url)
-            
-            if updates:
-                params.append(user_id)
-                cursor.execute(f'''
-                    UPDATE users
-                    SET {", ".join(updates)}
-                    WHERE id = ?
-                ''', params)
+            with self.db.connection() as conn:
+                cursor = conn.cursor()
+            
+                updates = []
+                params = []
+            
+                if avatar_url:
+                    updates.append("avatar_url = ?")
+                    params.append(avatar_url)
+            
+                if updates:
+                    params.append(user_id)
+                    cursor.execute(f'''
+                        UPDATE users
+                        SET {", ".join(updates)}
+                        WHERE id = ?
+                    ''', params)
                 
-                conn.commit()
+                    conn.commit()
             
-            conn.close()
+            self.cache.invalidate('user', user_id)
             
         except Exception as e:
             logger.error(f"Failed to update OAuth user: {e}")
@@ -646,26 +796,26 @@ class User:
     def create_character(self, user_id: int, name: str, vrm_file: str, prompt: str, voice_id: str, is_default: bool = False) -> Optional[int]:
         """新しいキャラクターを作成"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            with self.db.connection() as conn:
+                cursor = conn.cursor()
             
-            # デフォルトキャラクターに設定する場合、他のキャラクターのデフォルトを解除
-            if is_default:
-                cursor.execute('''
-                    UPDATE characters
-                    SET is_default = 0
-                    WHERE user_id = ?
-                ''', (user_id,))
+                # デフォルトキャラクターに設定する場合、他のキャラクターのデフォルトを解除
+                if is_default:
+                    cursor.execute('''
+                        UPDATE characters
+                        SET is_default = 0
+                        WHERE user_id = ?
+                    ''', (user_id,))
             
-            cursor.execute('''
-                INSERT INTO characters (user_id, name, vrm_file, prompt, voice_id, is_default)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (user_id, name, vrm_file, prompt, voice_id, is_default))
+                cursor.execute('''
+                    INSERT INTO characters (user_id, name, vrm_file, prompt, voice_id, is_default)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (user_id, name, vrm_file, prompt, voice_id, is_default))
             
-            character_id = cursor.lastrowid
-            conn.commit()
-            conn.close()
+                character_id = cursor.lastrowid
+                conn.commit()
             
+            self._invalidate_user_characters(user_id, all_characters=bool(is_default))
             logger.info(f"Character created: {name} (ID: {character_id}) for user {user_id}")
             return character_id
             
@@ -675,21 +825,25 @@ class User:
     
     def get_user_characters(self, user_id: int) -> List[Dict]:
         """ユーザーのキャラクター一覧を取得"""
+        cached = self.cache.get('user_characters', user_id)
+        if cached is not None:
+            return cached
+        generation = self.cache.generation
+        
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            with self.db.connection() as conn:
+                cursor = conn.cursor()
             
-            cursor.execute('''
-                SELECT id, name, vrm_file, prompt, voice_id, is_default, created_at, updated_at
-                FROM characters
-                WHERE user_id = ?
-                ORDER BY is_default DESC, created_at ASC
-            ''', (user_id,))
+                cursor.execute('''
+                    SELECT id, name, vrm_file, prompt, voice_id, is_default, created_at, updated_at
+                    FROM characters
+                    WHERE user_id = ?
+                    ORDER BY is_default DESC, created_at ASC
+                ''', (user_id,))
             
-            results = cursor.fetchall()
-            conn.close()
+                results = cursor.fetchall()
             
-            return [
+            characters = [
                 {
                     'id': row[0],
                     'name': row[1],
@@ -702,6 +856,8 @@ class User:
                 }
                 for row in results
             ]
+            self.cache.set('user_characters', user_id, characters, generation)
+            return characters
             
         except Exception as e:
             logger.error(f"Failed to get user characters: {e}")
@@ -709,21 +865,25 @@ class User:
     
     def get_character_by_id(self, character_id: int) -> Optional[Dict]:
         """キャラクターIDでキャラクター情報を取得"""
+        cached = self.cache.get('character', character_id)
+        if cached is not None:
+            return cached
+        generation = self.cache.generation
+        
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            with self.db.connection() as conn:
+                cursor = conn.cursor()
             
-            cursor.execute('''
-                SELECT id, user_id, name, vrm_file, prompt, voice_id, is_default, created_at, updated_at
-                FROM characters
-                WHERE id = ?
-            ''', (character_id,))
+                cursor.execute('''
+                    SELECT id, user_id, name, vrm_file, prompt, voice_id, is_default, created_at, updated_at
+                    FROM characters
+                    WHERE id = ?
+                ''', (character_id,))
             
-            result = cursor.fetchone()
-            conn.close()
+                result = cursor.fetchone()
             
             if result:
-                return {
+                character = {
                     'id': result[0],
                     'user_id': result[1],
                     'name': result[2],
@@ -734,6 +894,8 @@ class User:
                     'created_at': result[7],
                     'updated_at': result[8]
                 }
+                self.cache.set('character', character_id, character, generation)
+                return character
             return None
             
         except Exception as e:
@@ -743,55 +905,55 @@ class User:
     def update_character(self, character_id: int, name: str = None, prompt: str = None, voice_id: str = None, is_default: bool = None) -> bool:
         """キャラクター情報を更新"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            with self.db.connection() as conn:
+                cursor = conn.cursor()
             
-            # まず、キャラクターの所有者を確認
-            cursor.execute('SELECT user_id FROM characters WHERE id = ?', (character_id,))
-            result = cursor.fetchone()
+                # まず、キャラクターの所有者を確認
+                cursor.execute('SELECT user_id FROM characters WHERE id = ?', (character_id,))
+                result = cursor.fetchone()
             
-            if not result:
-                conn.close()
-                return False
+                if not result:
+                    return False
             
-            user_id = result[0]
+                user_id = result[0]
             
-            # デフォルトキャラクターに設定する場合、他のキャラクターのデフォルトを解除
-            if is_default:
-                cursor.execute('''
-                    UPDATE characters
-                    SET is_default = 0
-                    WHERE user_id = ?
-                ''', (user_id,))
+                # デフォルトキャラクターに設定する場合、他のキャラクターのデフォルトを解除
+                if is_default:
+                    cursor.execute('''
+                        UPDATE characters
+                        SET is_default = 0
+                        WHERE user_id = ?
+                    ''', (user_id,))
             
-            updates = []
-            params = []
+                updates = []
+                params = []
             
-            if name is not None:
-                updates.append('name = ?')
-                params.append(name)
+                if name is not None:
+                    updates.append('name = ?')
+                    params.append(name)
             
-            if prompt is not None:
-                updates.append('prompt = ?')
-                params.append(prompt)
+                if prompt is not None:
+                    updates.append('prompt = ?')
+                    params.append(prompt)
             
-            if voice_id is not None:
-                updates.append('voice_id = ?')
-                params.append(voice_id)
+                if voice_id is not None:
+                    updates.append('voice_id = ?')
+                    params.append(voice_id)
             
-            if is_default is not None:
-                updates.append('is_default = ?')
-                params.append(1 if is_default else 0)
+                if is_default is not None:
+                    updates.append('is_default = ?')
+                    params.append(1 if is_default else 0)
             
-            if updates:
-                updates.append('updated_at = CURRENT_TIMESTAMP')
-                params.append(character_id)
+                if updates:
+                    updates.append('updated_at = CURRENT_TIMESTAMP')
+                    params.append(character_id)
                 
-                sql = f"UPDATE characters SET {', '.join(updates)} WHERE id = ?"
-                cursor.execute(sql, params)
-                conn.commit()
+                    sql = f"UPDATE characters SET {', '.join(updates)} WHERE id = ?"
+                    cursor.execute(sql, params)
+                    conn.commit()
             
-            conn.close()
+            self.cache.invalidate('character', character_id)
+            self._invalidate_user_characters(user_id, all_characters=bool(is_default))
             logger.info(f"Character {character_id} updated")
             return True
             
@@ -802,14 +964,19 @@ class User:
     def delete_character(self, character_id: int) -> bool:
         """キャラクターを削除"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            with self.db.connection() as conn:
+                cursor = conn.cursor()
             
-            cursor.execute('DELETE FROM characters WHERE id = ?', (character_id,))
+                cursor.execute('SELECT user_id FROM characters WHERE id = ?', (character_id,))
+                owner = cursor.fetchone()
             
-            conn.commit()
-            conn.close()
+                cursor.execute('DELETE FROM characters WHERE id = ?', (character_id,))
+            
+                conn.commit()
             
+            self.cache.invalidate('character', character_id)
+            if owner:
+                self._invalidate_user_characters(owner[0])
             logger.info(f"Character {character_id} deleted")
             return True
             
@@ -820,17 +987,16 @@ class User:
     def get_default_character(self, user_id: int) -> Optional[Dict]:
         """ユーザーのデフォルトキャラクターを取得"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            with self.db.connection() as conn:
+                cursor = conn.cursor()
             
-            cursor.execute('''
-                SELECT id, name, vrm_file, prompt, voice_id, is_default, created_at, updated_at
-                FROM characters
-                WHERE user_id = ? AND is_default = 1
-            ''', (user_id,))
+                cursor.execute('''
+                    SELECT id, name, vrm_file, prompt, voice_id, is_default, created_at, updated_at
+                    FROM characters
+                    WHERE user_id = ? AND is_default = 1
+                ''', (user_id,))
             
-            result = cursor.fetchone()
-            conn.close()
+                result = cursor.fetchone()
             
             if result:
                 return {
@@ -848,3 +1014,13 @@ class User:
         except Exception as e:
             logger.error(f"Failed to get default character: {e}")
             return None
+    
+    def _invalidate_user_characters(self, user_id: int, all_characters: bool = False):
+        """キャラクター一覧のキャッシュを無効化（デフォルト変更時は同じユーザーの全キャラクターも）"""
+        self.cache.invalidate('user_characters', user_id)
+        if all_characters:
+            self.cache.invalidate_where('character', lambda character: character.get('user_id') == user_id)
+    
+    def get_cache_stats(self) -> Dict:
+        """読み取りキャッシュの統計情報を取得"""
+        return self.cache.get_stats()
@@ -0,0 +1,176 @@
+"""
+Character Models - per-character Gemini model handles
+Carries the persona as a system instruction (and as cached context for long prompts)
+"""
+
+import os
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Dict, Optional, Tuple
+
+import google.generativeai as genai
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+
+class _ModelHandle:
+    """A GenerativeModel bound to one persona prompt, with optional cached content"""
+
+    def __init__(self, model, cached_content=None, expires_at: Optional[float] = None):
+        self.model = model
+        self.cached_content = cached_content
+        self.expires_at = expires_at
+
+    def is_expired(self) -> bool:
+        return self.expires_at is not None and time.monotonic() >= self.expires_at
+
+    def release(self):
+        """Delete the server-side cached content (best effort)"""
+        if self.cached_content is None:
+            return
+        try:
+            self.cached_content.delete()
+        except Exception as e:
+            logger.warning(f"Failed to delete Gemini cached content: {e}")
+
+
+class CharacterModelRegistry:
+    """
+    Registry of per-character model handles keyed by prompt hash
+
+    Features:
+    - Persona is sent once as system_instruction instead of being prepended
+      to every user message
+    - Prompts longer than `cache_min_chars` are stored with Gemini context
+      caching, so per-turn input tokens are only the conversation itself
+    - Bounded LRU of handles; cached contents are refreshed before their TTL
+      and deleted on eviction or invalidation
+    """
+
+    def __init__(
+        self,
+        primary_model_name: str,
+        fallback_model_name: str,
+        max_entries: int = 64,
+        cache_min_chars: int = 4000,
+        cache_ttl_seconds: int = 3600
+    ):
+        """
+        Args:
+            primary_model_name: Primary Gemini model name
+            fallback_model_name: Fallback Gemini model name
+            max_entries: Maximum number of distinct prompts kept
+            cache_min_chars: Prompt length from which context caching is used
+                (0 disables context caching)
+            cache_ttl_seconds: TTL of server-side cached contents
+        """
+        self.model_names = {"primary": primary_model_name, "fallback": fallback_model_name}
+        self.max_entries = max_entries
+        self.cache_min_chars = cache_min_chars
+        self.cache_ttl_seconds = cache_ttl_seconds
+
+        self._handles: "OrderedDict[str, Dict[str, _ModelHandle]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "context_caches": 0, "context_cache_failures": 0,
+                      "evictions": 0, "invalidations": 0}
+
+    @staticmethod
+    def prompt_key(prompt: str) -> str:
+        """Stable key for a persona prompt"""
+        return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+    def _create_handle(self, model_name: str, prompt: str) -> _ModelHandle:
+        """Build a model handle, using context caching for long prompts"""
+        if self.cache_min_chars and len(prompt) >= self.cache_min_chars:
+            try:
+                cached_content = genai.caching.CachedContent.create(
+                    model=model_name,
+                    display_name=f"persona-{self.prompt_key(prompt)[:16]}",
+                    system_instruction=prompt,
+                    ttl=timedelta(seconds=self.cache_ttl_seconds)
+                )
+                self.stats["context_caches"] += 1
+                # Refresh a minute before the server-side cache expires
+                expires_at = time.monotonic() + max(self.cache_ttl_seconds - 60, 1)
+                return _ModelHandle(genai.GenerativeModel.from_cached_content(cached_content), cached_content, expires_at)
+            except Exception as e:
+                # Prompts under the model's minimum cacheable size or unsupported models
+                self.stats["context_cache_failures"] += 1
+                logger.warning(f"Gemini context caching unavailable for {model_name}: {e}")
+
+        return _ModelHandle(genai.GenerativeModel(model_name, system_instruction=prompt))
+
+    def get_models(self, prompt: str) -> Tuple[object, object]:
+        """
+        Get (primary, fallback) model handles for a persona prompt
+
+        Returns:
+            Tuple of GenerativeModel instances carrying the persona
+        """
+        key = self.prompt_key(prompt)
+
+        with self._lock:
+            handles = self._handles.get(key)
+            if handles is not None and not any(h.is_expired() for h in handles.values()):
+                self._handles.move_to_end(key)
+                self.stats["hits"] += 1
+                return handles["primary"].model, handles["fallback"].model
+            self.stats["misses"] += 1
+
+        # Context cache creation is a network call; build outside the lock
+        created = {label: self._create_handle(name, prompt) for label, name in self.model_names.items()}
+        released = []
+
+        with self._lock:
+            current = self._handles.get(key)
+            if current is not None and current is not handles and not any(h.is_expired() for h in current.values()):
+                # Another caller filled this entry concurrently; keep theirs
+                released.extend(created.values())
+                created = current
+            else:
+                if current is not None:
+                    released.extend(current.values())
+                self._handles[key] = created
+            self._handles.move_to_end(key)
+
+            while len(self._handles) > self.max_entries:
+                _, evicted = self._handles.popitem(last=False)
+                released.extend(evicted.values())
+                self.stats["evictions"] += 1
+
+        for handle in released:
+            handle.release()
+
+        return created["primary"].model, created["fallback"].model
+
+    def invalidate(self, prompt: str):
+        """Drop the handles for a prompt (e.g. after the character prompt was edited)"""
+        with self._lock:
+            handles = self._handles.pop(self.prompt_key(prompt), None)
+            if handles is not None:
+                self.stats["invalidations"] += 1
+
+        if handles is not None:
+            for handle in handles.values():
+                handle.release()
+
+    def get_stats(self) -> dict:
+        """Registry hit/miss and context caching counters"""
+        with self._lock:
+            return dict(self.stats, entries=len(self._handles), max_entries=self.max_entries)
+
+
+def create_character_model_registry(primary_model_name: str, fallback_model_name: str) -> CharacterModelRegistry:
+    """Create a CharacterModelRegistry configured from environment variables"""
+    return CharacterModelRegistry(
+        primary_model_name,
+        fallback_model_name,
+        max_entries=int(os.getenv('GEMINI_CHARACTER_MODELS_MAX', '64')),
+        cache_min_chars=int(os.getenv('GEMINI_CONTEXT_CACHE_MIN_CHARS', '4000')),
+        cache_ttl_seconds=int(os.getenv('GEMINI_CONTEXT_CACHE_TTL_SECONDS', '3600'))
+    )
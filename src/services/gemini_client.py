@@ -0,0 +1,560 @@
+"""
+Gemini Client - hedged streaming requests with per-model circuit breakers
+"""
+
+import os
+import math
+import queue
+import logging
+import threading
+import time
+from collections import deque
+from typing import Dict, Iterator, Optional
+
+from services import metrics
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+GEMINI_ATTEMPTS = metrics.counter("gemini_attempts_total", "Gemini streaming attempts by model and outcome",
+                                  ["model", "outcome"])
+GEMINI_TTFT = metrics.histogram("gemini_time_to_first_token_seconds", "Gemini time to first token", ["model"])
+GEMINI_DURATION = metrics.histogram("gemini_response_seconds", "Gemini time to complete a streamed response",
+                                    ["model"])
+GEMINI_BREAKER_STATE = metrics.gauge("gemini_circuit_breaker_state",
+                                     "Gemini circuit breaker state (0=closed, 1=half_open, 2=open)", ["model"])
+GEMINI_EVENTS = metrics.counter("gemini_client_events_total", "Gemini client requests, hedges and failovers",
+                                ["event"])
+
+
+class CircuitOpenError(Exception):
+    """Raised when every model's circuit breaker is open"""
+    pass
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """Whether an exception from the Gemini SDK is a 429 / quota error"""
+    message = str(error)
+    return "429" in message or "quota" in message.lower()
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker
+
+    closed -> open after `failure_threshold` consecutive failures (or one 429),
+    open -> half_open after `recovery_timeout` seconds, where a single probe
+    request decides whether to close again or re-open.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 3, recovery_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+        self.stats = {"successes": 0, "failures": 0, "rate_limited": 0, "rejected": 0, "opened": 0}
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self) -> str:
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.recovery_timeout:
+            self._state = self.HALF_OPEN
+            self._probe_in_flight = False
+        return self._state
+
+    def allow(self) -> bool:
+        """Whether a request may be sent now"""
+        with self._lock:
+            state = self._current_state()
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self.stats["rejected"] += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.stats["successes"] += 1
+            self._consecutive_failures = 0
+            self._probe_in_flight = False
+            if self._state != self.CLOSED:
+                logger.info(f"Circuit '{self.name}' closed")
+            self._state = self.CLOSED
+
+    def record_failure(self, rate_limited: bool = False):
+        with self._lock:
+            self.stats["failures"] += 1
+            if rate_limited:
+                self.stats["rate_limited"] += 1
+            self._consecutive_failures += 1
+            self._probe_in_flight = False
+            if (rate_limited or self._state == self.HALF_OPEN
+                    or self._consecutive_failures >= self.failure_threshold):
+                if self._state != self.OPEN:
+                    self.stats["opened"] += 1
+                    logger.warning(
+                        f"Circuit '{self.name}' opened after {self._consecutive_failures} failure(s)"
+                        f"{' (rate limited)' if rate_limited else ''}"
+                    )
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def record_cancelled(self):
+        """The request was abandoned before an outcome (e.g. lost a hedge race to a fast winner)"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return dict(
+                self.stats,
+                state=self._current_state(),
+                consecutive_failures=self._consecutive_failures
+            )
+
+
+class LatencyTracker:
+    """Sliding window of time-to-first-token samples"""
+
+    def __init__(self, window: int = 200):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, p: float) -> Optional[float]:
+        with self._lock:
+            if not self._samples:
+                return None
+            ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, max(0, math.ceil(p * len(ordered)) - 1))
+        return ordered[index]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._samples)
+
+
+class _Attempt:
+    """One in-flight streaming request to one model"""
+
+    def __init__(self, label: str):
+        self.label = label
+        self.started = time.perf_counter()
+        self.cancelled = threading.Event()
+        self.finished = False
+        self.exited = False  # the attempt's own thread has stopped
+        self.first_token_at: Optional[float] = None
+        self.response = None
+        self._settled = False
+        self._lock = threading.Lock()
+
+    def settle(self) -> bool:
+        """
+        Claim the breaker outcome for the first token
+
+        Either the attempt (first token or error) or the caller abandoning it
+        reports the outcome, never both; returns True for whichever comes first.
+        """
+        with self._lock:
+            if self._settled:
+                return False
+            self._settled = True
+            return True
+
+    def close_stream(self):
+        """Close the underlying HTTP/gRPC stream so a blocked read returns now"""
+        # GenerateContentResponse keeps the transport iterator privately; both the
+        # REST and gRPC iterators expose cancel()
+        stream = getattr(self.response, "_iterator", None)
+        cancel = getattr(stream, "cancel", None)
+        if callable(cancel):
+            try:
+                cancel()
+            except Exception as e:
+                logger.debug(f"Failed to cancel Gemini {self.label} stream: {e}")
+
+
+class GeminiClient:
+    """
+    Streaming Gemini client with hedging and circuit breaking
+
+    Features:
+    - Hedged request to the fallback model when the primary has not produced
+      its first token within the primary's recent p95 time-to-first-token
+    - Per-model circuit breakers (consecutive failures or any 429 open them),
+      so outages fail over immediately instead of paying the timeout each turn;
+      timeouts, stalls and a first token slower than `slow_call_threshold`
+      count as failures, so a browned-out model trips its breaker too
+    - Background prompts (generate) bypass hedging and the breaker/latency
+      bookkeeping so they cannot skew live-chat failover decisions
+    - State and latency metrics via get_stats()
+    """
+
+    def __init__(
+        self,
+        primary_model,
+        fallback_model,
+        hedge_percentile: float = 0.95,
+        hedge_min_delay: float = 1.0,
+        hedge_default_delay: float = 3.0,
+        hedge_min_samples: int = 20,
+        failure_threshold: int = 3,
+        recovery_timeout: float = 30.0,
+        request_timeout: float = 60.0,
+        slow_call_threshold: float = 5.0
+    ):
+        """
+        Args:
+            primary_model: Default primary GenerativeModel
+            fallback_model: Default fallback GenerativeModel
+            hedge_percentile: Primary TTFT percentile used as the hedge delay
+            hedge_min_delay: Lower bound for the hedge delay in seconds
+            hedge_default_delay: Hedge delay until enough samples are collected
+            hedge_min_samples: Samples required before using the percentile
+            failure_threshold: Consecutive failures that open a breaker
+            recovery_timeout: Seconds a breaker stays open before probing
+            request_timeout: Maximum wait for any streaming event in seconds
+            slow_call_threshold: Time to first token in seconds above which an
+                attempt counts as a breaker failure
+        """
+        self.primary_model = primary_model
+        self.fallback_model = fallback_model
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_default_delay = hedge_default_delay
+        self.hedge_min_samples = hedge_min_samples
+        self.request_timeout = request_timeout
+        self.slow_call_threshold = slow_call_threshold
+
+        self.breakers = {
+            "primary": CircuitBreaker("primary", failure_threshold, recovery_timeout),
+            "fallback": CircuitBreaker("fallback", failure_threshold, recovery_timeout),
+        }
+        self.latency = {"primary": LatencyTracker(), "fallback": LatencyTracker()}
+        state_values = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+        for label, breaker in self.breakers.items():
+            GEMINI_BREAKER_STATE.labels(label).set_function(lambda b=breaker: state_values[b.state])
+
+        self._stats_lock = threading.Lock()
+        self.stats = {
+            "requests": 0,
+            "hedges": 0,
+            "hedge_wins": 0,
+            "failovers": 0,
+            "short_circuited": 0,
+            "failed": 0,
+            "background_requests": 0,
+            "background_failed": 0,
+        }
+
+    def _count(self, name: str):
+        with self._stats_lock:
+            self.stats[name] += 1
+        GEMINI_EVENTS.labels(name).inc()
+
+    def hedge_delay(self) -> float:
+        """Current delay before hedging to the fallback model"""
+        tracker = self.latency["primary"]
+        if len(tracker) < self.hedge_min_samples:
+            return self.hedge_default_delay
+        return max(self.hedge_min_delay, tracker.percentile(self.hedge_percentile))
+
+    def _first_token(self, attempt: _Attempt) -> bool:
+        """Record the attempt's time to first token; False if it was already abandoned"""
+        if not attempt.settle():
+            return False
+        ttft = time.perf_counter() - attempt.started
+        self.latency[attempt.label].record(ttft)
+        GEMINI_TTFT.labels(attempt.label).observe(ttft)
+        if ttft > self.slow_call_threshold:
+            self.breakers[attempt.label].record_failure()
+            GEMINI_ATTEMPTS.labels(attempt.label, "slow").inc()
+        else:
+            self.breakers[attempt.label].record_success()
+        return True
+
+    def _abandon(self, attempt: _Attempt, failure: Optional[str] = None):
+        """
+        Stop an attempt that is no longer needed and report its outcome
+
+        Args:
+            attempt: Attempt to stop
+            failure: Why the attempt is a breaker failure ("timeout", "stalled",
+                or "slow" when it was overtaken by a hedge). None means it lost
+                to a fast winner, which is neutral unless it was already slower
+                than `slow_call_threshold`
+        """
+        if attempt.finished or attempt.exited:
+            # Completed or failed on its own; the outcome is already reported
+            return
+        attempt.finished = True
+        attempt.cancelled.set()
+        breaker = self.breakers[attempt.label]
+
+        if attempt.settle():
+            # No first token yet: the elapsed time is a lower bound of the TTFT,
+            # recorded so slow attempts are not missing from the hedge percentile
+            elapsed = time.perf_counter() - attempt.started
+            self.latency[attempt.label].record(elapsed)
+            if failure is None and elapsed > self.slow_call_threshold:
+                failure = "slow"
+            if failure:
+                breaker.record_failure()
+                GEMINI_ATTEMPTS.labels(attempt.label, failure).inc()
+            else:
+                breaker.record_cancelled()
+                GEMINI_ATTEMPTS.labels(attempt.label, "cancelled").inc()
+        elif failure == "stalled":
+            # The first token was already reported; only a stall fails it now
+            breaker.record_failure()
+            GEMINI_ATTEMPTS.labels(attempt.label, failure).inc()
+        else:
+            GEMINI_ATTEMPTS.labels(attempt.label, "cancelled").inc()
+
+        attempt.close_stream()
+
+    def _run_attempt(self, attempt: _Attempt, model, prompt, events: queue.Queue):
+        """Stream one model's response into the shared event queue"""
+        breaker = self.breakers[attempt.label]
+        try:
+            attempt.response = model.generate_content(prompt, stream=True)
+            if attempt.cancelled.is_set():
+                # Abandoned while the request was being sent
+                attempt.close_stream()
+                return
+            for chunk in attempt.response:
+                if attempt.cancelled.is_set():
+                    return
+                text = chunk.text
+                if not text:
+                    continue
+                if attempt.first_token_at is None:
+                    attempt.first_token_at = time.perf_counter()
+                    if not self._first_token(attempt):
+                        return
+                events.put((attempt.label, "chunk", text))
+            if attempt.cancelled.is_set():
+                return
+            if attempt.first_token_at is None and not self._first_token(attempt):
+                return
+            GEMINI_ATTEMPTS.labels(attempt.label, "success").inc()
+            GEMINI_DURATION.labels(attempt.label).observe(time.perf_counter() - attempt.started)
+            events.put((attempt.label, "done", None))
+        except Exception as e:
+            if attempt.cancelled.is_set():
+                # The stream was closed by _abandon, which reported the outcome
+                return
+            attempt.settle()
+            rate_limited = is_rate_limit_error(e)
+            breaker.record_failure(rate_limited=rate_limited)
+            GEMINI_ATTEMPTS.labels(attempt.label, "rate_limited" if rate_limited else "error").inc()
+            events.put((attempt.label, "error", e))
+        finally:
+            attempt.exited = True
+
+    def stream(self, prompt, primary_model=None, fallback_model=None) -> Iterator[str]:
+        """
+        Stream response text from whichever model answers first
+
+        Args:
+            prompt: Prompt passed to generate_content
+            primary_model: Optional per-call primary model handle
+            fallback_model: Optional per-call fallback model handle
+
+        Yields:
+            Text deltas from the winning model
+
+        Raises:
+            CircuitOpenError: Both breakers are open
+            Exception: The last model error when every attempt failed
+        """
+        models = {
+            "primary": primary_model or self.primary_model,
+            "fallback": fallback_model or self.fallback_model,
+        }
+        events: queue.Queue = queue.Queue()
+        attempts: Dict[str, _Attempt] = {}
+        self._count("requests")
+
+        def launch(label: str) -> bool:
+            if label in attempts or not self.breakers[label].allow():
+                return False
+            attempt = _Attempt(label)
+            attempts[label] = attempt
+            # Under gevent monkey-patching this thread runs as a greenlet
+            threading.Thread(
+                target=self._run_attempt,
+                args=(attempt, models[label], prompt, events),
+                name=f"gemini-{label}",
+                daemon=True
+            ).start()
+            return True
+
+        if not launch("primary"):
+            self._count("short_circuited")
+            if not launch("fallback"):
+                self._count("failed")
+                raise CircuitOpenError("Gemini circuit breakers are open for all models")
+
+        hedge_at = time.monotonic() + self.hedge_delay() if "primary" in attempts else None
+        winner = None
+        first_text = None
+        last_error: Optional[Exception] = None
+
+        try:
+            # Wait for the first token from any attempt, hedging if the primary is slow
+            while winner is None:
+                running = [a for a in attempts.values() if not a.finished]
+                if not running:
+                    self._count("failed")
+                    raise last_error or RuntimeError("Gemini returned no response")
+
+                timeout = self.request_timeout
+                if hedge_at is not None:
+                    timeout = min(timeout, max(0.0, hedge_at - time.monotonic()))
+
+                try:
+                    label, kind, payload = events.get(timeout=timeout)
+                except queue.Empty:
+                    if hedge_at is not None and time.monotonic() >= hedge_at:
+                        hedge_at = None
+                        if launch("fallback"):
+                            self._count("hedges")
+                            logger.info("Primary Gemini model is slow; hedging to fallback")
+                        continue
+                    self._count("failed")
+                    for attempt in running:
+                        self._abandon(attempt, "timeout")
+                    raise TimeoutError(f"Gemini did not respond within {self.request_timeout}s")
+
+                if kind == "error":
+                    attempts[label].finished = True
+                    last_error = payload
+                    logger.warning(f"Gemini {label} model failed: {payload}")
+                    if label == "primary" and launch("fallback"):
+                        self._count("failovers")
+                    hedge_at = None
+                    continue
+
+                winner = label
+                if kind == "done":
+                    attempts[label].finished = True
+                    return
+                first_text = payload
+
+            hedge_won = winner == "fallback" and "primary" in attempts and not attempts["primary"].finished
+            if hedge_won:
+                self._count("hedge_wins")
+                # The primary was past its hedge delay and still lost: a brownout
+                # must open its breaker instead of costing the hedge delay every turn
+                self._abandon(attempts["primary"], "slow")
+            for label, attempt in attempts.items():
+                if label != winner:
+                    self._abandon(attempt)
+
+            yield first_text
+
+            # Relay the rest of the winner's stream
+            while True:
+                try:
+                    label, kind, payload = events.get(timeout=self.request_timeout)
+                except queue.Empty:
+                    self._abandon(attempts[winner], "stalled")
+                    raise TimeoutError(f"Gemini stream stalled for {self.request_timeout}s")
+                if label != winner:
+                    continue
+                if kind == "chunk":
+                    yield payload
+                elif kind == "done":
+                    attempts[winner].finished = True
+                    return
+                else:
+                    attempts[winner].finished = True
+                    raise payload
+        finally:
+            # Attempts still running here were not needed (or the caller stopped reading)
+            for attempt in attempts.values():
+                self._abandon(attempt)
+
+    def generate(self, prompt, primary_model=None, fallback_model=None) -> str:
+        """
+        Complete a background prompt (e.g. a conversation summary) without hedging
+
+        Nobody is waiting on these calls and their prompts are large, so they
+        must not feed the live-chat bookkeeping: breakers and the TTFT window are
+        only read, never updated. A model whose breaker is open is skipped, and
+        the fallback model is tried when the primary fails.
+
+        Raises:
+            CircuitOpenError: Both breakers are open
+            Exception: The last model error when every model failed
+        """
+        self._count("background_requests")
+        models = (
+            ("primary", primary_model or self.primary_model),
+            ("fallback", fallback_model or self.fallback_model),
+        )
+        last_error: Optional[Exception] = None
+        for label, model in models:
+            if self.breakers[label].state == CircuitBreaker.OPEN:
+                continue
+            try:
+                response = model.generate_content(prompt, request_options={"timeout": self.request_timeout})
+                return response.text
+            except Exception as e:
+                last_error = e
+                logger.warning(f"Gemini {label} model failed for a background request: {e}")
+
+        self._count("background_failed")
+        raise last_error or CircuitOpenError("Gemini circuit breakers are open for all models")
+
+    def get_stats(self) -> dict:
+        """Breaker states, latency percentiles and hedging counters"""
+        with self._stats_lock:
+            stats = dict(self.stats)
+        stats["hedge_delay_seconds"] = round(self.hedge_delay(), 3)
+        stats["models"] = {}
+        for label, breaker in self.breakers.items():
+            tracker = self.latency[label]
+            p50 = tracker.percentile(0.5)
+            p95 = tracker.percentile(0.95)
+            stats["models"][label] = dict(
+                breaker.get_stats(),
+                ttft_samples=len(tracker),
+                ttft_p50_seconds=round(p50, 3) if p50 is not None else None,
+                ttft_p95_seconds=round(p95, 3) if p95 is not None else None
+            )
+        return stats
+
+
+def create_gemini_client(primary_model, fallback_model) -> GeminiClient:
+    """Create a GeminiClient configured from environment variables"""
+    return GeminiClient(
+        primary_model,
+        fallback_model,
+        hedge_percentile=float(os.getenv('GEMINI_HEDGE_PERCENTILE', '0.95')),
+        hedge_min_delay=float(os.getenv('GEMINI_HEDGE_MIN_DELAY_MS', '1000')) / 1000,
+        hedge_default_delay=float(os.getenv('GEMINI_HEDGE_DEFAULT_DELAY_MS', '3000')) / 1000,
+        failure_threshold=int(os.getenv('GEMINI_BREAKER_FAILURE_THRESHOLD', '3')),
+        recovery_timeout=float(os.getenv('GEMINI_BREAKER_RECOVERY_SECONDS', '30')),
+        request_timeout=float(os.getenv('GEMINI_REQUEST_TIMEOUT_SECONDS', '60')),
+        slow_call_threshold=float(os.getenv('GEMINI_BREAKER_SLOW_CALL_MS', '5000')) / 1000
+    )
@@ -0,0 +1,151 @@
+"""
+Keyword Matcher - shared emotion/topic keyword tables with an Aho-Corasick matcher
+Linear in input length and usable incrementally on streamed text
+"""
+
+from collections import deque
+from typing import Dict, Iterable, List, Set
+
+
+# Shared keyword tables (single source of truth for emotion and topic detection)
+EMOTION_KEYWORDS: Dict[str, List[str]] = {
+    'surprised': ['驚いた', 'びっくり', 'すごい', '信じられない'],
+    'happy': ['嬉しい', '楽しい', '幸せ', '好き', 'ありがとう', '素晴らしい', 'わくわく'],
+    'sad': ['悲しい', '辛い', '嫌い', '疲れた', '困った', '不安'],
+}
+
+# When several emotions match, the first one in this order wins
+EMOTION_PRIORITY = ('surprised', 'happy', 'sad')
+
+TECHNICAL_KEYWORDS: List[str] = [
+    'Python', 'JavaScript', 'AI', '機械学習', 'ディープラーニング', 'API', 'Flask',
+    'React', 'Vue', 'Docker', 'Kubernetes', 'AWS', 'Azure', 'GCP', 'サーバー',
+    'データベース', 'SQL', 'NoSQL', 'セキュリティ', '暗号化', 'ネットワーク',
+    'フロントエンド', 'バックエンド', 'VRM', 'Three.js', 'WebRTC', 'Socket.IO'
+]
+
+
+class KeywordMatcher:
+    """
+    Aho-Corasick automaton over labelled keywords
+
+    One pass over the input finds every keyword occurrence regardless of the
+    number of keywords. The automaton state can be carried across chunks, so
+    keywords split between streamed chunks are still found.
+    """
+
+    def __init__(self, keywords: Dict[str, Iterable[str]], case_insensitive: bool = False):
+        """
+        Args:
+            keywords: Mapping of label -> keywords for that label
+            case_insensitive: Match regardless of case
+        """
+        self.case_insensitive = case_insensitive
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[frozenset] = [frozenset()]
+
+        outputs: List[Set[str]] = [set()]
+        for label, words in keywords.items():
+            for word in words:
+                if self.case_insensitive:
+                    word = word.lower()
+                node = 0
+                for char in word:
+                    next_node = self._goto[node].get(char)
+                    if next_node is None:
+                        next_node = len(self._goto)
+                        self._goto[node][char] = next_node
+                        self._goto.append({})
+                        self._fail.append(0)
+                        outputs.append(set())
+                    node = next_node
+                outputs[node].add(label)
+
+        # Breadth-first construction of failure links; outputs are merged along them
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                outputs[child] |= outputs[self._fail[child]]
+
+        self._output = [frozenset(labels) for labels in outputs]
+
+    def advance(self, state: int, text: str, found: Set[str]) -> int:
+        """Feed text from an automaton state, adding matched labels to `found`"""
+        if self.case_insensitive:
+            text = text.lower()
+        goto, fail, output = self._goto, self._fail, self._output
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found |= output[state]
+        return state
+
+    def labels(self, text: str) -> Set[str]:
+        """All labels whose keywords occur in the text"""
+        found: Set[str] = set()
+        self.advance(0, text, found)
+        return found
+
+    def stream(self) -> 'KeywordStream':
+        """Start incremental matching over streamed chunks"""
+        return KeywordStream(self)
+
+
+class KeywordStream:
+    """Incremental matching state for one stream"""
+
+    def __init__(self, matcher: KeywordMatcher):
+        self.matcher = matcher
+        self.state = 0
+        self.labels: Set[str] = set()
+
+    def feed(self, chunk: str) -> Set[str]:
+        """Feed the next chunk; returns all labels seen so far"""
+        self.state = self.matcher.advance(self.state, chunk, self.labels)
+        return self.labels
+
+
+def classify_emotion(labels: Set[str]) -> str:
+    """Pick the emotion for a set of matched labels"""
+    for emotion in EMOTION_PRIORITY:
+        if emotion in labels:
+            return emotion
+    return 'neutral'
+
+
+emotion_matcher = KeywordMatcher(EMOTION_KEYWORDS)
+technical_matcher = KeywordMatcher({'technical': TECHNICAL_KEYWORDS}, case_insensitive=True)
+
+
+def analyze_emotion(text: str) -> str:
+    """Emotion of a complete text (surprised / happy / sad / neutral)"""
+    return classify_emotion(emotion_matcher.labels(text))
+
+
+def is_technical_topic(text: str) -> bool:
+    """Whether the text mentions a technical keyword"""
+    return bool(technical_matcher.labels(text))
+
+
+class EmotionTracker:
+    """Emotion of streamed text, updated per chunk without rescanning"""
+
+    def __init__(self):
+        self._stream = emotion_matcher.stream()
+
+    def feed(self, chunk: str) -> str:
+        """Feed the next chunk and return the emotion so far"""
+        return classify_emotion(self._stream.feed(chunk))
+
+    @property
+    def emotion(self) -> str:
+        return classify_emotion(self._stream.labels)
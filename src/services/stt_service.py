@@ -0,0 +1,226 @@
+"""
+STT Service - AssemblyAI Speech-to-Text Integration
+Long-lived transcription worker with a pooled HTTP session
+"""
+
+import os
+import asyncio
+import logging
+import threading
+import time
+import concurrent.futures
+from typing import Optional
+
+import aiohttp
+from aiohttp import TCPConnector
+
+from services import metrics
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+STT_REQUESTS = metrics.counter("stt_requests_total", "Speech-to-text requests by outcome", ["outcome"])
+STT_DURATION = metrics.histogram("stt_duration_seconds", "Speech-to-text latency from upload to transcript",
+                                 buckets=(0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 7.5, 10.0, 15.0, 30.0))
+
+
+class STTService:
+    """
+    AssemblyAI-based Speech-to-Text service
+
+    Features:
+    - One long-lived event loop shared by all transcriptions
+    - Pooled aiohttp session (no new connection setup per utterance)
+    - Short initial polls with exponential backoff and a hard deadline
+    - Concurrency limit on in-flight transcriptions
+    """
+
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        base_url: Optional[str] = None,
+        max_concurrent: int = 4,
+        deadline_seconds: float = 30.0,
+        initial_poll_interval: float = 0.3,
+        max_poll_interval: float = 2.0,
+        poll_backoff: float = 1.5
+    ):
+        """
+        Args:
+            api_key: AssemblyAI API key (defaults to ASSEMBLYAI_API_KEY)
+            base_url: API base URL (defaults to ASSEMBLYAI_BASE_URL or the public API)
+            max_concurrent: Maximum number of concurrent transcriptions
+            deadline_seconds: Hard deadline for one transcription (upload + polling)
+            initial_poll_interval: First polling delay in seconds
+            max_poll_interval: Upper bound for the polling delay in seconds
+            poll_backoff: Multiplier applied to the polling delay after each poll
+        """
+        self.api_key = api_key or os.getenv('ASSEMBLYAI_API_KEY')
+        self.base_url = (base_url or os.getenv('ASSEMBLYAI_BASE_URL', 'https://api.assemblyai.com/v2')).rstrip('/')
+        self.max_concurrent = max_concurrent
+        self.deadline_seconds = deadline_seconds
+        self.initial_poll_interval = initial_poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.poll_backoff = poll_backoff
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        """Start the worker event loop on first use"""
+        with self._start_lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                # Under gevent monkey-patching this thread runs as a greenlet
+                worker = threading.Thread(target=self._run_loop, args=(loop,), name='stt-worker', daemon=True)
+                worker.start()
+                self._loop = loop
+            return self._loop
+
+    def _run_loop(self, loop: asyncio.AbstractEventLoop):
+        """Worker entry point"""
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Create the pooled session and semaphore inside the worker loop"""
+        if self._session is None or self._session.closed:
+            connector = TCPConnector(ssl=False, limit=self.max_concurrent * 2, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers={'authorization': self.api_key or ''}
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        return self._session
+
+    def transcribe(self, audio_data: bytes) -> Optional[str]:
+        """
+        Transcribe audio synchronously (safe to call from gevent greenlets)
+
+        Args:
+            audio_data: Raw audio bytes
+
+        Returns:
+            Transcribed text, or None on failure or timeout
+        """
+        loop = self._ensure_loop()
+        future = asyncio.run_coroutine_threadsafe(self.transcribe_async(audio_data), loop)
+        try:
+            # The coroutine enforces the deadline itself; the extra second covers scheduling
+            return future.result(timeout=self.deadline_seconds + 1.0)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            logger.error(f"STT timed out after {self.deadline_seconds}s")
+            return None
+        except Exception as e:
+            logger.error(f"STT error: {e}")
+            return None
+
+    async def transcribe_async(self, audio_data: bytes) -> Optional[str]:
+        """
+        Transcribe audio inside the worker loop
+
+        Returns:
+            Transcribed text, or None on failure or timeout
+        """
+        session = await self._get_session()
+
+        async with self._semaphore:
+            started = time.perf_counter()
+            try:
+                text = await asyncio.wait_for(self._transcribe(session, audio_data), timeout=self.deadline_seconds)
+            except asyncio.TimeoutError:
+                STT_REQUESTS.labels("timeout").inc()
+                logger.error(f"AssemblyAI transcription exceeded deadline of {self.deadline_seconds}s")
+                return None
+            except Exception as e:
+                STT_REQUESTS.labels("error").inc()
+                logger.error(f"STT error: {e}")
+                return None
+
+            STT_REQUESTS.labels("success" if text is not None else "failed").inc()
+            STT_DURATION.observe(time.perf_counter() - started)
+            return text
+
+    async def _transcribe(self, session: aiohttp.ClientSession, audio_data: bytes) -> Optional[str]:
+        """Upload, request and poll one transcription"""
+        # 1. Upload the audio
+        async with session.post(f"{self.base_url}/upload", data=audio_data) as response:
+            if response.status != 200:
+                logger.error(f"AssemblyAI upload failed: {response.status}")
+                return None
+            audio_url = (await response.json())['upload_url']
+
+        # 2. Request the transcription
+        transcript_request = {'audio_url': audio_url, 'language_code': 'ja'}
+        async with session.post(f"{self.base_url}/transcript", json=transcript_request) as response:
+            if response.status != 200:
+                logger.error(f"AssemblyAI transcription request failed: {response.status}")
+                return None
+            transcript_id = (await response.json())['id']
+
+        # 3. Poll with short initial intervals and exponential backoff
+        polling_endpoint = f"{self.base_url}/transcript/{transcript_id}"
+        interval = self.initial_poll_interval
+        while True:
+            await asyncio.sleep(interval)
+
+            async with session.get(polling_endpoint) as response:
+                if response.status != 200:
+                    logger.error(f"AssemblyAI polling failed: {response.status}")
+                    return None
+                result_json = await response.json()
+
+            status = result_json['status']
+            if status == 'completed':
+                return result_json['text']
+            elif status == 'error':
+                logger.error(f"AssemblyAI transcription error: {result_json.get('error')}")
+                return None
+
+            interval = min(interval * self.poll_backoff, self.max_poll_interval)
+
+    def close(self):
+        """Close the pooled session and stop the worker loop"""
+        if self._loop is None:
+            return
+
+        async def _shutdown():
+            if self._session is not None and not self._session.closed:
+                await self._session.close()
+
+        try:
+            asyncio.run_coroutine_threadsafe(_shutdown(), self._loop).result(timeout=5)
+        except Exception as e:
+            logger.error(f"Error closing STT session: {e}")
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop = None
+
+
+# Singleton instance
+_stt_service_instance = None
+
+
+def get_stt_service(force_reinit: bool = False) -> STTService:
+    """
+    Get or create STTService singleton instance
+
+    Args:
+        force_reinit: Force recreation of the instance
+
+    Returns:
+        STTService instance
+    """
+    global _stt_service_instance
+
+    if _stt_service_instance is None or force_reinit:
+        if _stt_service_instance is not None:
+            _stt_service_instance.close()
+        _stt_service_instance = STTService(
+            max_concurrent=int(os.getenv('STT_MAX_CONCURRENCY', '4')),
+            deadline_seconds=float(os.getenv('STT_DEADLINE_SECONDS', '30'))
+        )
+
+    return _stt_service_instance
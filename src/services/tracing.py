@@ -0,0 +1,182 @@
+"""
+Tracing - turn-scoped trace context with stage spans
+Traces are handed to pluggable exporters when every part of the turn is done
+"""
+
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional
+
+
+class TurnTrace:
+    """
+    Timing record for one conversational turn (STT -> LLM -> split -> TTS -> emit)
+
+    Spans are recorded against a monotonic clock and reported as offsets from
+    the start of the turn. A turn can have several parts that finish
+    independently (e.g. the text response and the sentence audio); the trace is
+    exported once all expected parts are complete.
+    """
+
+    def __init__(self, tracer: "Tracer", turn_id: Optional[str] = None, session_id: Optional[str] = None):
+        self.tracer = tracer
+        self.turn_id = turn_id or uuid.uuid4().hex
+        self.session_id = session_id
+        self.started_at = datetime.now(timezone.utc)
+        self._start = time.perf_counter()
+
+        self._spans: List[Dict] = []
+        self._marks: Dict[str, float] = {}
+        self._pending_parts = {"response"}
+        self._finished = False
+        self._lock = threading.Lock()
+
+    def now(self) -> float:
+        """Current time on the trace clock"""
+        return time.perf_counter()
+
+    def record(self, name: str, start: float, end: Optional[float] = None, **attributes):
+        """Record a span measured on the trace clock (end defaults to now)"""
+        end = self.now() if end is None else end
+        span = {
+            "name": name,
+            "start_ms": round((start - self._start) * 1000, 2),
+            "duration_ms": round((end - start) * 1000, 2),
+        }
+        if attributes:
+            span["attributes"] = attributes
+        with self._lock:
+            self._spans.append(span)
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """Time the enclosed block as a span"""
+        start = self.now()
+        try:
+            yield
+        finally:
+            self.record(name, start, **attributes)
+
+    def mark(self, name: str):
+        """Record the first time an event happened (e.g. the first audio sent)"""
+        offset = round((self.now() - self._start) * 1000, 2)
+        with self._lock:
+            self._marks.setdefault(name, offset)
+
+    def expect(self, part: str):
+        """Declare another part that must complete before the trace is exported"""
+        with self._lock:
+            if not self._finished:
+                self._pending_parts.add(part)
+
+    def complete(self, part: str = "response"):
+        """Mark a part as complete; exports the trace when no parts remain"""
+        with self._lock:
+            self._pending_parts.discard(part)
+            if self._finished or self._pending_parts:
+                return
+            self._finished = True
+        self.tracer.export(self)
+
+    def breakdown(self) -> Dict:
+        """Per-stage totals so far (suitable for sending to the client)"""
+        with self._lock:
+            spans = list(self._spans)
+            marks = dict(self._marks)
+
+        stages: "OrderedDict[str, Dict]" = OrderedDict()
+        for span in spans:
+            stage = stages.setdefault(span["name"], {"ms": 0.0, "count": 0})
+            stage["ms"] = round(stage["ms"] + span["duration_ms"], 2)
+            stage["count"] += 1
+
+        return {
+            "turn_id": self.turn_id,
+            "session_id": self.session_id,
+            "started_at": self.started_at.isoformat(),
+            "elapsed_ms": round((self.now() - self._start) * 1000, 2),
+            "stages": stages,
+            "marks": marks,
+        }
+
+    def to_dict(self) -> Dict:
+        """Full trace including individual spans"""
+        data = self.breakdown()
+        with self._lock:
+            data["spans"] = sorted(self._spans, key=lambda s: s["start_ms"])
+        return data
+
+
+class RingBufferExporter:
+    """Keeps the most recent traces in memory for the trace endpoint"""
+
+    def __init__(self, capacity: int = 200):
+        self.capacity = capacity
+        self._traces: deque = deque(maxlen=capacity)
+        self._lock = threading.Lock()
+
+    def export(self, trace: Dict):
+        with self._lock:
+            self._traces.append(trace)
+
+    def recent(self, limit: Optional[int] = None, session_id: Optional[str] = None) -> List[Dict]:
+        """Most recent traces, newest first (optionally only one session's)"""
+        with self._lock:
+            traces = list(self._traces)
+        traces.reverse()
+        if session_id is not None:
+            traces = [trace for trace in traces if trace["session_id"] == session_id]
+        return traces[:limit] if limit else traces
+
+    def get(self, turn_id: str, session_id: Optional[str] = None) -> Optional[Dict]:
+        """A buffered trace by turn id (None if it belongs to another session)"""
+        with self._lock:
+            for trace in reversed(self._traces):
+                if trace["turn_id"] == turn_id:
+                    if session_id is not None and trace["session_id"] != session_id:
+                        return None
+                    return trace
+        return None
+
+
+class Tracer:
+    """
+    Creates turn traces and fans finished ones out to exporters
+
+    An exporter is any object with an export(trace_dict) method. Exporter
+    failures are counted and never propagate into the request path.
+    """
+
+    def __init__(self, exporters: Iterable = ()):
+        self.exporters = list(exporters)
+        self._lock = threading.Lock()
+        self.stats = {"started": 0, "exported": 0, "export_failures": 0}
+
+    def add_exporter(self, exporter):
+        self.exporters.append(exporter)
+
+    def start_turn(self, turn_id: Optional[str] = None, session_id: Optional[str] = None) -> TurnTrace:
+        """Start a trace for a new turn"""
+        with self._lock:
+            self.stats["started"] += 1
+        return TurnTrace(self, turn_id, session_id)
+
+    def export(self, trace: TurnTrace):
+        data = trace.to_dict()
+        for exporter in self.exporters:
+            try:
+                exporter.export(data)
+            except Exception:
+                with self._lock:
+                    self.stats["export_failures"] += 1
+        with self._lock:
+            self.stats["exported"] += 1
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return dict(self.stats)
+
@@ -4,16 +4,504 @@ High-quality text-to-speech using ElevenLabs API
 """
 
 import os
+import json
 import logging
 import requests
 import hashlib
+import random
+import threading
 import time
-from typing import Optional
+from collections import OrderedDict
+from typing import Callable, Optional, Dict, List
 from pathlib import Path
+from requests.adapters import HTTPAdapter
+
+from services import metrics
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
+TTS_REQUESTS = metrics.counter("tts_requests_total", "ElevenLabs synthesis requests by endpoint and outcome",
+                               ["endpoint", "outcome"])
+TTS_DURATION = metrics.histogram("tts_duration_seconds", "ElevenLabs time to receive the complete clip", ["endpoint"])
+TTS_FIRST_BYTE = metrics.histogram("tts_stream_first_byte_seconds", "ElevenLabs streaming time to first audio frame")
+TTS_CACHE_LOOKUPS = metrics.counter("tts_cache_lookups_total", "Audio cache lookups by cache and result",
+                                    ["cache", "result"])
+
+
+class AudioCache:
+    """
+    Content-addressed, size-bounded cache for synthesized audio files
+    
+    Files are named after a hash of everything that affects the audio
+    (text, voice, model, output format, voice settings), so identical
+    requests map to the same file. An in-memory index tracks size and
+    usage of every entry, so lookups never touch the filesystem, and
+    entries are evicted (LRU or LFU) when the byte budget is exceeded.
+    """
+    
+    def __init__(self, cache_dir: Path, max_bytes: int, policy: str = "lru"):
+        """
+        Args:
+            cache_dir: Directory holding the cached audio files
+            max_bytes: Disk budget for cached audio (in bytes)
+            policy: Eviction policy, "lru" or "lfu"
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.policy = policy if policy in ("lru", "lfu") else "lru"
+        
+        # key -> {"filename", "size", "hits"} (ordered by recency of use)
+        self._index: "OrderedDict[str, Dict]" = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        
+        self._load_index()
+    
+    @staticmethod
+    def make_key(text: str, voice_id: str, model: str, output_format: str, voice_settings: dict) -> str:
+        """Build the content address for a synthesis request"""
+        material = json.dumps(
+            {
+                "text": text,
+                "voice_id": voice_id,
+                "model": model,
+                "output_format": output_format,
+                "voice_settings": voice_settings,
+            },
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+    
+    def _load_index(self):
+        """Rebuild the index from files left by a previous run (oldest first)"""
+        try:
+            entries = []
+            for file_path in self.cache_dir.iterdir():
+                key = file_path.stem
+                if len(key) != 64 or not file_path.is_file():
+                    continue
+                stat = file_path.stat()
+                entries.append((stat.st_mtime, key, file_path.name, stat.st_size))
+            
+            for _, key, filename, size in sorted(entries):
+                self._index[key] = {"filename": filename, "size": size, "hits": 0}
+                self._total_bytes += size
+            
+            self._evict()
+            logger.info(f"Audio cache loaded: {len(self._index)} files, {self._total_bytes} bytes")
+            
+        except Exception as e:
+            logger.error(f"Failed to load audio cache index: {str(e)}")
+    
+    def get(self, key: str) -> Optional[str]:
+        """
+        Look up a cached file
+        
+        Returns:
+            Filename of the cached audio, or None on a miss
+        """
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is None:
+                self.misses += 1
+                TTS_CACHE_LOOKUPS.labels("disk", "miss").inc()
+                return None
+            
+            entry["hits"] += 1
+            self._index.move_to_end(key)
+            self.hits += 1
+            TTS_CACHE_LOOKUPS.labels("disk", "hit").inc()
+            return entry["filename"]
+    
+    def peek(self, key: str) -> Optional[str]:
+        """Look up a cached file without counting a lookup or updating usage"""
+        with self._lock:
+            entry = self._index.get(key)
+            return entry["filename"] if entry else None
+    
+    def put(self, key: str, extension: str, content: bytes) -> str:
+        """
+        Store synthesized audio and evict entries beyond the byte budget
+        
+        Returns:
+            Filename of the stored audio
+        """
+        filename = f"{key}.{extension}"
+        file_path = self.cache_dir / filename
+        tmp_path = self.cache_dir / f".{filename}.tmp"
+        
+        # Write atomically so a concurrent reader never sees a partial file
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, file_path)
+        
+        with self._lock:
+            previous = self._index.pop(key, None)
+            if previous:
+                self._total_bytes -= previous["size"]
+            self._index[key] = {"filename": filename, "size": len(content), "hits": 0}
+            self._total_bytes += len(content)
+            self._evict(keep=key)
+        
+        return filename
+    
+    def remove(self, filename: str):
+        """Drop an entry whose file was deleted outside the cache"""
+        with self._lock:
+            key = filename.split(".", 1)[0]
+            entry = self._index.pop(key, None)
+            if entry:
+                self._total_bytes -= entry["size"]
+    
+    def _evict(self, keep: Optional[str] = None):
+        """Evict entries until the cache fits its byte budget (lock must be held)"""
+        while self._total_bytes > self.max_bytes and len(self._index) > (1 if keep else 0):
+            if self.policy == "lfu":
+                # Least hits first; ties go to the least recently used entry
+                victim = min(
+                    (k for k in self._index if k != keep),
+                    key=lambda k: self._index[k]["hits"],
+                )
+            else:
+                victim = next(k for k in self._index if k != keep)
+            
+            entry = self._index.pop(victim)
+            self._total_bytes -= entry["size"]
+            self.evictions += 1
+            
+            try:
+                (self.cache_dir / entry["filename"]).unlink()
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.error(f"Failed to evict cached audio {entry['filename']}: {str(e)}")
+    
+    def get_stats(self) -> dict:
+        """Return hit/miss counters and current usage"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._index),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "policy": self.policy,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class MemoryAudioCache:
+    """
+    Size-bounded in-memory LRU cache for small clips delivered inline
+    
+    Clips sent as Socket.IO attachments never touch the audio directory,
+    so repeated short sentences are served from memory instead.
+    """
+    
+    def __init__(self, max_bytes: int):
+        """
+        Args:
+            max_bytes: Memory budget for cached clips (in bytes)
+        """
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, key: str) -> Optional[bytes]:
+        """Look up a cached clip"""
+        with self._lock:
+            content = self._entries.get(key)
+            if content is None:
+                self.misses += 1
+                TTS_CACHE_LOOKUPS.labels("memory", "miss").inc()
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            TTS_CACHE_LOOKUPS.labels("memory", "hit").inc()
+            return content
+    
+    def put(self, key: str, content: bytes):
+        """Store a clip and evict the least recently used ones beyond the budget"""
+        if len(content) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._total_bytes -= len(previous)
+            self._entries[key] = content
+            self._total_bytes += len(content)
+            while self._total_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._total_bytes -= len(evicted)
+                self.evictions += 1
+    
+    def get_stats(self) -> dict:
+        """Return hit/miss counters and current usage"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls that share a key into one execution
+    
+    The first caller for a key runs the function; callers arriving while it
+    is in flight wait for it and receive the same result (or exception).
+    threading primitives are cooperative under gevent monkey-patching.
+    """
+    
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error: Optional[BaseException] = None
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, "SingleFlight._Call"] = {}
+        self.executions = 0
+        self.shared = 0
+    
+    def do(self, key: str, fn):
+        """Run fn once for all concurrent callers with the same key"""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.shared += 1
+                leader = False
+            else:
+                call = self._calls[key] = SingleFlight._Call()
+                self.executions += 1
+                leader = True
+        
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+    
+    def get_stats(self) -> dict:
+        """In-flight and deduplication counters"""
+        with self._lock:
+            in_flight = len(self._calls)
+        return {
+            "executions": self.executions,
+            "shared": self.shared,
+            "in_flight": in_flight,
+        }
+
+
+class StreamFanout:
+    """
+    Shares one upstream stream between concurrent calls that use the same key
+    
+    The first caller for a key opens the stream and publishes each frame;
+    callers arriving while it is in flight replay the frames published so far,
+    then receive the rest as they arrive, and finally get the same result.
+    """
+    
+    class _Stream:
+        def __init__(self):
+            self.frames: List[bytes] = []
+            self.done = False
+            self.result = None
+            self.changed = threading.Condition()
+        
+        def publish(self, frame: bytes):
+            with self.changed:
+                self.frames.append(frame)
+                self.changed.notify_all()
+        
+        def finish(self):
+            with self.changed:
+                self.done = True
+                self.changed.notify_all()
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._streams: Dict[str, "StreamFanout._Stream"] = {}
+        self.executions = 0
+        self.shared = 0
+    
+    def do(self, key: str, on_chunk: Callable[[bytes], None], fn):
+        """Run fn(publish) once for all concurrent callers with the same key, passing every frame to on_chunk"""
+        with self._lock:
+            stream = self._streams.get(key)
+            if stream is not None:
+                self.shared += 1
+                leader = False
+            else:
+                stream = self._streams[key] = StreamFanout._Stream()
+                self.executions += 1
+                leader = True
+        
+        if not leader:
+            return self._follow(stream, on_chunk)
+        
+        def publish(frame: bytes):
+            stream.publish(frame)
+            on_chunk(frame)
+        
+        try:
+            stream.result = fn(publish)
+            return stream.result
+        finally:
+            with self._lock:
+                del self._streams[key]
+            stream.finish()
+    
+    @staticmethod
+    def _follow(stream: "StreamFanout._Stream", on_chunk: Callable[[bytes], None]):
+        """Forward the leader's frames in order until its stream ends"""
+        sent = 0
+        while True:
+            with stream.changed:
+                while sent == len(stream.frames) and not stream.done:
+                    stream.changed.wait()
+                pending = stream.frames[sent:]
+                done = stream.done
+            for frame in pending:
+                on_chunk(frame)
+            sent += len(pending)
+            if done:
+                return stream.result
+    
+    def get_stats(self) -> dict:
+        """In-flight and deduplication counters"""
+        with self._lock:
+            in_flight = len(self._streams)
+        return {
+            "executions": self.executions,
+            "shared": self.shared,
+            "in_flight": in_flight,
+        }
+
+
+class ElevenLabsClient:
+    """
+    Long-lived HTTP client for the ElevenLabs API
+    
+    Keeps a keep-alive connection pool sized to the TTS concurrency limit,
+    so consecutive sentence requests reuse established TLS connections.
+    requests/urllib3 sockets are cooperative under gevent monkey-patching,
+    and the pool blocks instead of opening extra connections beyond its size.
+    429 and 5xx responses are retried with exponential backoff and full jitter.
+    """
+    
+    RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+    
+    def __init__(
+        self,
+        api_key: str,
+        pool_size: int = 3,
+        connect_timeout: float = 3.05,
+        read_timeout: float = 30.0,
+        max_retries: int = 2,
+        backoff_base: float = 0.5,
+        backoff_max: float = 8.0
+    ):
+        """
+        Args:
+            api_key: ElevenLabs API key
+            pool_size: Maximum number of pooled connections (TTS concurrency)
+            connect_timeout: Connection timeout in seconds
+            read_timeout: Read timeout in seconds
+            max_retries: Number of retries on 429/5xx and connection errors
+            backoff_base: Base delay for exponential backoff in seconds
+            backoff_max: Upper bound for a single backoff delay in seconds
+        """
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Content-Type": "application/json",
+            "xi-api-key": api_key
+        })
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+    
+    def _backoff_delay(self, attempt: int, response: Optional[requests.Response] = None) -> float:
+        """Delay before the next attempt (honours Retry-After when present)"""
+        if response is not None:
+            retry_after = response.headers.get("Retry-After")
+            if retry_after:
+                try:
+                    return min(float(retry_after), self.backoff_max)
+                except ValueError:
+                    pass
+        
+        ceiling = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        return random.uniform(0, ceiling)
+    
+    def post(self, url: str, **kwargs) -> requests.Response:
+        """
+        POST with pooled connections and retry-with-jitter
+        
+        Returns:
+            The final response (callers check the status themselves)
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        
+        attempt = 0
+        while True:
+            try:
+                response = self.session.post(url, **kwargs)
+            except requests.exceptions.ConnectionError:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._backoff_delay(attempt)
+                logger.warning(f"ElevenLabs connection failed, retrying in {delay:.2f}s")
+            else:
+                if response.status_code not in self.RETRY_STATUS_CODES or attempt >= self.max_retries:
+                    return response
+                delay = self._backoff_delay(attempt, response)
+                logger.warning(f"ElevenLabs returned HTTP {response.status_code}, retrying in {delay:.2f}s")
+                response.close()
+            
+            time.sleep(delay)
+            attempt += 1
+    
+    def close(self):
+        """Close all pooled connections"""
+        self.session.close()
+
 
 class VoiceService:
     """
@@ -22,9 +510,28 @@ class VoiceService:
     Features:
     - High-quality multilingual voice synthesis
     - Low latency with turbo model
-    - File-based caching for generated audio
+    - Content-addressed, size-bounded caching for generated audio
+    - Single-flight deduplication of concurrent identical requests
+    - Streaming synthesis that forwards audio frames as they arrive
+    - Inline delivery of small clips from memory, without a file round trip
+    - Per-client output format (codec and bitrate) negotiation
     """
     
+    # ElevenLabs output_format per codec and client bandwidth class
+    OUTPUT_FORMATS = {
+        "mp3": {"low": "mp3_22050_32", "normal": "mp3_22050_32", "high": "mp3_44100_64"},
+        "opus": {"low": "opus_48000_32", "normal": "opus_48000_64", "high": "opus_48000_128"},
+        "pcm": {"low": "pcm_16000", "normal": "pcm_22050", "high": "pcm_24000"},
+    }
+    
+    # MIME type of the audio returned for each codec
+    MIME_TYPES = {
+        "mp3": "audio/mpeg",
+        "opus": "audio/ogg; codecs=opus",
+        "pcm": "audio/pcm",
+        "ulaw": "audio/basic",
+    }
+    
     def __init__(self):
         """Initialize the ElevenLabs Voice Service"""
         
@@ -49,14 +556,44 @@ class VoiceService:
         self.model = "eleven_turbo_v2_5"  # Low latency model
         # Alternative: "eleven_multilingual_v2" for higher quality
         
-        # Output format
-        self.output_format = "mp3_22050_32"  # Optimized for web playback
+        # Default output format (used when a client does not negotiate one)
+        self.output_format = os.getenv('TTS_OUTPUT_FORMAT', 'mp3_22050_32')  # Optimized for web playback
         
         # Audio output directory
         project_root = Path(__file__).parent.parent.parent
         self.audio_dir = project_root / "frontend" / "audio"
         self.audio_dir.mkdir(parents=True, exist_ok=True)
         
+        # Pooled HTTP client (pool size matches the TTS concurrency limit)
+        self.client = ElevenLabsClient(
+            self.api_key,
+            pool_size=int(os.getenv('TTS_MAX_CONCURRENCY', '3')),
+            connect_timeout=float(os.getenv('ELEVENLABS_CONNECT_TIMEOUT', '3.05')),
+            read_timeout=float(os.getenv('ELEVENLABS_READ_TIMEOUT', '30')),
+            max_retries=int(os.getenv('ELEVENLABS_MAX_RETRIES', '2'))
+        )
+        
+        # Audio cache (disk budget and eviction policy are configurable)
+        self.cache = AudioCache(
+            self.audio_dir,
+            max_bytes=int(os.getenv('TTS_CACHE_MAX_BYTES', str(200 * 1024 * 1024))),
+            policy=os.getenv('TTS_CACHE_POLICY', 'lru')
+        )
+        
+        # Concurrent cache misses for the same key share one API call
+        self.inflight = SingleFlight()
+        # Concurrent streaming requests for the same key share one upstream stream
+        self.stream_fanout = StreamFanout()
+        
+        # Streaming synthesis: frame size forwarded per read, and whether streamed
+        # audio is also written to the cache
+        self.stream_chunk_bytes = int(os.getenv('TTS_STREAM_CHUNK_BYTES', '4096'))
+        self.stream_tee_to_cache = os.getenv('TTS_STREAM_CACHE', 'true').lower() == 'true'
+        
+        # Inline delivery: clips up to this size are returned as bytes and kept in memory
+        self.inline_max_bytes = int(os.getenv('TTS_INLINE_MAX_BYTES', str(64 * 1024)))
+        self.inline_cache = MemoryAudioCache(int(os.getenv('TTS_INLINE_CACHE_MAX_BYTES', str(32 * 1024 * 1024))))
+        
         logger.info(f"ElevenLabs VoiceService initialized")
         logger.info(f"Audio output directory: {self.audio_dir}")
         logger.info(f"Model: {self.model}")
@@ -69,7 +606,8 @@ class VoiceService:
         stability: float = 0.5,
         similarity_boost: float = 0.75,
         style: float = 0.0,
-        use_speaker_boost: bool = True
+        use_speaker_boost: bool = True,
+        output_format: Optional[str] = None
     ) -> Optional[str]:
         """
         Generate audio from text using ElevenLabs API
@@ -82,6 +620,7 @@ class VoiceService:
             similarity_boost: Voice similarity (0.0-1.0)
             style: Style exaggeration (0.0-1.0)
             use_speaker_boost: Enable speaker boost
+            output_format: ElevenLabs output format (defaults to the service default)
         
         Returns:
             Relative URL path to the generated audio file (e.g., "/audio/abc123.mp3")
@@ -92,65 +631,290 @@ class VoiceService:
             logger.warning("Empty text provided for TTS")
             return None
         
-        # Determine voice ID
+        output_format = output_format or self.output_format
+        voice_id, voice_settings, cache_key = self._prepare_request(
+            text, character_id, voice_id, stability, similarity_boost, style, use_speaker_boost, output_format
+        )
+        
+        # Serve identical requests from the cache
+        cached_filename = self.cache.get(cache_key)
+        if cached_filename:
+            logger.info(f"✓ Audio cache hit: {cached_filename}")
+            return f"/audio/{cached_filename}"
+        
+        return self.inflight.do(
+            cache_key,
+            lambda: self._synthesize(cache_key, text, voice_id, voice_settings, output_format)
+        )
+    
+    def generate_audio_inline(
+        self,
+        text: str,
+        character_id: str = "shiro",
+        voice_id: Optional[str] = None,
+        stability: float = 0.5,
+        similarity_boost: float = 0.75,
+        style: float = 0.0,
+        use_speaker_boost: bool = True,
+        output_format: Optional[str] = None
+    ) -> Dict[str, Optional[object]]:
+        """
+        Generate audio for inline delivery
+        
+        Clips up to `inline_max_bytes` are returned as bytes and cached in memory
+        only; larger clips are stored in the audio cache and returned as a URL.
+        
+        Returns:
+            {"content": bytes or None, "url": str or None}; both None on failure
+        """
+        if not text or not text.strip():
+            logger.warning("Empty text provided for TTS")
+            return {"content": None, "url": None}
+        
+        output_format = output_format or self.output_format
+        voice_id, voice_settings, cache_key = self._prepare_request(
+            text, character_id, voice_id, stability, similarity_boost, style, use_speaker_boost, output_format
+        )
+        
+        content = self.inline_cache.get(cache_key)
+        if content is not None:
+            return {"content": content, "url": None}
+        
+        # Large clips from earlier requests are already on disk
+        cached_filename = self.cache.get(cache_key)
+        if cached_filename:
+            return {"content": None, "url": f"/audio/{cached_filename}"}
+        
+        return self.inflight.do(
+            f"{cache_key}:inline",
+            lambda: self._synthesize_inline(cache_key, text, voice_id, voice_settings, output_format)
+        )
+    
+    def _synthesize_inline(self, cache_key: str, text: str, voice_id: str, voice_settings: dict,
+                           output_format: str) -> Dict[str, Optional[object]]:
+        """Call the ElevenLabs API and keep small clips in memory (runs once per in-flight key)"""
+        content = self._request_audio(text, voice_id, voice_settings, output_format)
+        if content is None:
+            return {"content": None, "url": None}
+        
+        if len(content) <= self.inline_max_bytes:
+            self.inline_cache.put(cache_key, content)
+            return {"content": content, "url": None}
+        
+        filename = self.cache.put(cache_key, self._file_extension(output_format), content)
+        return {"content": None, "url": f"/audio/{filename}"}
+    
+    def stream_audio(
+        self,
+        text: str,
+        on_chunk: Callable[[bytes], None],
+        character_id: str = "shiro",
+        voice_id: Optional[str] = None,
+        stability: float = 0.5,
+        similarity_boost: float = 0.75,
+        style: float = 0.0,
+        use_speaker_boost: bool = True,
+        output_format: Optional[str] = None
+    ) -> Optional[str]:
+        """
+        Synthesize via the ElevenLabs streaming endpoint, forwarding audio as it arrives
+        
+        Each frame read from the response is passed to `on_chunk` immediately,
+        so playback can start after the first few KB. When teeing is enabled the
+        complete clip is also stored in the cache; a cache hit sends no frames.
+        Concurrent calls for the same clip share one upstream stream and each
+        receive all of its frames.
+        
+        Args:
+            text: Text to synthesize
+            on_chunk: Called with each audio frame (bytes) in order
+            character_id: Character personality ID (maps to voice)
+            voice_id: Optional explicit voice ID (overrides character_id)
+            output_format: ElevenLabs output format (defaults to the service default)
+        
+        Returns:
+            Relative URL path of the cached audio file (on a cache hit or after
+            teeing a complete stream), otherwise None
+        """
+        if not text or not text.strip():
+            logger.warning("Empty text provided for TTS")
+            return None
+        
+        output_format = output_format or self.output_format
+        voice_id, voice_settings, cache_key = self._prepare_request(
+            text, character_id, voice_id, stability, similarity_boost, style, use_speaker_boost, output_format
+        )
+        
+        cached_filename = self.cache.get(cache_key)
+        if cached_filename:
+            logger.info(f"✓ Audio cache hit: {cached_filename}")
+            return f"/audio/{cached_filename}"
+        
+        return self.stream_fanout.do(
+            cache_key,
+            on_chunk,
+            lambda publish: self._stream_upstream(cache_key, text, voice_id, voice_settings, output_format, publish)
+        )
+    
+    def _stream_upstream(self, cache_key: str, text: str, voice_id: str, voice_settings: dict,
+                         output_format: str, on_chunk: Callable[[bytes], None]) -> Optional[str]:
+        """Open the ElevenLabs stream and forward its frames (runs once per in-flight key)"""
+        # A stream for this key may have completed between the cache lookup and now
+        cached_filename = self.cache.peek(cache_key)
+        if cached_filename:
+            return f"/audio/{cached_filename}"
+        
+        logger.info(f"Streaming audio for '{text[:50]}...' with voice: {voice_id}")
+        
+        url = f"{self.base_url}/text-to-speech/{voice_id}/stream"
+        payload = {
+            "text": text,
+            "model_id": self.model,
+            "voice_settings": voice_settings
+        }
+        
+        frames = []
+        received = 0
+        started = time.perf_counter()
+        try:
+            response = self.client.post(
+                url,
+                params={"output_format": output_format},
+                json=payload,
+                headers={"Accept": self.mime_type(output_format)},
+                stream=True
+            )
+            try:
+                response.raise_for_status()
+                for frame in response.iter_content(chunk_size=self.stream_chunk_bytes):
+                    if not frame:
+                        continue
+                    if not received:
+                        TTS_FIRST_BYTE.observe(time.perf_counter() - started)
+                    received += 1
+                    if self.stream_tee_to_cache:
+                        frames.append(frame)
+                    on_chunk(frame)
+            finally:
+                response.close()
+            
+        except requests.exceptions.HTTPError as e:
+            TTS_REQUESTS.labels("stream", "http_error").inc()
+            logger.error(f"ElevenLabs streaming API returned HTTP {e.response.status_code}: {str(e)}")
+            return None
+            
+        except requests.exceptions.RequestException as e:
+            # Includes timeouts and connections dropped mid-stream; frames already
+            # forwarded stay with the client, but a partial clip is never cached
+            TTS_REQUESTS.labels("stream", "connection_error").inc()
+            logger.error(f"ElevenLabs streaming request failed: {str(e)}")
+            return None
+            
+        except Exception as e:
+            TTS_REQUESTS.labels("stream", "error").inc()
+            logger.error(f"Unexpected error in streaming TTS: {str(e)}")
+            return None
+        
+        TTS_REQUESTS.labels("stream", "success").inc()
+        TTS_DURATION.labels("stream").observe(time.perf_counter() - started)
+        
+        if not frames:
+            return None
+        
+        content = b"".join(frames)
+        filename = self.cache.put(cache_key, self._file_extension(output_format), content)
+        logger.info(f"✓ Audio streamed successfully: {filename} ({len(content)} bytes)")
+        return f"/audio/{filename}"
+    
+    def _prepare_request(
+        self,
+        text: str,
+        character_id: str,
+        voice_id: Optional[str],
+        stability: float,
+        similarity_boost: float,
+        style: float,
+        use_speaker_boost: bool,
+        output_format: str
+    ):
+        """Resolve the voice, voice settings and cache key for a synthesis request"""
         if voice_id is None:
             voice_id = self.voice_map.get(character_id, self.voice_map["default"])
         
-        logger.info(f"Generating audio for '{text[:50]}...' with voice: {voice_id}")
+        voice_settings = {
+            "stability": stability,
+            "similarity_boost": similarity_boost,
+            "style": style,
+            "use_speaker_boost": use_speaker_boost
+        }
+        
+        cache_key = AudioCache.make_key(text, voice_id, self.model, output_format, voice_settings)
+        return voice_id, voice_settings, cache_key
+    
+    def _synthesize(self, cache_key: str, text: str, voice_id: str, voice_settings: dict,
+                    output_format: str) -> Optional[str]:
+        """Call the ElevenLabs API and store the result (runs once per in-flight key)"""
+        # A flight for this key may have completed between the cache lookup and now;
+        # the caller already counted this lookup as a miss
+        cached_filename = self.cache.peek(cache_key)
+        if cached_filename:
+            return f"/audio/{cached_filename}"
+        
+        content = self._request_audio(text, voice_id, voice_settings, output_format)
+        if content is None:
+            return None
         
-        # Generate unique filename based on text hash
-        text_hash = hashlib.md5(text.encode()).hexdigest()
-        filename = f"{text_hash}_{int(time.time())}.mp3"
-        file_path = self.audio_dir / filename
+        # Save audio file into the cache
+        filename = self.cache.put(cache_key, self._file_extension(output_format), content)
+        
+        # Return relative URL path
+        return f"/audio/{filename}"
+    
+    def _request_audio(self, text: str, voice_id: str, voice_settings: dict, output_format: str) -> Optional[bytes]:
+        """Call the ElevenLabs API and return the audio bytes, or None on failure"""
+        logger.info(f"Generating audio for '{text[:50]}...' with voice: {voice_id}")
         
         # Construct API URL
         url = f"{self.base_url}/text-to-speech/{voice_id}"
         
-        # Request headers
+        # Request headers (API key and content type are set on the pooled session)
         headers = {
-            "Accept": "audio/mpeg",
-            "Content-Type": "application/json",
-            "xi-api-key": self.api_key
+            "Accept": self.mime_type(output_format)
         }
         
         # Request payload
         payload = {
             "text": text,
             "model_id": self.model,
-            "voice_settings": {
-                "stability": stability,
-                "similarity_boost": similarity_boost,
-                "style": style,
-                "use_speaker_boost": use_speaker_boost
-            }
+            "voice_settings": voice_settings
         }
         
+        started = time.perf_counter()
         try:
-            # Make API request
-            response = requests.post(
+            # Make API request over the pooled connection
+            response = self.client.post(
                 url,
+                params={"output_format": output_format},
                 json=payload,
-                headers=headers,
-                timeout=30  # 30 seconds timeout
+                headers=headers
             )
             
             # Check response status
             response.raise_for_status()
             
-            # Save audio file
-            with open(file_path, 'wb') as f:
-                f.write(response.content)
-            
-            logger.info(f"✓ Audio generated successfully: {filename} ({len(response.content)} bytes)")
+            TTS_REQUESTS.labels("convert", "success").inc()
+            TTS_DURATION.labels("convert").observe(time.perf_counter() - started)
+            logger.info(f"✓ Audio generated successfully ({len(response.content)} bytes)")
             
-            # Return relative URL path
-            return f"/audio/{filename}"
+            return response.content
             
         except requests.exceptions.Timeout:
+            TTS_REQUESTS.labels("convert", "timeout").inc()
             logger.error("ElevenLabs API request timed out")
             return None
             
         except requests.exceptions.HTTPError as e:
+            TTS_REQUESTS.labels("convert", "http_error").inc()
             status_code = e.response.status_code
             logger.error(f"ElevenLabs API returned HTTP {status_code}: {str(e)}")
             
@@ -164,15 +928,61 @@ class VoiceService:
             return None
             
         except requests.exceptions.ConnectionError as e:
+            TTS_REQUESTS.labels("convert", "connection_error").inc()
             logger.error(f"Connection failed to ElevenLabs API: {str(e)}")
             return None
             
         except Exception as e:
+            TTS_REQUESTS.labels("convert", "error").inc()
             logger.error(f"Unexpected error in TTS generation: {str(e)}")
             import traceback
             logger.debug(traceback.format_exc())
             return None
     
+    def _file_extension(self, output_format: str) -> str:
+        """File extension matching an output format"""
+        codec = output_format.split("_", 1)[0]
+        return {"mp3": "mp3", "pcm": "pcm", "ulaw": "ulaw", "opus": "opus"}.get(codec, "bin")
+    
+    def mime_type(self, output_format: Optional[str] = None) -> str:
+        """MIME type of audio in an output format"""
+        codec = (output_format or self.output_format).split("_", 1)[0]
+        return self.MIME_TYPES.get(codec, "application/octet-stream")
+    
+    def negotiate_output_format(self, codecs, bandwidth: str = "normal") -> str:
+        """
+        Pick the ElevenLabs output format for a client
+        
+        Args:
+            codecs: Codecs the client can handle, in order of preference
+                (e.g. ["opus", "mp3"]; "pcm" for clients doing their own analysis)
+            bandwidth: Client bandwidth class, "low", "normal" or "high"
+        
+        Returns:
+            The first supported codec's format for the bandwidth class, or the
+            default output format when none of the codecs is supported
+        """
+        if bandwidth not in ("low", "normal", "high"):
+            bandwidth = "normal"
+        for codec in codecs or []:
+            formats = self.OUTPUT_FORMATS.get(str(codec).strip().lower())
+            if formats:
+                return formats[bandwidth]
+        return self.output_format
+    
+    def get_cache_stats(self) -> dict:
+        """
+        Get audio cache statistics
+        
+        Returns:
+            Dictionary with hit/miss counters, disk usage and single-flight/fan-out counters
+        """
+        stats = self.cache.get_stats()
+        stats["single_flight"] = self.inflight.get_stats()
+        stats["stream_fanout"] = self.stream_fanout.get_stats()
+        stats["inline"] = self.inline_cache.get_stats()
+        return stats
+    
     def get_available_speakers(self) -> dict:
         """
         Get available character voice mappings
@@ -199,11 +1009,14 @@ class VoiceService:
             max_age_seconds = max_age_hours * 3600
             
             deleted_count = 0
-            for file_path in self.audio_dir.glob("*.mp3"):
+            for file_path in self.audio_dir.glob("*.*"):
+                if not file_path.is_file() or file_path.name.startswith("."):
+                    continue
                 file_age = current_time - file_path.stat().st_mtime
                 
                 if file_age > max_age_seconds:
                     file_path.unlink()
+                    self.cache.remove(file_path.name)
                     deleted_count += 1
             
             if deleted_count > 0:
@@ -230,6 +1043,8 @@ def get_voice_service(force_reinit: bool = False) -> VoiceService:
     global _voice_service_instance
     
     if _voice_service_instance is None or force_reinit:
+        if _voice_service_instance is not None:
+            _voice_service_instance.client.close()
         _voice_service_instance = VoiceService()
     
     return _voice_service_instance
@@ -0,0 +1,11 @@
+"""
+Shared test setup - puts src/ on sys.path the way the app is run (python src/app.py)
+"""
+
+import os
+import sys
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
@@ -0,0 +1,234 @@
+"""
+STTService against a local stand-in of the AssemblyAI upload/transcript endpoints
+"""
+
+import asyncio
+import itertools
+import json
+import os
+import subprocess
+import sys
+import textwrap
+import threading
+import time
+
+import pytest
+from aiohttp import web
+
+import services
+from services.stt_service import STTService, STT_REQUESTS
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(services.__file__)))
+
+
+class AssemblyAIStandIn:
+    """
+    Minimal AssemblyAI API served by aiohttp on its own thread and event loop
+
+    The uploaded bytes are echoed back as the transcript text, so concurrent
+    callers can check they received their own result. A transcript completes
+    once `processing_seconds` have passed since it was requested.
+    """
+
+    def __init__(self):
+        self.processing_seconds = 0.0
+        self.upload_status = 200
+        self.transcript_status = 'completed'  # 'completed', 'error' or 'never'
+        self.polls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.auth_headers = set()
+
+        self._ids = itertools.count(1)
+        self._uploads = {}
+        self._transcripts = {}
+        self._loop = asyncio.new_event_loop()
+        self._started = threading.Event()
+        self._runner = None
+        self.port = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    async def _upload(self, request):
+        self.auth_headers.add(request.headers.get('authorization'))
+        if self.upload_status != 200:
+            return web.json_response({'error': 'upload failed'}, status=self.upload_status)
+        upload_id = next(self._ids)
+        self._uploads[upload_id] = await request.read()
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        return web.json_response({'upload_url': f"{self.base_url}/files/{upload_id}"})
+
+    async def _create_transcript(self, request):
+        body = await request.json()
+        upload_id = int(body['audio_url'].rsplit('/', 1)[1])
+        transcript_id = f"t{next(self._ids)}"
+        self._transcripts[transcript_id] = {'upload_id': upload_id, 'created': time.monotonic(), 'done': False}
+        return web.json_response({'id': transcript_id, 'status': 'queued'})
+
+    async def _poll_transcript(self, request):
+        self.polls += 1
+        transcript = self._transcripts[request.match_info['transcript_id']]
+        ready = time.monotonic() - transcript['created'] >= self.processing_seconds
+        if self.transcript_status == 'never' or not ready:
+            return web.json_response({'status': 'processing'})
+
+        if not transcript['done']:
+            transcript['done'] = True
+            self.in_flight -= 1
+        if self.transcript_status == 'error':
+            return web.json_response({'status': 'error', 'error': 'audio could not be decoded'})
+        text = self._uploads[transcript['upload_id']].decode('utf-8')
+        return web.json_response({'status': 'completed', 'text': text})
+
+    def _serve(self):
+        asyncio.set_event_loop(self._loop)
+        app = web.Application()
+        app.router.add_post('/upload', self._upload)
+        app.router.add_post('/transcript', self._create_transcript)
+        app.router.add_get('/transcript/{transcript_id}', self._poll_transcript)
+
+        self._runner = web.AppRunner(app)
+        self._loop.run_until_complete(self._runner.setup())
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        self._loop.run_until_complete(site.start())
+        self.port = site._server.sockets[0].getsockname()[1]
+        self._started.set()
+        self._loop.run_forever()
+
+    def start(self):
+        threading.Thread(target=self._serve, name='assemblyai-stand-in', daemon=True).start()
+        self._started.wait(timeout=5)
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result(timeout=5)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+@pytest.fixture
+def stand_in():
+    server = AssemblyAIStandIn()
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def make_service(stand_in):
+    created = []
+
+    def factory(**kwargs):
+        options = dict(api_key='test-key', base_url=stand_in.base_url,
+                       initial_poll_interval=0.01, max_poll_interval=0.05)
+        options.update(kwargs)
+        service = STTService(**options)
+        created.append(service)
+        return service
+
+    yield factory
+    for service in created:
+        service.close()
+
+
+def test_upload_transcript_and_poll(stand_in, make_service):
+    stand_in.processing_seconds = 0.1
+    service = make_service()
+
+    assert service.transcribe('こんにちは'.encode('utf-8')) == 'こんにちは'
+    # Still processing on the first poll, so the worker had to poll again
+    assert stand_in.polls >= 2
+    assert stand_in.auth_headers == {'test-key'}
+
+
+def test_session_is_reused_across_transcriptions(stand_in, make_service):
+    service = make_service()
+
+    assert service.transcribe(b'one') == 'one'
+    session = service._session
+    assert service.transcribe(b'two') == 'two'
+    assert service._session is session
+
+
+def test_polling_stops_at_deadline(stand_in, make_service):
+    stand_in.transcript_status = 'never'
+    service = make_service(deadline_seconds=0.3)
+    timeouts = STT_REQUESTS.labels('timeout').get()
+
+    started = time.monotonic()
+    assert service.transcribe(b'never finishes') is None
+    elapsed = time.monotonic() - started
+
+    assert elapsed < 1.0
+    assert STT_REQUESTS.labels('timeout').get() == timeouts + 1
+
+
+def test_transcript_error_status(stand_in, make_service):
+    stand_in.transcript_status = 'error'
+    service = make_service()
+    failed = STT_REQUESTS.labels('failed').get()
+
+    assert service.transcribe(b'noise') is None
+    assert STT_REQUESTS.labels('failed').get() == failed + 1
+
+
+def test_upload_http_error(stand_in, make_service):
+    stand_in.upload_status = 500
+    service = make_service()
+
+    assert service.transcribe(b'audio') is None
+    assert stand_in.polls == 0
+
+
+# Runs in a child interpreter because gevent must patch before anything else is imported
+GEVENT_SCRIPT = textwrap.dedent('''
+    from gevent import monkey
+    monkey.patch_all()
+
+    import json, sys, time
+    import gevent
+    from services.stt_service import STTService
+
+    base_url, count, max_concurrent = sys.argv[1], int(sys.argv[2]), int(sys.argv[3])
+    service = STTService(api_key='test-key', base_url=base_url, max_concurrent=max_concurrent,
+                         deadline_seconds=10, initial_poll_interval=0.01, max_poll_interval=0.05)
+
+    ticks = 0
+    def heartbeat():
+        global ticks
+        while True:
+            gevent.sleep(0.01)
+            ticks += 1
+    ticker = gevent.spawn(heartbeat)
+
+    started = time.monotonic()
+    jobs = [gevent.spawn(service.transcribe, f'utterance-{i}'.encode()) for i in range(count)]
+    gevent.joinall(jobs, timeout=15)
+    elapsed = time.monotonic() - started
+    ticker.kill()
+    service.close()
+
+    print(json.dumps({'results': [job.value for job in jobs], 'elapsed': elapsed, 'ticks': ticks}))
+''')
+
+
+def test_concurrent_transcriptions_under_gevent(stand_in):
+    stand_in.processing_seconds = 0.3
+    count, max_concurrent = 6, 3
+
+    env = dict(os.environ, PYTHONPATH=SRC_DIR)
+    completed = subprocess.run(
+        [sys.executable, '-c', GEVENT_SCRIPT, stand_in.base_url, str(count), str(max_concurrent)],
+        capture_output=True, text=True, timeout=30, env=env
+    )
+    assert completed.returncode == 0, completed.stderr
+    report = json.loads(completed.stdout.strip().splitlines()[-1])
+
+    # Every greenlet got its own transcript back
+    assert report['results'] == [f'utterance-{i}' for i in range(count)]
+    # Two waves of three run in parallel instead of six sequential transcriptions
+    assert report['elapsed'] < count * stand_in.processing_seconds
+    assert stand_in.max_in_flight == max_concurrent
+    # Waiting on the worker yields to the gevent hub instead of blocking it
+    assert report['ticks'] >= report['elapsed'] / 0.01 * 0.5